@@ -7,9 +7,8 @@ from zipfile import ZipFile
 from StringIO import StringIO
 
 import click
-import requests
 
-from strephit.commons import secrets
+from strephit.commons import secrets, web
 from strephit.commons.logging import log_request_data
 
 logger = logging.getLogger(__name__)
@@ -22,7 +21,7 @@ def get_latest_job_id():
     :return: the latest job ID
     :rtype: str
     """
-    r = requests.get(secrets.CF_JOBS_URL, params={'key': secrets.CF_KEY})
+    r = web.get(secrets.CF_JOBS_URL, params={'key': secrets.CF_KEY})
     log_request_data(r, logger)
     r.raise_for_status()
     # The API call returns the 10 latest jobs
@@ -42,7 +41,7 @@ def download_full_report(job_id):
         'key': secrets.CF_KEY,
         'type': 'full'
     }
-    r = requests.get(secrets.CF_JOB_RESULTS_URL % job_id, params=params)
+    r = web.get(secrets.CF_JOB_RESULTS_URL % job_id, params=params)
     log_request_data(r, logger)
     r.raise_for_status()
     zipped_report = ZipFile(StringIO(r.content))
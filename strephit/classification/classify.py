@@ -7,7 +7,7 @@ import click
 from sklearn.externals import joblib
 
 from strephit.commons.classification import apply_custom_classification_rules, reverse_gazetteer
-from strephit.commons import parallel
+from strephit.commons import parallel, codec, pos_tag
 
 logger = logging.getLogger(__name__)
 
@@ -32,20 +32,20 @@ class SentenceClassifier:
         """
         self.extractor.start()
 
-        sentences_data = []
+        sentences_data, rows = [], []
         for data in sentences:
             if 'url' not in data:
                 logger.warn('found a sentence with no URL (row number %d), skipping it')
                 continue
 
             entities = dict(enumerate(e['chunk'] for e in data.get('linked_entities', [])))
-            tagged = self.extractor.process_sentence(
-                data['text'], data['lu'], entities, add_unknown=False, gazetteer=self.gazetteer
-            )
-
-            data['tagged'] = tagged
+            rows.append((data['text'], data['lu'], entities))
             sentences_data.append(data)
 
+        tagged = self.extractor.process_sentences(rows, add_unknown=False, gazetteer=self.gazetteer)
+        for data, each in zip(sentences_data, tagged):
+            data['tagged'] = each
+
         features, _ = self.extractor.get_features(refit=False)
         y = self.model.predict(features)
 
@@ -109,14 +109,14 @@ def main(sentences, model, language, outfile, processes, gazetteer):
     classifier = SentenceClassifier(model, extractor, language, gazetteer)
 
     def worker(batch):
-        data = (json.loads(s) for s in batch)
+        data = (codec.loads(s) for s in batch)
         for classified in classifier.classify_sentences(data):
-            yield json.dumps(classified)
+            yield codec.dumps(classified)
 
     logger.info('Starting classification')
     count = 0
-    for each in parallel.map(worker, sentences, batch_size=100,
-                             flatten=True, processes=processes):
+    for each in parallel.map(worker, sentences, batch_size='auto',
+                             flatten=True, processes=processes, ordered=True):
         outfile.write(each)
         outfile.write('\n')
 
@@ -125,5 +125,6 @@ def main(sentences, model, language, outfile, processes, gazetteer):
             logger.info('Classified %d sentences', count)
 
     logger.info('Done, classified %d sentences', count)
+    pos_tag.log_cache_stats()
     if count > 0:
         logger.info("Dumped classified sentences to '%s'", outfile.name)
@@ -5,7 +5,8 @@ import numpy as np
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.decomposition import TruncatedSVD
 import gensim
-from strephit.commons.pos_tag import TTPosTagger
+from strephit.commons import parallel
+from strephit.commons.pos_tag import get_pos_tagger
 from strephit.commons.stopwords import StopWords
 
 
@@ -33,7 +34,7 @@ class BagOfTermsFeatureExtractor(object):
              or to keep them split.
         """
         self.language = language
-        self.tagger = TTPosTagger(language)
+        self.tagger = get_pos_tagger(language)
         self.window_width = window_width
         self.collapse_fes = collapse_fes
         self.unk_feature = 'UNK'
@@ -54,7 +55,7 @@ class BagOfTermsFeatureExtractor(object):
     def lu_column(self):
         return self.vectorizer.vocabulary_['lu'] if not self.target_size else None
 
-    def process_sentence(self, sentence, lu, fes, add_unknown, gazetteer):
+    def process_sentence(self, sentence, lu, fes, add_unknown, gazetteer, tagged=None):
         """ Extracts and accumulates features for the given sentence
 
             :param unicode sentence: Text of the sentence
@@ -67,6 +68,7 @@ class BagOfTermsFeatureExtractor(object):
             :param dict gazetteer: Additional features to add when a given
              chunk is found in the sentence. Keys should be chunks and
              values should be list of features
+            :param list tagged: POS tags of the sentence, if already known
             :return: List of tuples whose first elements are chunks of words
              and the second ones indicate whether the chunk was used as a
              sample or skipped altogether
@@ -74,7 +76,7 @@ class BagOfTermsFeatureExtractor(object):
         """
 
         gazetteer = gazetteer or {}
-        tagged = self.sentence_to_tokens(sentence, fes)
+        tagged = self.sentence_to_tokens(sentence, fes, tagged)
 
         ret = []
         for position in xrange(len(tagged)):
@@ -107,6 +109,33 @@ class BagOfTermsFeatureExtractor(object):
 
         return ret
 
+    def process_sentences(self, sentences, add_unknown, gazetteer, batch_size=500):
+        """ Extracts and accumulates features for many sentences, see
+            :meth:`process_sentence`. The sentences are POS-tagged in batches,
+            which is much faster than tagging them one by one
+
+            :param sentences: Iterable of tuples (sentence, lu, fes)
+            :param bool add_unknown: see :meth:`process_sentence`
+            :param dict gazetteer: see :meth:`process_sentence`
+            :param int batch_size: How many sentences to tag at once
+            :return: The result of :meth:`process_sentence` for each sentence, in order
+            :rtype: list
+        """
+        processed = []
+        for batch in parallel.make_batches(sentences, batch_size):
+            tagged = iter(self.tagger.tag_sentences(
+                [sentence for sentence, _, _ in batch if sentence.strip()],
+                skip_unknown=False, batch_size=batch_size
+            ))
+
+            for sentence, lu, fes in batch:
+                processed.append(self.process_sentence(
+                    sentence, lu, fes, add_unknown, gazetteer,
+                    next(tagged) if sentence.strip() else None
+                ))
+
+        return processed
+
     def add_feature_to(self, sample, feature_name, feature_value, add_unknown):
         if add_unknown or feature_value in self.vocabulary:
             sample[feature_name] = feature_value
@@ -139,20 +168,22 @@ class BagOfTermsFeatureExtractor(object):
 
         return features, labels
 
-    def sentence_to_tokens(self, sentence, fes):
+    def sentence_to_tokens(self, sentence, fes, tagged=None):
         """ Transforms a sentence into a list of tokens. Appends the FE type
             to all tokens composing a certain FE and optionally group them into
             a single token.
 
             :param unicode sentence: Text of the sentence
             :param dict fes: mapping FE -> chunk
+            :param list tagged: POS tags of the sentence, tagged here if not given
             :return: List of tokens
         """
 
         if not sentence.strip():
             return []
 
-        tagged = self.tagger.tag_one(sentence, skip_unknown=False)
+        if tagged is None:
+            tagged = self.tagger.tag_one(sentence, skip_unknown=False)
         for fe, chunk in fes.iteritems():
             if chunk is None:
                 continue
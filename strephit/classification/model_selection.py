@@ -17,6 +17,7 @@ from sklearn.ensemble import RandomForestClassifier
 
 from strephit.classification.classifiers import FeatureSelectedClassifier
 from strephit.commons.classification import reverse_gazetteer
+from strephit.commons import codec, pos_tag
 from strephit.classification.feature_extractors import BagOfTermsFeatureExtractor, Word2VecFeatureExtractor
 
 logger = logging.getLogger(__name__)
@@ -106,7 +107,7 @@ def get_training_sets(training_set, language, gazetteer, word2vec_model, indepen
         if word2vec_model else []
     )
 
-    lus = set(json.loads(row)['lu'] for row in training_set) if independent_lus else ['$all']
+    lus = set(codec.loads(row)['lu'] for row in training_set) if independent_lus else ['$all']
 
     count = 0
     for gaz in list(gazetteer) + [None]:
@@ -121,11 +122,12 @@ def get_training_sets(training_set, language, gazetteer, word2vec_model, indepen
                 gazetteer = reverse_gazetteer(json.load(gazetteer)) if gaz else {}
 
                 training_set.seek(0)
-                for row in training_set:
-                    data = json.loads(row)
-                    if not independent_lus or data['lu'] in lus:
-                        extractor.process_sentence(data['sentence'], data['lu'], data['fes'],
-                                                   add_unknown=True, gazetteer=gazetteer)
+                rows = (codec.loads(row) for row in training_set)
+                extractor.process_sentences(
+                    ((data['sentence'], data['lu'], data['fes']) for data in rows
+                     if not independent_lus or data['lu'] in lus),
+                    add_unknown=True, gazetteer=gazetteer
+                )
 
                 meta = {
                     'lu': lu,
@@ -189,6 +191,7 @@ def main(training_set, language, gold_standard, gazetteer, n_folds, n_jobs,
     search = MultimodelGridSearchCV(*models, cv=n_folds, n_jobs=n_jobs,
                                     scoring=Scorer(scoring, True))
     (x_tr, y_tr, best_training_meta), best_score, best_params, best_model = search.fit(training_sets)
+    pos_tag.log_cache_stats()
 
     logger.info('Evaluation Results')
     logger.info('  Best model: %s', best_model.__class__.__name__)
@@ -211,10 +214,9 @@ def main(training_set, language, gold_standard, gazetteer, n_folds, n_jobs,
     gazetteer = best_training_meta['gazetteer']
 
     extractor.start()
-    for row in gold_standard:
-        data = json.loads(row)
-        extractor.process_sentence(data['sentence'], data['lu'], data['fes'],
-                                   add_unknown=False, gazetteer=gazetteer)
+    rows = (codec.loads(row) for row in gold_standard)
+    extractor.process_sentences(((data['sentence'], data['lu'], data['fes']) for data in rows),
+                                add_unknown=False, gazetteer=gazetteer)
     x_gold, y_gold = extractor.get_features(refit=False)
 
     dummy = DummyClassifier(strategy='stratified')
@@ -12,6 +12,7 @@ from sklearn.cross_validation import KFold
 import numpy as np
 
 from strephit.commons.classification import reverse_gazetteer
+from strephit.commons import codec, pos_tag
 from strephit.classification.model_selection import Scorer
 from strephit.classification.classifiers import FeatureSelectedClassifier
 from sklearn.preprocessing import MultiLabelBinarizer
@@ -75,20 +76,17 @@ def kfolds_evaluation(folds, model, scoring, skip_majority, x, y):
 def gold_evaluation(sentences, extractor, gazetteer, model_cls, model_args):
     logger.info('Evaluating on the gold sentences')
 
-    for each in sentences:
-        if not each.get('gold_fes'):
-            extractor.process_sentence(each['sentence'], each['lu'], each['fes'],
-                                       add_unknown=True, gazetteer=gazetteer)
+    extractor.process_sentences(((each['sentence'], each['lu'], each['fes'])
+                                 for each in sentences if not each.get('gold_fes')),
+                                add_unknown=True, gazetteer=gazetteer)
     x_tr, y_tr = extractor.get_features(refit=True)
 
     extractor.start()
-    tagged_gold = []
-    for each in sentences:
-        if each.get('gold_fes'):
-            tagged_gold.append((each['gold_fes'], extractor.process_sentence(
-                each['sentence'], each['lu'], each['fes'],
-                add_unknown=False, gazetteer=gazetteer
-            )))
+    gold = [each for each in sentences if each.get('gold_fes')]
+    tagged_gold = zip([each['gold_fes'] for each in gold], extractor.process_sentences(
+        ((each['sentence'], each['lu'], each['fes']) for each in gold),
+        add_unknown=False, gazetteer=gazetteer
+    ))
 
     if not tagged_gold:
         logger.warn('asked to evaluate gold, but no gold sentences found')
@@ -153,12 +151,12 @@ def main(training_set, language, outfile, model_class, model_param, extractor_cl
     extractor = initialize(extractor_class, [('language', language)] + list(extractor_param), True)
 
     logger.info("Building training set from '%s' ..." % training_set.name)
-    for row in training_set:
-        data = json.loads(row)
-        extractor.process_sentence(data['sentence'], data['lu'], data['fes'],
-                                   add_unknown=True, gazetteer=gazetteer)
+    rows = (codec.loads(row) for row in training_set)
+    extractor.process_sentences(((data['sentence'], data['lu'], data['fes']) for data in rows),
+                                add_unknown=True, gazetteer=gazetteer)
     x, y = extractor.get_features(refit=True)
     logger.info('Got %d samples with %d features each', *x.shape)
+    pos_tag.log_cache_stats()
 
     model = FeatureSelectedClassifier(model_cls, extractor.lu_column(), model_args)
 
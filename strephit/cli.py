@@ -18,6 +18,7 @@ CLI_COMMANDS = {
     'rule_based': strephit.rule_based.cli.cli,
 }
 
+logger = logging.getLogger(__name__)
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 
@@ -25,10 +26,74 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 @click.pass_context
 @click.option('--log-level', type=(unicode, click.Choice(commons.logging.LEVELS)), multiple=True)
 @click.option('--cache-dir', type=click.Path(file_okay=False, resolve_path=True), default=None)
-def cli(ctxm, log_level, cache_dir):
+@click.option('--cache-backend', type=click.Choice(commons.cache.BACKENDS.keys()), default=None)
+@click.option('--cache-memory-entries', type=int, default=None,
+              help='Maximum number of items kept in memory by each process, 0 to disable')
+@click.option('--cache-memory-bytes', type=int, default=None,
+              help='Approximate maximum size of the items kept in memory by each process')
+@click.option('--cache-ttl', type=(unicode, int), multiple=True,
+              help='Default time to live in seconds of the items in a cache namespace')
+@click.option('--cache-negative-ttl', type=int, default=None,
+              help='Time to live in seconds of lookups which found nothing')
+@click.option('--retries', type=int, default=None,
+              help='How many times to try again parallel tasks whose worker dies')
+@click.option('--dead-letter', type=click.Path(dir_okay=False, resolve_path=True), default=None,
+              help='Append parallel tasks which raise or keep killing their worker to this JSONL file')
+@click.option('--json-backend', type=click.Choice(commons.codec.BACKENDS.keys()), default=None,
+              help='Library used to encode and decode JSON items, defaults to the fastest available')
+@click.option('--wikidata-index', type=click.Path(exists=True, dir_okay=False),
+              help='Search Wikidata in this local index instead of using the APIs')
+@click.option('--http-retries', type=int, default=None,
+              help='How many times to try again HTTP requests which fail or are throttled')
+@click.option('--http-concurrency', type=int, default=None,
+              help='Maximum concurrent HTTP requests to the same host, for each process')
+@click.option('--pos-tag-cache', is_flag=True,
+              help='Cache the POS tags of each sentence, best with --cache-backend sqlite')
+def cli(ctxm, log_level, cache_dir, cache_backend, cache_memory_entries, cache_memory_bytes,
+        cache_ttl, cache_negative_ttl, retries, dead_letter, json_backend, wikidata_index,
+        http_retries, http_concurrency, pos_tag_cache):
     commons.logging.setup()
     for module, level in log_level:
         commons.logging.setLogLevel(module, level)
 
     if cache_dir:
         commons.cache.BASE_DIR = cache_dir
+
+    if cache_backend:
+        commons.cache.BACKEND = cache_backend
+
+    if cache_memory_entries is not None:
+        commons.cache.memory.max_entries = cache_memory_entries
+
+    if cache_memory_bytes is not None:
+        commons.cache.memory.max_bytes = cache_memory_bytes
+
+    for namespace, ttl in cache_ttl:
+        commons.cache.TTL[namespace] = ttl
+
+    if cache_negative_ttl is not None:
+        commons.cache.NEGATIVE_TTL = cache_negative_ttl
+
+    if retries is not None:
+        commons.parallel.RETRIES = retries
+
+    if dead_letter:
+        commons.parallel.DEAD_LETTER = dead_letter
+
+    if json_backend:
+        commons.codec.set_backend(json_backend)
+
+    if wikidata_index:
+        commons.wikidata.INDEX = wikidata_index
+
+    if http_retries is not None:
+        commons.web.RETRIES = http_retries
+
+    if http_concurrency is not None:
+        commons.web.CONCURRENCY = http_concurrency
+
+    if pos_tag_cache:
+        commons.pos_tag.CACHE = True
+        if commons.cache.BACKEND == 'files':
+            logger.warn('caching the POS tags with the files backend stores a file for each sentence, '
+                        'consider --cache-backend sqlite')
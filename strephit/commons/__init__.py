@@ -6,6 +6,8 @@ import cache
 import wikidata
 import datetime
 import parallel
+import codec
+import web
 import text
 import entity_linking
 import secrets
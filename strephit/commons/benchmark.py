@@ -0,0 +1,334 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+import bz2
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import click
+
+from strephit.commons import cache, codec, io, wikidata
+
+logger = logging.getLogger(__name__)
+
+
+def _resolver_calls(items):
+    """ Replays the calls to :func:`wikidata.resolve` made by the serializer
+        of semi-structured data, without resolving anything. Statements
+        resolved along the way are not known, so the additional info only
+        contains the scraped data
+
+        :param items: Scraped items
+        :return: tuples (property, value, additional info)
+        :rtype: generator
+    """
+    for item in items:
+        item.pop('name', None)
+        item.pop('url', None)
+        other = item.pop('other', {})
+
+        data = {}
+        try:
+            data = json.loads(other)
+        except (ValueError, TypeError):
+            if isinstance(other, dict):
+                data = other
+
+        data.update(item)
+        data.pop('bio', None)
+
+        for key, value in data.iteritems():
+            property = wikidata.PROPERTY_TO_WIKIDATA.get(key)
+            if not property:
+                continue
+
+            for val in value if isinstance(value, list) else [value]:
+                if val and isinstance(val, basestring):
+                    yield property, val, data
+
+
+def _legacy_key(function, args, kwargs):
+    return str([function.__module__]) + function.__name__ + str(args) + str(kwargs)
+
+
+def _canonical_key(function, args, kwargs):
+    return cache.make_key(function, args, kwargs, ignored=('kwargs',))
+
+
+def _legacy_load_scraped_items(location):
+    """ The corpus reader before compressed shards were supported, which
+        iterates over the lines of uncompressed jsonlines files
+    """
+    for name in os.listdir(location):
+        if name.endswith('.jsonl') or name.endswith('.jsonlines'):
+            with open(os.path.join(location, name)) as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def _write_shards(lines, directory, shards, compression):
+    """ Splits the lines in shards, compressing them with the given extension """
+    for i in xrange(shards):
+        path = os.path.join(directory, 'items-%03d.jsonl%s' % (i, compression or ''))
+        content = ''.join(lines[i::shards])
+        if compression == '.gz':
+            with gzip.open(path, 'wb') as f:
+                f.write(content)
+        elif compression == '.bz2':
+            with open(path, 'wb') as f:
+                f.write(bz2.compress(content))
+        elif compression == '.zst':
+            import zstandard
+            with open(path, 'wb') as f:
+                f.write(zstandard.ZstdCompressor().compress(content))
+        else:
+            with open(path, 'wb') as f:
+                f.write(content)
+
+
+@click.group()
+def main():
+    """ Benchmarks of the common utilities
+    """
+    pass
+
+
+@main.command()
+@click.argument('corpus', type=click.Path(exists=True), default='samples/corpus.jsonlines')
+@click.option('--language', default='en')
+def cache_keys(corpus, language):
+    """ Compares the hit rate and the cost of legacy and canonical cache keys
+        when resolving the values of a semi-structured corpus
+    """
+    def resolver(property, value, language, **kwargs):
+        pass
+
+    calls = list(_resolver_calls(io.load_scraped_items(corpus)))
+    logger.info('Replaying %d resolver calls', len(calls))
+
+    for name, key_for in [('legacy', _legacy_key), ('canonical', _canonical_key)]:
+        seen = set()
+        hits = size = 0
+        start = time.time()
+        for property, value, info in calls:
+            key = key_for(resolver, (property, value, language), info)
+            hits += key in seen
+            size += len(key)
+            seen.add(key)
+        elapsed = time.time() - start
+
+        click.echo('%s keys: %d hits out of %d calls (%.1f%%) at %.1f us per call, %d distinct keys, '
+                   '%.1f characters per key on average, %.2f ms to compute them' % (
+                       name, hits, len(calls), 100.0 * hits / max(len(calls), 1),
+                       1e6 * elapsed / max(len(calls), 1), len(seen),
+                       float(size) / max(len(calls), 1), 1000 * elapsed))
+
+
+@main.command()
+@click.argument('corpus', type=click.Path(exists=True), default='samples/corpus.jsonlines')
+@click.option('--shards', default=8, help='Split the corpus in these many files')
+@click.option('--repeat', default=20, help='Repeat the corpus these many times')
+@click.option('--processes', '-p', default=0)
+def corpus_reader(corpus, shards, repeat, processes):
+    """ Measures the throughput, in lines per second, of the corpus readers
+        on the same corpus split in shards, uncompressed and compressed
+    """
+    with open(corpus) as f:
+        lines = [line if line.endswith('\n') else line + '\n' for line in f] * repeat
+
+    compressions = [None, '.gz', '.bz2']
+    try:
+        import zstandard
+        compressions.append('.zst')
+    except ImportError:
+        logger.warn('Cannot import zstandard, skipping .zst shards')
+
+    directory = tempfile.mkdtemp()
+    try:
+        for compression in compressions:
+            location = os.path.join(directory, compression or 'plain')
+            os.mkdir(location)
+            _write_shards(lines, location, shards, compression)
+
+            readers = [
+                ('sequential', io.load_scraped_items),
+                ('parallel', lambda location: io.load_scraped_shards(location, processes)),
+            ]
+            if compression is None:
+                readers.insert(0, ('legacy', _legacy_load_scraped_items))
+
+            for name, reader in readers:
+                start = time.time()
+                count = sum(1 for _ in reader(location))
+                elapsed = time.time() - start
+                click.echo('%s reader, %s shards: %d lines in %.2f s, %.0f lines/sec' % (
+                    name, compression or 'uncompressed', count, elapsed,
+                    count / max(elapsed, 1e-6)))
+    finally:
+        shutil.rmtree(directory)
+
+
+@main.command()
+@click.argument('corpus', type=click.Path(exists=True), default='samples/corpus.jsonlines')
+@click.option('--repeat', default=100, help='Encode and decode the corpus these many times')
+def json_codec(corpus, repeat):
+    """ Compares the speed of the available JSON backends when decoding
+        and encoding the items of a corpus
+    """
+    with open(corpus) as f:
+        lines = [line for line in f if line.strip()]
+    items = map(json.loads, lines)
+
+    current = codec.BACKEND
+    try:
+        for backend in codec.PREFERENCE:
+            try:
+                codec.set_backend(backend)
+            except ImportError:
+                click.echo('%s: not installed' % backend)
+                continue
+
+            start = time.time()
+            for _ in xrange(repeat):
+                for line in lines:
+                    codec.loads(line)
+            decoding = time.time() - start
+
+            start = time.time()
+            for _ in xrange(repeat):
+                for item in items:
+                    codec.dumps(item)
+            encoding = time.time() - start
+
+            count = repeat * len(lines)
+            click.echo('%s: decoded %.0f lines/sec, encoded %.0f items/sec' % (
+                backend, count / max(decoding, 1e-6), count / max(encoding, 1e-6)))
+    finally:
+        codec.set_backend(current)
+
+
+def _legacy_score(entity, kwargs):
+    """ How :func:`wikidata.resolver_with_hints` scored the candidates before
+        the hints were prepared in advance
+    """
+    def date_matches(their_dates, our_dates):
+        matches = 0
+        for theirs, ours in itertools.product(their_dates, our_dates):
+            val = theirs['mainsnak']['datavalue']['value']
+            their_date = wikidata.parse_date(val['time'], val['precision'])
+            our_date = wikidata.parse_date(ours)
+            matches += all(
+                their_date[k] == our_date[k]
+                for k in {'year', 'month', 'day'}
+                if their_date.get(k) and our_date.get(k)
+            )
+        return matches
+
+    matches = 0
+    known_properties = set(wikidata.PROPERTY_TO_WIKIDATA.values()) | set(kwargs)
+    for property, claim in entity['claims'].iteritems():
+        try:
+            if property == 'P569':
+                if 'P569' in kwargs:
+                    matches += date_matches(claim, kwargs['P569'])
+            elif property == 'P570':
+                if 'P570' in kwargs:
+                    matches += date_matches(claim, kwargs['P570'])
+            elif property in known_properties:
+                entity_val = set(filter(None, ('Q%d' % v['mainsnak']['datavalue']['value']['numeric-id']
+                                               for v in claim)))
+                our_val = set(filter(None, kwargs.get(property, [])))
+                weight = 0.5 if property == 'P21' else 1
+                matches += len(our_val.intersection(entity_val)) * weight
+        except (KeyError, TypeError):
+            continue
+    return matches
+
+
+def _candidates(hints, count, claims, rnd):
+    """ Generates candidates with many claims, some of which match the hints """
+    def date_claim(date):
+        time_, precision = date.split('/')
+        return {'mainsnak': {'datavalue': {'value': {'time': time_, 'precision': int(precision)}}}}
+
+    def entity_claim(qid):
+        return {'mainsnak': {'datavalue': {'value': {'numeric-id': int(qid[1:])}}}}
+
+    candidates = []
+    for i in xrange(count):
+        entity = {'id': 'Q%d' % i, 'claims': {}}
+        for _ in xrange(claims):
+            property = 'P%d' % rnd.randint(1, 2000)
+            entity['claims'][property] = [entity_claim('Q%d' % rnd.randint(1, 100))
+                                          for _ in xrange(rnd.randint(1, 3))]
+
+        for property, values in hints.iteritems():
+            if property in {'P569', 'P570'}:
+                dates = [wikidata.format_date(rnd.randint(1800, 2000), rnd.randint(1, 12), rnd.randint(1, 28))
+                         for _ in xrange(rnd.randint(1, 3))]
+                if rnd.random() < 0.3:
+                    dates.append(rnd.choice(values))
+                entity['claims'][property] = map(date_claim, dates)
+            elif property.startswith('P') and rnd.random() < 0.5:
+                entity['claims'][property] = map(entity_claim, rnd.sample(values, 1) + ['Q%d' % rnd.randint(1, 100)])
+        candidates.append(entity)
+    return candidates
+
+
+@main.command()
+@click.argument('corpus', type=click.Path(exists=True), default='samples/corpus.jsonlines')
+@click.option('--candidates', default=15, help='Candidates for each name')
+@click.option('--claims', default=100, help='Claims of each candidate')
+@click.option('--repeat', default=20, help='Score the candidates these many times')
+def hints_scoring(corpus, candidates, claims, repeat):
+    """ Compares the legacy and the current scoring of the candidates of
+        :func:`wikidata.resolver_with_hints`, using the dates found in the
+        corpus as hints and synthetic candidates
+    """
+    rnd = random.Random(42)
+    enabled, cache.ENABLED = cache.ENABLED, False
+    try:
+        dates = [wikidata.date_resolver(property, value, 'en')
+                 for property, value, _ in _resolver_calls(io.load_scraped_items(corpus))
+                 if property in {'P569', 'P570'}]
+    finally:
+        cache.ENABLED = enabled
+
+    dates = filter(None, dates)
+    if len(dates) < 2:
+        raise click.UsageError('not enough dates in the corpus')
+
+    lookups = []
+    for _ in xrange(50):
+        hints = {'P569': rnd.sample(dates, 2), 'P570': rnd.sample(dates, 1), 'P21': ['Q6581097'],
+                 'P27': ['Q30', 'Q145'], 'P106': ['Q%d' % rnd.randint(1, 100) for _ in xrange(3)],
+                 'Born': 'some date', 'name': 'some name'}
+        lookups.append((hints, _candidates(hints, candidates, claims, rnd)))
+
+    def legacy(hints, entities):
+        best = None
+        for entity in entities:
+            matches = _legacy_score(entity, hints)
+            if best is None or matches > best[0]:
+                best = matches, entity
+        return best[1]['id'] if best[0] >= 1 else ''
+
+    def current(hints, entities):
+        return wikidata.Hints(hints).best_match(entities)
+
+    results = {}
+    for name, function in [('legacy', legacy), ('current', current)]:
+        start = time.time()
+        for _ in xrange(repeat):
+            results[name] = [function(hints, entities) for hints, entities in lookups]
+        elapsed = time.time() - start
+        click.echo('%s: %.3f ms per lookup of %d candidates' % (
+            name, 1000 * elapsed / (repeat * len(lookups)), candidates))
+
+    click.echo('same results: %s' % (results['legacy'] == results['current']))
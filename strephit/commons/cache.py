@@ -1,35 +1,443 @@
+from __future__ import absolute_import
 import tempfile
 import os
+import errno
 import hashlib
+import inspect
 import json
+import logging
+import shutil
+import sqlite3
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from json.encoder import encode_basestring_ascii as _encode_string
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import click
+
+
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.join(tempfile.gettempdir(), 'strephit-cache')
 ENABLED = True
+BACKEND = 'files'
+
+# default time to live in seconds of the items of each namespace
+TTL = {}
+
+# time to live in seconds of negative results, i.e. lookups which found nothing
+NEGATIVE_TTL = 24 * 3600
+
+# lookups which miss the cache are performed by one process at a time for each
+# key, the others wait for the result instead of performing them again. Waiting
+# stops after LOCK_TIMEOUT seconds, in case the lookup hangs
+SINGLE_FLIGHT = True
+LOCK_TIMEOUT = 300
+
+# the builtin is shadowed by the `set` function below
+_SET_TYPES = (set, frozenset)
 
 
 def _hash_for(key):
     return hashlib.sha1(key.encode('utf8')).hexdigest()
 
 
-def _path_for(hashed_key):
+def _is_expired(expires):
+    return expires is not None and expires < time.time()
+
+
+def _path_for(hashed_key, base_dir=None):
     """ Computes the path in which the given key should be stored.
 
+        :param base_dir: Root of the cache, defaults to `BASE_DIR`
         :return: tuple (full path, base path, file name)
         :rtype: tuple
     """
-    loc = os.path.join(BASE_DIR, hashed_key[:3])
+    loc = os.path.join(base_dir or BASE_DIR, hashed_key[:3])
     return os.path.join(loc, hashed_key), loc, hashed_key
 
 
-def get(key, default=None):
+class FileSystemBackend(object):
+    """ Stores every item in its own file inside `base_dir`. Files are grouped
+        in sub-directories named after the first three characters of the hashed key,
+        and items of a namespace other than the default one are kept in a separate
+        directory. Collisions are handled by re-hashing the key.
+
+        Each file contains the key in the first line, the JSON-encoded value in
+        the second one and, optionally, the expiration timestamp in the third one.
+    """
+
+    namespace_prefix = 'ns-'
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def _namespace_dir(self, namespace):
+        return os.path.join(self.base_dir, self.namespace_prefix + namespace.replace(os.sep, '_'))
+
+    def _locate(self, hashed, namespace):
+        if not namespace:
+            return _path_for(hashed, self.base_dir)
+
+        loc = os.path.join(self._namespace_dir(namespace), hashed[:3])
+        return os.path.join(loc, hashed), loc, hashed
+
+    @staticmethod
+    def _parse(content):
+        value, _, expires = content.partition('\n')
+        return value, float(expires) if expires else None
+
+    @staticmethod
+    def _format(value, expires):
+        return value + ('\n%f' % expires if expires is not None else '')
+
+    def get(self, key, namespace=None):
+        hashed = _hash_for(key)
+        loc, _, _ = self._locate(hashed, namespace)
+        if os.path.exists(loc):
+            with open(loc) as f:
+                stored_key = f.readline().decode('utf8')[:-1]
+                if stored_key == key:
+                    value, expires = self._parse(f.read().decode('utf8'))
+                    return (value, expires) if not _is_expired(expires) else None
+                else:
+                    return self.get(key + hashed, namespace)
+        else:
+            return None
+
+    def set(self, key, value, overwrite=True, namespace=None, expires=None):
+        hashed = _hash_for(key)
+        loc, path, fname = self._locate(hashed, namespace)
+        if not os.path.exists(loc):
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+
+            with open(loc, 'w') as f:
+                f.write(key.encode('utf8') + '\n')
+                f.write(self._format(value, expires).encode('utf8'))
+        else:
+            with open(loc, 'r+') as f:
+                stored_key = f.readline().decode('utf8')[:-1]
+                if stored_key == key:
+                    position = f.tell()
+                    _, stored_expires = self._parse(f.read().decode('utf8'))
+                    if overwrite or _is_expired(stored_expires):
+                        f.seek(position)
+                        f.write(self._format(value, expires).encode('utf8'))
+                        f.truncate()
+                    return
+            self.set(key + hashed, value, overwrite, namespace, expires)
+
+    def _directories(self):
+        """ Finds the directories containing the items of each namespace
+
+            :return: tuples (namespace, list of directories)
+            :rtype: generator
+        """
+        if not os.path.isdir(self.base_dir):
+            return
+
+        default = []
+        for name in sorted(os.listdir(self.base_dir)):
+            path = os.path.join(self.base_dir, name)
+            if not os.path.isdir(path):
+                continue
+            elif name.startswith(self.namespace_prefix):
+                yield name[len(self.namespace_prefix):], [
+                    os.path.join(path, prefix) for prefix in sorted(os.listdir(path))
+                ]
+            elif len(name) == 3:
+                default.append(path)
+
+        if default:
+            yield '', default
+
+    def _files(self):
+        for namespace, directories in self._directories():
+            for path in directories:
+                for fname in os.listdir(path):
+                    yield namespace, os.path.join(path, fname)
+
+    def items(self):
+        """ Iterates over all the items stored in the cache rooted at `base_dir`
+
+            :return: tuples (namespace, key, JSON-encoded value, expiration timestamp)
+            :rtype: generator
+        """
+        for namespace, fname in self._files():
+            with open(fname) as f:
+                key = f.readline().decode('utf8')[:-1]
+                value, expires = self._parse(f.read().decode('utf8'))
+
+            # undo the re-hashing done to handle collisions
+            while len(key) > 40 and _hash_for(key[:-40]) == key[-40:]:
+                key = key[:-40]
+
+            yield namespace, key, value, expires
+
+    def purge(self, namespace):
+        """ Removes all the items in the given namespace """
+        if namespace:
+            shutil.rmtree(self._namespace_dir(namespace), ignore_errors=True)
+        else:
+            for ns, directories in self._directories():
+                if not ns:
+                    for path in directories:
+                        shutil.rmtree(path, ignore_errors=True)
+
+    def purge_expired(self):
+        """ Removes all the expired items
+
+            :return: how many items were removed
+            :rtype: int
+        """
+        count = 0
+        for _, fname in self._files():
+            with open(fname) as f:
+                f.readline()
+                _, expires = self._parse(f.read().decode('utf8'))
+
+            if _is_expired(expires):
+                os.remove(fname)
+                count += 1
+        return count
+
+    def sizes(self):
+        """ Computes how many items there are in each namespace and how much
+            space they take
+
+            :return: dictionary namespace -> (number of items, size in bytes)
+            :rtype: dict
+        """
+        sizes = {}
+        for namespace, fname in self._files():
+            count, size = sizes.get(namespace, (0, 0))
+            sizes[namespace] = count + 1, size + os.path.getsize(fname)
+        return sizes
+
+
+class SQLiteBackend(object):
+    """ Stores all the items in a single SQLite database inside `base_dir`.
+        Keys are indexed by the database itself, so lookups do not touch
+        the file system besides the database file.
+    """
+
+    file_name = 'strephit-cache.sqlite'
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, self.file_name)
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # sqlite connections cannot be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            if not os.path.exists(self.base_dir):
+                try:
+                    os.makedirs(self.base_dir)
+                except OSError:
+                    pass
+
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                                     'namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                                     'value TEXT, expires REAL, '
+                                     'PRIMARY KEY (namespace, key))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS cache_expires '
+                                     'ON cache (expires)')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _to_unicode(key):
+        return key.decode('utf8') if isinstance(key, str) else key
+
+    def get(self, key, namespace=None):
+        row = self.connection.execute(
+            'SELECT value, expires FROM cache WHERE namespace = ? AND key = ?',
+            (namespace or '', self._to_unicode(key))
+        ).fetchone()
+
+        if row is None or _is_expired(row[1]):
+            return None
+        return row
+
+    def set(self, key, value, overwrite=True, namespace=None, expires=None):
+        params = namespace or '', self._to_unicode(key)
+        with self.connection:
+            if overwrite:
+                query = 'INSERT OR REPLACE'
+            else:
+                query = 'INSERT OR IGNORE'
+                self.connection.execute('DELETE FROM cache WHERE namespace = ? AND key = ? '
+                                        'AND expires < ?', params + (time.time(),))
+
+            self.connection.execute(query + ' INTO cache (namespace, key, value, expires) '
+                                    'VALUES (?, ?, ?, ?)', params + (value, expires))
+
+    def items(self):
+        for each in self.connection.execute('SELECT namespace, key, value, expires FROM cache'):
+            yield each
+
+    def purge(self, namespace):
+        with self.connection:
+            self.connection.execute('DELETE FROM cache WHERE namespace = ?', (namespace or '',))
+
+    def purge_expired(self):
+        with self.connection:
+            cursor = self.connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        return cursor.rowcount
+
+    def sizes(self):
+        return {
+            namespace: (count, size) for namespace, count, size in self.connection.execute(
+                'SELECT namespace, COUNT(*), SUM(LENGTH(key) + LENGTH(value)) '
+                'FROM cache GROUP BY namespace'
+            )
+        }
+
+
+class MemoryCache(object):
+    """ Least-recently-used cache kept in the memory of the current process,
+        bounded both in number of entries and in (approximate) size in bytes.
+        Immutable values are kept decoded, so that repeated hits do not
+        need to parse JSON over and over, while mutable values are kept
+        encoded and parsed at every hit, so that callers cannot alter them
+    """
+
+    _immutable = (basestring, int, long, float, bool, type(None))
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None or _is_expired(entry[3]):
+            if entry is not None:
+                self.size -= entry[2]
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries[key] = entry
+        value, encoded, _, _ = entry
+        return json.loads(value) if encoded else value
+
+    def set(self, key, value, encoded_value, expires=None):
+        self.discard(key)
+
+        size = len(key) + len(encoded_value)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+
+        if isinstance(value, self._immutable):
+            self.entries[key] = value, False, size, expires
+        else:
+            self.entries[key] = encoded_value, True, size, expires
+        self.size += size
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, _, evicted, _) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """ Returns the number of entries, their approximate size in bytes
+            and the number of hits and misses so far
+        """
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+BACKENDS = {
+    'files': FileSystemBackend,
+    'sqlite': SQLiteBackend,
+}
+
+_backend = None
+
+# in-process tier in front of the backend, it is not shared between processes
+memory = MemoryCache(max_entries=10000, max_bytes=32 * 1024 * 1024)
+
+# value stored in place of negative results, distinct from anything a function could return
+_NEGATIVE_VALUE = {'__strephit_cache__': 'negative'}
+
+# returned by `get` for negative results, when asked to
+NEGATIVE = object()
+
+# how many lookups were served a negative result by this process, per namespace
+negative_hits = Counter()
+
+
+def get_backend():
+    """ Returns the storage backend currently in use, according to
+        `BACKEND` and `BASE_DIR`
+    """
+    global _backend
+    if _backend is None or _backend.base_dir != BASE_DIR or \
+            not isinstance(_backend, BACKENDS[BACKEND]):
+        _backend = BACKENDS[BACKEND](BASE_DIR)
+        memory.clear()
+    return _backend
+
+
+def _memory_key(key, namespace):
+    if not namespace:
+        return key
+    elif isinstance(key, str):
+        key = key.decode('utf8')
+    return namespace + u'\x00' + key
+
+
+def _expiration(namespace, ttl):
+    if ttl is None:
+        ttl = TTL.get(namespace)
+    return time.time() + ttl if ttl is not None else None
+
+
+def get(key, default=None, namespace=None, negative=None):
     """ Retrieves an item from the cache
 
         :param key: Key of the item
         :param default: Default value to return if the
          key is not in the cache
+        :param namespace: Namespace of the item, if any
+        :param negative: Value to return if the key is known to have
+         no value, see :func:`set_negative`. Defaults to `default`,
+         use `NEGATIVE` to tell negative results apart from misses
         :return: The item associated with the given key or
-         the default value
+         the default value. Expired items are treated as missing
 
         Sample usage:
 
@@ -45,27 +453,38 @@ def get(key, default=None):
     if not ENABLED:
         return default
 
-    hashed = _hash_for(key)
-    loc, _, _ = _path_for(hashed)
-    if os.path.exists(loc):
-        with open(loc) as f:
-            stored_key = f.readline().decode('utf8')[:-1]
-            if stored_key == key:
-                return json.loads(f.read().decode('utf8'))
-            else:
-                return get(key + hashed, default)
-    else:
-        return default
+    backend = get_backend()
+    memory_key = _memory_key(key, namespace)
+    value = memory.get(memory_key, memory)
+    if value is memory:
+        stored = backend.get(key, namespace)
+        if stored is None:
+            return default
 
+        encoded, expires = stored
+        value = json.loads(encoded)
+        memory.set(memory_key, value, encoded, expires)
 
-def set(key, value, overwrite=True):
+    if value == _NEGATIVE_VALUE:
+        negative_hits[namespace or ''] += 1
+        return default if negative is None else negative
+    return value
+
+
+def set(key, value, overwrite=True, namespace=None, ttl=None):
     """ Stores an item in the cache under the given key
 
         :param key: Unique key used to identify the idem.
         :param value: Value to store in the cache. Must be
          JSON-dumpable
         :param overwrite: Whether to overwrite the previous
-         value associated with the key (if any)
+         value associated with the key (if any). Expired values
+         are always overwritten
+        :param namespace: Namespace of the item, if any. Namespaces
+         can be purged as a whole and have their own default time to live
+        :param ttl: Time to live of the item, in seconds. If not given
+         the default for the namespace is used, from `TTL`. Items
+         without a time to live never expire
         :return: Nothing
 
         Sample usage:
@@ -82,31 +501,326 @@ def set(key, value, overwrite=True):
     if not ENABLED:
         return
 
-    hashed = _hash_for(key)
-    loc, path, fname = _path_for(hashed)
-    if not os.path.exists(loc):
-        if not os.path.exists(path):
-            try:
-                os.makedirs(path)
-            except OSError:
-                pass
+    backend = get_backend()
+    encoded = json.dumps(value)
+    expires = _expiration(namespace, ttl)
+    backend.set(key, encoded, overwrite, namespace, expires)
 
-        with open(loc, 'w') as f:
-            f.write(key.encode('utf8') + '\n')
-            f.write(json.dumps(value).encode('utf8'))
+    memory_key = _memory_key(key, namespace)
+    if overwrite:
+        memory.set(memory_key, value, encoded, expires)
     else:
-        with open(loc, 'r+') as f:
-            stored_key = f.readline().decode('utf8')[:-1]
-            if stored_key == key:
-                if overwrite:
-                    f.write(json.dumps(value).encode('utf8'))
-                    f.truncate()
-                return
-        set(key + hashed, value, overwrite)
+        memory.discard(memory_key)
+
+
+def _canonical(value):
+    """ Converts a value to an equivalent one whose JSON representation does
+        not depend on dictionary ordering, set ordering or the distinction
+        between byte and unicode strings
+    """
+    if isinstance(value, str):
+        try:
+            value = value.decode('utf8')
+        except UnicodeDecodeError:
+            value = value.decode('latin1')
+
+    if isinstance(value, unicode):
+        return unicodedata.normalize('NFC', value)
+    elif isinstance(value, dict):
+        canonical = {}
+        for key, val in value.iteritems():
+            key = _canonical(key)
+            if not isinstance(key, unicode):
+                key = _dumps(key)
+            canonical[key] = _canonical(val)
+        return canonical
+    elif isinstance(value, _SET_TYPES):
+        return sorted(_canonical(each) for each in value)
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(each) for each in value]
+    else:
+        return value
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=repr)
+
+
+def _encode(value):
+    """ Same as `_dumps(_canonical(value))`, in a single pass. The json module
+        uses its slow, pure Python encoder when sorting the keys
+    """
+    if isinstance(value, basestring):
+        return _encode_string(_canonical(value))
+    elif value is None:
+        return 'null'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, float):
+        return json.dumps(value)
+    elif isinstance(value, dict):
+        encoded = {}
+        for key, val in value.iteritems():
+            key = _canonical(key) if isinstance(key, basestring) else _encode(key).decode('utf8')
+            encoded[key] = _encode(val)
+        return '{%s}' % ','.join(_encode_string(key) + ':' + encoded[key]
+                                 for key in sorted(encoded))
+    elif isinstance(value, _SET_TYPES):
+        return _dumps(_canonical(value))
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_encode(each) for each in value)
+    else:
+        return _encode_string(repr(value))
+
 
+# signature of the functions given to :func:`make_key`, see :func:`_call_arguments`
+_signatures = weakref.WeakKeyDictionary()
 
-def cached(function):
-    """ Decorator to cache function results based on its arguments
+
+def _call_arguments(function, args, kwargs):
+    """ Same as `inspect.getcallargs`, without inspecting the function at every
+        call. Unusual calls, including invalid ones, are left to `inspect.getcallargs`
+    """
+    signature = _signatures.get(function)
+    if signature is None:
+        names, varargs, varkw, defaults = inspect.getargspec(function)
+        # tuple parameters are unpacked by inspect
+        simple = all(isinstance(name, basestring) for name in names)
+        defaults = zip(names[-len(defaults):], defaults) if defaults else []
+        signature = _signatures[function] = (names, frozenset(names) if simple else None,
+                                             varargs, varkw, defaults, simple)
+
+    names, known, varargs, varkw, defaults, simple = signature
+    if not simple or len(args) > len(names) and varargs is None:
+        return inspect.getcallargs(function, *args, **kwargs)
+
+    arguments, extra = dict(zip(names, args)), {}
+    for name, value in kwargs.iteritems():
+        if name in arguments or name not in known and varkw is None:
+            return inspect.getcallargs(function, *args, **kwargs)
+        elif name in known:
+            arguments[name] = value
+        else:
+            extra[name] = value
+
+    for name, value in defaults:
+        arguments.setdefault(name, value)
+    if len(arguments) < len(names):
+        return inspect.getcallargs(function, *args, **kwargs)
+
+    if varargs is not None:
+        arguments[varargs] = args[len(names):]
+    if varkw is not None:
+        arguments[varkw] = extra
+    return arguments
+
+
+def _hash_argument(value):
+    """ SHA1 of an argument, without canonicalizing it unless needed """
+    try:
+        encoded = _dumps(value)
+    except UnicodeDecodeError:
+        encoded = _dumps(_canonical(value))
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def make_key(function, args, kwargs, ignored=(), hashed=()):
+    """ Computes the cache key of a function call. Arguments are matched
+        to the function signature, so that passing a value positionally
+        or by name makes no difference, and canonicalized
+
+        :param function: The function being called
+        :param args: Positional arguments of the call
+        :param kwargs: Keyword arguments of the call
+        :param ignored: Names of the arguments which are not part of the key
+        :param hashed: Names of the arguments which are replaced by their
+         SHA1 in the key, useful to keep keys short with big arguments.
+         They are hashed as they are, without the canonicalization of the others
+        :return: The key, unicode
+        :rtype: unicode
+
+        Sample usage:
+
+        >>> from strephit.commons import cache
+        >>> def f(x, y, **kwargs):
+        ...     pass
+        ...
+        >>> cache.make_key(f, (1,), {'y': 'b', 'z': 'c'})
+        u'f{"kwargs":{"z":"c"},"x":1,"y":"b"}'
+        >>> cache.make_key(f, (1, u'b'), {'z': 'c'}, ignored=('kwargs',))
+        u'f{"x":1,"y":"b"}'
+    """
+    arguments = _call_arguments(function, args, kwargs)
+
+    for name in ignored:
+        arguments.pop(name, None)
+
+    for name in hashed:
+        if name in arguments:
+            arguments[name] = _hash_argument(arguments[name])
+
+    return function.__name__.decode('utf8') + _encode(arguments)
+
+
+def set_negative(key, namespace=None, ttl=None):
+    """ Remembers that the given key has no value, for example because the
+        resource it refers to does not exist. Negative results expire
+        sooner than regular ones, after `NEGATIVE_TTL` seconds by default
+
+        :param key: Key of the item
+        :param namespace: Namespace of the item, if any
+        :param ttl: Time to live of the negative result, in seconds
+        :return: Nothing
+
+        Sample usage:
+
+        >>> from strephit.commons import cache
+        >>> cache.set_negative('nn')
+        >>> cache.get('nn', 13)
+        13
+        >>> cache.get('nn', negative=cache.NEGATIVE) is cache.NEGATIVE
+        True
+    """
+    set(key, _NEGATIVE_VALUE, namespace=namespace,
+        ttl=NEGATIVE_TTL if ttl is None else ttl)
+
+
+def log_stats():
+    """ Logs statistics about the lookups performed by the current process
+    """
+    stats = memory.stats()
+    logger.info('In-memory cache: %d entries, %d bytes, %d hits, %d misses',
+                stats['entries'], stats['bytes'], stats['hits'], stats['misses'])
+    for namespace, count in negative_hits.most_common():
+        logger.info('%d lookups served a negative result from namespace %s',
+                    count, namespace or '(default)')
+
+
+_held = threading.local()
+
+
+@contextmanager
+def lock(key, namespace=None):
+    """ Context manager to perform the lookup of a key missing from the cache
+        in one process at a time: the other processes (and threads) wait
+        for it to finish, and should look for the key in the cache again
+        before performing the lookup themselves. The keys of each namespace
+        are spread over 4096 lock files in `BASE_DIR`, so unrelated keys of
+        the same namespace may occasionally wait for each other. Namespaces
+        have separate lock files, so that a lookup holding the lock of its
+        key can take the locks of another namespace, e.g. a cached function
+        downloading pages, without deadlocking with the other processes.
+        Locks are reentrant within the same thread and are released by the
+        operating system if the process dies.
+
+        :param key: Key of the item
+        :param namespace: Namespace of the item, if any
+
+        Sample usage:
+
+        >>> from strephit.commons import cache
+        >>> with cache.lock('kk'):
+        ...     if cache.get('kk') is None:
+        ...         cache.set('kk', 15)
+    """
+    with _lock_stripe(_stripe_for(key, namespace), key):
+        yield
+
+
+@contextmanager
+def lock_many(keys, namespace=None):
+    """ Same as :func:`lock`, for many keys at once. Every process takes
+        the lock files in the same order, so that lookups of batches
+        sharing some keys do not deadlock. Each lock file stays open
+        while held, so keep the batches small
+
+        :param keys: Keys of the items
+        :param namespace: Namespace of the items, if any
+
+        Sample usage:
+
+        >>> from strephit.commons import cache
+        >>> with cache.lock_many(['kk', 'jj']):
+        ...     for key in ['kk', 'jj']:
+        ...         if cache.get(key) is None:
+        ...             cache.set(key, 15)
+    """
+    stripes = sorted({_stripe_for(key, namespace) for key in keys})
+    contexts = []
+    try:
+        for stripe in stripes:
+            context = _lock_stripe(stripe, 'a batch of %d keys' % len(keys))
+            context.__enter__()
+            contexts.append(context)
+        yield
+    finally:
+        for context in reversed(contexts):
+            context.__exit__(None, None, None)
+
+
+def _stripe_for(key, namespace):
+    """ Path of the lock file of the given key, see :func:`lock` """
+    directory = os.path.join(BASE_DIR, 'locks', 'ns-' + namespace.replace(os.sep, '_')
+                             if namespace else '')
+    return os.path.join(directory, _hash_for(_memory_key(key, namespace))[:3] + '.lock')
+
+
+@contextmanager
+def _lock_stripe(stripe, description):
+    """ Holds the given lock file, see :func:`lock`
+
+        :param stripe: Path of the lock file
+        :param description: What is being looked up, for the log
+    """
+    directory = os.path.dirname(stripe)
+    held = _held.__dict__.setdefault('stripes', {})
+    if not ENABLED or not SINGLE_FLIGHT or fcntl is None or stripe in held:
+        yield
+        return
+
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+    with open(stripe, 'a') as f:
+        locked, deadline = False, time.time() + LOCK_TIMEOUT
+        while not locked:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                elif time.time() > deadline:
+                    logger.warn('Waited more than %d seconds for the lookup of %s, '
+                                'performing it again', LOCK_TIMEOUT, description)
+                    break
+                time.sleep(0.05)
+
+        held[stripe] = True
+        try:
+            yield
+        finally:
+            del held[stripe]
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cached(function=None, namespace=None, ttl=None, ignored=(), hashed=(), negative_ttl=None):
+    """ Decorator to cache function results based on its arguments.
+        Results are stored in the given namespace, which defaults to
+        the full name of the function, and expire after `ttl` seconds.
+        When the function returns `None` a negative result is stored
+        instead, expiring after `negative_ttl` seconds (see :func:`set_negative`).
+        See :func:`make_key` for the meaning of `ignored` and `hashed`.
+        Concurrent calls with the same arguments are performed only once,
+        see :func:`lock`
 
     Sample usage:
 
@@ -121,14 +835,133 @@ def cached(function):
     20
     >>> f(10)
     20
+    >>> @cache.cached(namespace='doctest', ttl=3600, ignored=('verbose',))
+    ... def g(x, verbose=False):
+    ...     print 'inside g'
+    ...     return 3 * x
+    ...
+    >>> g(10)
+    inside g
+    30
+    >>> g(x=10, verbose=True)
+    30
 
     """
+    if function is None:
+        return lambda f: cached(f, namespace, ttl, ignored, hashed, negative_ttl)
+
+    if namespace is None:
+        namespace = '%s.%s' % (function.__module__, function.__name__)
+
     def wrapper(*args, **kwargs):
-        key = str([function.__module__]) + function.__name__ + str(args) + str(kwargs)
-        res = get(key)
+        key = make_key(function, args, kwargs, ignored, hashed)
+        res = get(key, namespace=namespace, negative=NEGATIVE)
         if res is None:
-            res = function(*args, **kwargs)
-            if res is not None:
-                set(key, res)
-        return res
+            with lock(key, namespace):
+                # another process may have stored it while this one was waiting
+                res = get(key, namespace=namespace, negative=NEGATIVE)
+                if res is None:
+                    res = function(*args, **kwargs)
+                    if res is not None:
+                        set(key, res, namespace=namespace, ttl=ttl)
+                    else:
+                        set_negative(key, namespace=namespace, ttl=negative_ttl)
+        return res if res is not NEGATIVE else None
     return wrapper
+
+
+def _purge_memory(namespace):
+    """ Removes the items of the given namespace from the in-process tier """
+    for key in memory.entries.keys():
+        if namespace and key.startswith(namespace + u'\x00') or \
+                not namespace and u'\x00' not in key:
+            memory.discard(key)
+
+
+def purge(namespace):
+    """ Removes all the items in the given namespace
+
+        :param namespace: Namespace to purge. Use an empty string for
+         the default namespace
+    """
+    get_backend().purge(namespace)
+    _purge_memory(namespace)
+
+
+def purge_expired():
+    """ Removes all the expired items
+
+        :return: How many items were removed
+        :rtype: int
+    """
+    return get_backend().purge_expired()
+
+
+def sizes():
+    """ Computes the number of items and their size for each namespace
+
+        :return: dictionary namespace -> (number of items, size in bytes)
+        :rtype: dict
+    """
+    return get_backend().sizes()
+
+
+@click.group()
+def main():
+    """ Manages the cache
+    """
+    pass
+
+
+@main.command()
+@click.argument('source', type=click.Path(exists=True, file_okay=False, resolve_path=True))
+@click.option('--overwrite/--keep-existing', default=False,
+              help='Whether to overwrite items already in the current backend')
+def migrate(source, overwrite):
+    """ Imports a file-based cache directory into the current backend.
+        Use the global --cache-dir and --cache-backend options to choose the destination
+    """
+    target = get_backend()
+    if isinstance(target, FileSystemBackend) and target.base_dir == source:
+        raise click.BadParameter('source and destination are the same')
+
+    logger.info('Importing cache from %s into %s', source, target.base_dir)
+    count = 0
+    for namespace, key, value, expires in FileSystemBackend(source).items():
+        target.set(key, value, overwrite, namespace, expires)
+        count += 1
+        if count % 10000 == 0:
+            logger.info('Imported %d items', count)
+
+    logger.info('Done, imported %d items', count)
+
+
+@main.command(name='purge')
+@click.argument('namespace', nargs=-1)
+@click.option('--default', 'default', is_flag=True, help='Also purge the default namespace')
+def purge_command(namespace, default):
+    """ Removes all the items in the given namespaces
+    """
+    if default:
+        namespace += ('',)
+    elif not namespace:
+        raise click.UsageError('no namespace given, use --default to purge the default one')
+
+    for each in namespace:
+        purge(each)
+        logger.info('Purged namespace %s', each or '(default)')
+
+
+@main.command(name='purge-expired')
+def purge_expired_command():
+    """ Removes all the expired items
+    """
+    logger.info('Removed %d expired items', purge_expired())
+
+
+@main.command()
+def stats():
+    """ Shows the number of items and their size for each namespace
+    """
+    for namespace, (count, size) in sorted(sizes().items()):
+        click.echo('%s\t%d items\t%.1f MiB' % (namespace or '(default)', count, size / 1024.0 ** 2))
@@ -0,0 +1,172 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+import itertools
+import json
+import logging
+import os
+
+from strephit.commons import parallel
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """ Keeps track of the progress of a pipeline which processes its input
+        row by row and writes its output to a file, so that it can be resumed
+        if it is interrupted. The progress is stored in a file next to the
+        output, named after it with the `.checkpoint` extension, and contains:
+
+         * the offset of the first input row which was not completely processed
+         * how many outputs were written
+         * the size of the output file at that point
+         * the size of the other files written along the output, see :meth:`track`
+
+        Use as a context manager around the processing, with :meth:`map`
+        in place of :func:`parallel.map` and :meth:`write` to produce the output.
+        The progress is saved every `every` input rows, when the processing
+        stops because of an exception and at the end.
+
+        Sample usage:
+
+        >>> import tempfile
+        >>> from strephit.commons.checkpoint import Checkpoint
+        >>> outfile = open(tempfile.mktemp(), 'w')
+        >>> with Checkpoint(outfile) as checkpoint:
+        ...     for each in checkpoint.map(lambda x: 2 * x, range(5)):
+        ...         checkpoint.write('%d\\n' % each)
+        >>> checkpoint.offset, checkpoint.outputs
+        (5, 5)
+    """
+
+    def __init__(self, outfile, resume=False, every=1000):
+        """ Prepares the output, truncating it to the last checkpoint when resuming
+
+            :param outfile: The output file, opened for writing. When resuming it is
+             replaced by the same file opened for appending. Click files are opened
+             lazily, so the previous content is not lost
+            :param bool resume: Whether to resume from the last checkpoint, if any
+            :param int every: Save the progress every this many input rows
+        """
+        self.path = outfile.name + '.checkpoint'
+        self.every = every
+        self.offset = self.outputs = self.position = 0
+        self.resumed = {}
+
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.offset, self.outputs, self.position = \
+                state['offset'], state['outputs'], state['position']
+            self.resumed = state.get('files', {})
+
+            outfile.close()
+            outfile = open(outfile.name, 'r+')
+            outfile.truncate(self.position)
+            outfile.seek(self.position)
+            logger.info('Resuming from input row %d, %d outputs already in %s',
+                        self.offset, self.outputs, outfile.name)
+        elif resume:
+            logger.warn('No checkpoint found at %s, starting from the beginning', self.path)
+
+        self.outfile = outfile
+        self.saved_offset = self.offset
+        # outputs and positions of the other files at the last completed input row
+        self.reached_outputs = self.outputs
+        self.files, self.positions = [], {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+        if exc_type is not None:
+            logger.error('Stopped at input row %d, use --resume to continue from there',
+                         self.offset)
+
+    def save(self):
+        """ Saves the progress reached at the last completed input row.
+            What was written for a row which was not completed is not counted,
+            as the row is processed again when resuming
+        """
+        self.outfile.flush()
+        for each in self.files:
+            each.flush()
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'offset': self.offset, 'outputs': self.reached_outputs,
+                       'position': self.position, 'files': self.positions}, f)
+        os.rename(self.path + '.tmp', self.path)
+        self.saved_offset = self.offset
+
+    def write(self, output):
+        """ Writes an output, which must end with a newline """
+        self.outfile.write(output)
+        self.outputs += 1
+
+    def track(self, other):
+        """ Keeps track of another file written along the output, so that
+            when resuming it is truncated to the last checkpoint as well
+
+            :param other: The file, opened for writing
+            :return: The file to write to, which replaces the given one
+        """
+        if other.name in self.resumed:
+            other.close()
+            other = open(other.name, 'r+')
+            other.truncate(self.resumed[other.name])
+            other.seek(self.resumed[other.name])
+
+        self.files.append(other)
+        self.positions[other.name] = other.tell()
+        return other
+
+    def _reached(self, offset):
+        """ Marks all the input rows before the given offset as processed, i.e.
+            their outputs were all written
+        """
+        self.offset, self.position = offset, self.outfile.tell()
+        self.reached_outputs = self.outputs
+        for each in self.files:
+            self.positions[each.name] = each.tell()
+
+        if self.offset - self.saved_offset >= self.every:
+            self.save()
+
+    def map(self, function, iterable, processes=0, flatten=False, **kwargs):
+        """ Applies the given function to the input rows which were not processed yet,
+            see :func:`parallel.map`. Results are always in order, and batching is not
+            supported. All the results of a row must be consumed, and the corresponding
+            outputs written, before asking for the results of the following row
+
+            :param function: the function used to transform the rows
+            :param iterable: All the input rows, including the ones already processed
+            :param processes: how many rows to process in parallel
+            :param flatten: whether the function returns an iterable of results
+            :param kwargs: Other arguments for :func:`parallel.map`
+            :return: The results
+        """
+        def task((index, row)):
+            result = function(row) if row is not None else None
+            if flatten and result is not None:
+                result = list(result)
+            return index, result
+
+        kwargs.pop('ordered', None)
+        consumed = [self.offset]
+
+        def rows():
+            for index, row in itertools.islice(enumerate(iterable), self.offset, None):
+                consumed[0] = index + 1
+                yield index, row
+
+        for index, result in parallel.map(task, rows(), processes, ordered=True, **kwargs):
+            self._reached(index)
+            if result is None:
+                continue
+            elif flatten:
+                for each in result:
+                    yield each
+            else:
+                yield result
+
+        self._reached(consumed[0])
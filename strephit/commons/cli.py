@@ -1,14 +1,21 @@
 import click
 
-from strephit.commons import tokenize, pos_tag, entity_linking, split_sentences, download, serialize
+from strephit.commons import tokenize, pos_tag, entity_linking, split_sentences, download, serialize, cache, benchmark, io, columnar, \
+    wikidata_index
 
 CLI_COMMANDS = {
     'tokenize': tokenize.main,
     'pos_tag': pos_tag.main,
+    'train_pos_tagger': pos_tag.train_command,
     'entity_linking': entity_linking.main,
     'split_sentences': split_sentences.main,
     'download': download.main,
     'serialize': serialize.main,
+    'cache': cache.main,
+    'benchmark': benchmark.main,
+    'index': io.main,
+    'columnar': columnar.main,
+    'wikidata_index': wikidata_index.main,
 }
 
 
@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+""" JSON encoding and decoding of the items read and written by the pipelines,
+    one per line. The fastest available backend is used: orjson, ujson or
+    the json module of the standard library. Use :func:`loads` and :func:`dumps`
+    as you would use the functions of the json module, without any argument.
+
+    Note that the encoded documents may differ slightly, for instance in the
+    whitespace, but they are always valid JSON and decode to the same values,
+    except for floats encoded by ujson older than 2.0, which are rounded to 15
+    decimal digits, its maximum precision.
+"""
+from __future__ import absolute_import
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _orjson():
+    import orjson
+    return orjson.loads, orjson.dumps
+
+
+def _ujson():
+    import ujson
+
+    if int(ujson.__version__.split('.')[0]) >= 2:
+        # floats are encoded with the shortest representation which decodes to the same value
+        def dumps(obj):
+            return ujson.dumps(obj, escape_forward_slashes=False)
+    else:
+        # round floats to 15 decimal digits, the most allowed, rather than to the default 10
+        def dumps(obj):
+            return ujson.dumps(obj, escape_forward_slashes=False, double_precision=15)
+
+    return ujson.loads, dumps
+
+
+def _stdlib():
+    return json.loads, json.dumps
+
+
+BACKENDS = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _stdlib,
+}
+
+PREFERENCE = ['orjson', 'ujson', 'json']
+
+BACKEND = None
+loads = dumps = None
+
+
+def set_backend(name=None):
+    """ Uses the given backend to encode and decode JSON
+
+        :param name: Name of the backend, or None to pick the fastest available one
+        :return: The name of the backend in use
+        :raises ImportError: if the requested backend is not installed
+    """
+    global BACKEND, loads, dumps
+
+    for candidate in [name] if name else PREFERENCE:
+        try:
+            loads, dumps = BACKENDS[candidate]()
+        except ImportError:
+            if name:
+                raise
+            logger.debug('JSON backend %s not available', candidate)
+        else:
+            BACKEND = candidate
+            break
+
+    logger.debug('Using JSON backend %s', BACKEND)
+    return BACKEND
+
+
+set_backend()
@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+""" Columnar format for items with POS tags, such as the POS-tagged corpus
+    or the extracted sentences. The tags of all the items, lists of
+    `[token, pos, lemma]` (or `[token, pos]`), are stored column by column
+    as integer IDs into vocabularies shared by all the items, while the
+    other fields of each item are stored as JSON lines. This is several
+    times smaller than JSON and much faster to load.
+
+    A columnar corpus is a directory containing:
+
+     * `meta.json`: the key of the tags, the columns, the number of items
+     * `<column>.bin`: for each column, the IDs of all the tags, native int32
+     * `<column>.vocab`: for each column, the vocabulary, one JSON string per line
+     * `offsets.bin`: where the tags of each item start, native int64, one
+       more than the items
+     * `sentences.bin`: where the tags of each sentence start, native int64, one
+       more than the sentences. Sentences end with a tag in :data:`SENTENCE_TAGS`
+       or with the item
+     * `items.jsonl`: the other fields of each item
+
+    Sample usage:
+
+    >>> import tempfile
+    >>> from strephit.commons import columnar
+    >>> path = tempfile.mktemp()
+    >>> with columnar.ColumnarWriter(path, 'tagged') as writer:
+    ...     writer.write({'id': 0, 'tagged': [['He', 'PP', 'he'], ['was', 'VBD', 'be']]})
+    ...     writer.write({'id': 1, 'tagged': [['It', 'PP', 'it'], ['is', 'VBZ', 'be']]})
+    >>> reader = columnar.ColumnarReader(path)
+    >>> reader.vocabularies['lemma']
+    [u'he', u'be', u'it']
+    >>> reader.columns['lemma'].tolist()
+    [0, 1, 2, 1]
+    >>> list(reader)[1]
+    {u'tagged': [[u'It', u'PP', u'it'], [u'is', u'VBZ', u'be']], u'id': 1}
+"""
+from __future__ import absolute_import
+import array
+import json
+import logging
+import multiprocessing as mp
+import os
+
+import click
+import numpy as np
+
+from strephit.commons import codec, parallel
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+COLUMNS = ['token', 'pos', 'lemma']
+
+# POS tags of sentence-final punctuation, for TreeTagger and the Penn tagset
+SENTENCE_TAGS = {'SENT', '.'}
+
+
+def is_columnar(path):
+    """ Whether the given path is a corpus in columnar format """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+class Vocabulary(object):
+    """ Assigns consecutive integer IDs to words """
+
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def id(self, word):
+        """ Returns the ID of the given word, adding it to the vocabulary if needed """
+        id_ = self.ids.get(word)
+        if id_ is None:
+            id_ = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return id_
+
+
+class ColumnarWriter(object):
+    """ Writes items in columnar format, moving their tags to the columns.
+        Use as a context manager or call `close` when done.
+    """
+
+    def __init__(self, path, key, buffer_size=1000000):
+        """ :param path: Directory where to write the corpus, created if needed
+            :param key: Key of the tags in the items
+            :param buffer_size: How many IDs to keep in memory before writing them
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.key = key
+        self.buffer_size = buffer_size
+        self.columns = None
+        self.count = self.offset = self.sentences = 0
+        self.items = open(os.path.join(path, 'items.jsonl'), 'w')
+        self.offsets = open(os.path.join(path, 'offsets.bin'), 'wb')
+        self.offsets_buffer = array.array('l', [0])
+        self.sentences_file = open(os.path.join(path, 'sentences.bin'), 'wb')
+        self.sentences_buffer = array.array('l', [0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self, width):
+        self.columns = COLUMNS[:width]
+        self.vocabularies = [Vocabulary() for _ in self.columns]
+        self.buffers = [array.array('i') for _ in self.columns]
+        self.files = [open(os.path.join(self.path, column + '.bin'), 'wb')
+                      for column in self.columns]
+
+    def _flush(self):
+        if self.columns:
+            for buf, f in zip(self.buffers, self.files):
+                buf.tofile(f)
+                del buf[:]
+        self.offsets_buffer.tofile(self.offsets)
+        del self.offsets_buffer[:]
+        self.sentences_buffer.tofile(self.sentences_file)
+        del self.sentences_buffer[:]
+
+    def write(self, item):
+        """ Writes an item. The tags are written to the columns, the other fields
+            as a JSON line. The item is not modified
+
+            :raises ValueError: if the tags do not have as many columns as the
+             tags of the items already written
+        """
+        tags = item.get(self.key) or []
+        if tags and self.columns is None:
+            self._start(len(tags[0]))
+
+        for tag in tags:
+            if len(tag) != len(self.columns):
+                raise ValueError('Tag %r of item %d has %d columns instead of %d' % (
+                    tag, self.count, len(tag), len(self.columns)))
+
+        for i, tag in enumerate(tags):
+            for value, vocabulary, buf in zip(tag, self.vocabularies, self.buffers):
+                buf.append(vocabulary.id(value))
+
+            if i == len(tags) - 1 or len(tag) > 1 and tag[1] in SENTENCE_TAGS:
+                self.sentences_buffer.append(self.offset + i + 1)
+                self.sentences += 1
+
+        self.offset += len(tags)
+        self.offsets_buffer.append(self.offset)
+        self.items.write(codec.dumps({key: value for key, value in item.iteritems()
+                                      if key != self.key}) + '\n')
+        self.count += 1
+
+        if len(self.offsets_buffer) >= self.buffer_size or \
+                self.columns and len(self.buffers[0]) >= self.buffer_size:
+            self._flush()
+
+    def close(self):
+        """ Writes the vocabularies and the metadata """
+        if self.columns is None:
+            self._start(len(COLUMNS))
+        self._flush()
+
+        for column, vocabulary, f in zip(self.columns, self.vocabularies, self.files):
+            f.close()
+            with open(os.path.join(self.path, column + '.vocab'), 'w') as vocab:
+                for word in vocabulary.words:
+                    vocab.write(json.dumps(word) + '\n')
+
+        self.offsets.close()
+        self.sentences_file.close()
+        self.items.close()
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'version': VERSION, 'key': self.key, 'columns': self.columns,
+                       'count': self.count, 'tags': self.offset, 'sentences': self.sentences}, f)
+
+        logger.info("Written %d items with %d tags in columnar format to '%s'",
+                    self.count, self.offset, self.path)
+
+
+class ColumnarReader(object):
+    """ Reads a corpus in columnar format. The columns of IDs are memory-mapped
+        numpy arrays, which can be used directly to analyze the whole corpus
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.key = self.meta['key']
+        self._lookups = {}
+        self.offsets = self._map('offsets', np.int_, self.meta['count'] + 1)
+        self.sentences = self._map('sentences', np.int_, self.meta['sentences'] + 1)
+        self.columns, self.vocabularies = {}, {}
+        for column in self.meta['columns']:
+            self.columns[column] = self._map(column, np.intc, self.meta['tags'])
+            with open(os.path.join(path, column + '.vocab')) as f:
+                self.vocabularies[column] = [json.loads(line) for line in f]
+
+    def _map(self, name, dtype, size):
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r', shape=(size,))
+
+    def __len__(self):
+        return self.meta['count']
+
+    def tags(self, n):
+        """ Returns the tags of the n-th item, as lists of `[token, pos, lemma]`.
+            Items without tags and items with an empty list of tags cannot
+            be told apart, in both cases no tags are returned.
+        """
+        start, end = self.offsets[n], self.offsets[n + 1]
+        decoded = [[self.vocabularies[column][id_] for id_ in self.columns[column][start:end].tolist()]
+                   for column in self.meta['columns']]
+        return map(list, zip(*decoded))
+
+    def sentence_ids(self, start, end):
+        """ Returns the number of the sentence of each tag in the given range """
+        return np.searchsorted(self.sentences, np.arange(start, end), side='right') - 1
+
+    def lookup(self, column, function, name=None):
+        """ Applies a function to the vocabulary of a column, so that
+            `lookup(column, function)[ids]` applies it to all the given IDs at once
+
+            :param column: Name of the column
+            :param function: Function of a word, returning a boolean or an integer
+            :param name: If given, the result is computed only once and remembered
+             with this name
+            :rtype: numpy.ndarray
+        """
+        if name is not None and (column, name) in self._lookups:
+            return self._lookups[column, name]
+
+        values = [function(word) for word in self.vocabularies[column]]
+        result = np.array(values, dtype=type(values[0]) if values else bool)
+        if name is not None:
+            self._lookups[column, name] = result
+        return result
+
+    def items(self, tags=True):
+        """ Iterates over the items
+
+            :param tags: Whether to decode the tags and add them to the items
+             which have some
+            :rtype: generator
+        """
+        with open(os.path.join(self.path, 'items.jsonl')) as f:
+            for n, line in enumerate(f):
+                item = codec.loads(line)
+                if tags and self.offsets[n + 1] > self.offsets[n]:
+                    item[self.key] = self.tags(n)
+                yield item
+
+    def __iter__(self):
+        return self.items()
+
+
+_readers = {}
+
+
+def open_reader(path):
+    """ Opens a columnar corpus, once per process unless it is written again.
+        The columns are memory-mapped, so all the processes share the same
+        pages through the operating system
+    """
+    modified = os.path.getmtime(os.path.join(path, 'meta.json'))
+    if path not in _readers or _readers[path][0] != modified:
+        _readers[path] = modified, ColumnarReader(path)
+    return _readers[path][1]
+
+
+def _apply((path, function, start, end, args)):
+    return function(open_reader(path), start, end, *args)
+
+
+def map_sentences(path, function, args=(), processes=0, parts=None):
+    """ Applies a function to ranges of whole sentences of a columnar corpus,
+        in parallel. Only the path of the corpus is sent to the workers, which
+        map the columns by themselves instead of receiving the tags
+
+        :param path: Directory of the corpus
+        :param function: Function called as `function(reader, start, end, *args)`,
+         where start and end delimit the tags in the range (end excluded). It must
+         be defined at module level
+        :param args: Additional arguments of the function
+        :param processes: How many processes to use
+        :param parts: In how many ranges to split the corpus, by default four
+         for each process
+        :return: The results of the function, in no particular order
+        :rtype: generator
+    """
+    reader = open_reader(path)
+    parts = parts or 4 * (processes or mp.cpu_count())
+    bounds = np.unique(np.searchsorted(reader.sentences, np.linspace(0, reader.meta['tags'], parts + 1)))
+    splits = reader.sentences[bounds].tolist()
+
+    tasks = [(path, function, start, end, args) for start, end in zip(splits, splits[1:]) if start < end]
+    for each in parallel.map(_apply, tasks, processes):
+        yield each
+
+
+def convert(items, path, key):
+    """ Writes the given items in columnar format
+
+        :param items: Iterable of items
+        :param path: Directory where to write the corpus
+        :param key: Key of the tags in the items
+        :return: The number of items written
+    """
+    with ColumnarWriter(path, key) as writer:
+        for item in items:
+            writer.write(item)
+    return writer.count
+
+
+@click.command()
+@click.argument('corpus', type=click.Path(exists=True))
+@click.argument('outdir', type=click.Path(file_okay=False, resolve_path=True))
+@click.option('--key', '-k', default='pos_tag', help='Key of the tags in the items')
+def main(corpus, outdir, key):
+    """ Converts a corpus with POS tags to the columnar format
+    """
+    from strephit.commons.io import load_scraped_items
+    count = convert(load_scraped_items(corpus), outdir, key)
+    logger.info("Converted %d items to '%s'", count, outdir)
@@ -3,18 +3,17 @@
 from __future__ import absolute_import
 
 import logging
-import json
 from sys import exit
 
 import click
-import requests
 
-from strephit.commons import secrets, cache, parallel
+from strephit.commons import secrets, cache, parallel, codec, web
+from strephit.commons.checkpoint import Checkpoint
 
 logger = logging.getLogger(__name__)
 
 
-@cache.cached
+@cache.cached(hashed=('text',))
 def link(text, min_confidence, language):
     """
      Run entity linking on the given text using Dandelion APIs.
@@ -47,7 +46,7 @@ def link(text, min_confidence, language):
             "Check if your 'strephit/commons/secret_keys.py' file "
             "contains 'NEX_TOKEN', or 'NEX_ID' and 'NEX_KEY'"
          )
-    r = requests.post(secrets.NEX_URL, data=nex_data)
+    r = web.post(secrets.NEX_URL, data=nex_data)
     r.raise_for_status()
     response = r.json()
     logger.debug("Response: %s " % response)
@@ -85,7 +84,8 @@ def extract_entities(response_json):
 @click.option('--processes', '-p', default=0)
 @click.option('--outfile', '-o', type=click.File('w'), default='output/entity_linked.jsonlines')
 @click.option('--confidence', '-c', default=0.25, help='Minimum confidence score, defaults to 0.25.')
-def main(sentences, language, outfile, confidence, processes):
+@click.option('--resume', is_flag=True, help='Resume from the last checkpoint, appending to the outfile')
+def main(sentences, language, outfile, confidence, processes, resume):
     """ Perform entity linking over a set of input sentences.
         The service is Dandelion Entity Extraction API:
         https://dandelion.eu/docs/api/datatxt/nex/v1/ .
@@ -94,20 +94,20 @@ def main(sentences, language, outfile, confidence, processes):
     """
 
     def worker(row):
-        sentence = json.loads(row)
+        sentence = codec.loads(row)
         text = sentence.get('text')
         if text:
             sentence['linked_entities'] = link(text, confidence, language)
-            return json.dumps(sentence)
+            return codec.dumps(sentence)
 
-    count = 0
-    for each in parallel.map(worker, sentences, processes):
-        outfile.write(each)
-        outfile.write('\n')
+    with Checkpoint(outfile, resume) as checkpoint:
+        count = checkpoint.outputs
+        for each in checkpoint.map(worker, sentences, processes):
+            checkpoint.write(each + '\n')
 
-        count += 1
-        if count % 1000 == 0:
-            logger.info('Linked %d sentences', count)
+            count += 1
+            if count % 1000 == 0:
+                logger.info('Linked %d sentences', count)
     if count > 0:
         logger.info("Dumped linked sentences to '%s'" % outfile.name)
     logger.info('Done, linked %d sentences', count)
@@ -1,63 +1,438 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
+import bz2
 import json
 import os
 import logging
 import tarfile
+import zlib
+from collections import defaultdict
 
+import click
+import numpy as np
 import requests
 
-from strephit.commons import cache
+from strephit.commons import cache, codec, columnar, parallel, web
 
 logger = logging.getLogger(__name__)
 
 
+CHUNK_SIZE = 1024 * 1024
+
+JSONLINES_EXTENSIONS = ('.jsonl', '.jsonlines')
+
+# most pages :func:`get_many_and_cache` holds the lock of at the same time
+LOCKED_PAGES = 128
+
+
+def _zstd_decompressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Cannot import zstandard, install it to read .zst files')
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+DECOMPRESSORS = {
+    '.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Decompressor,
+    '.zst': _zstd_decompressor,
+}
+
+
+def _split_compression(name):
+    """ Splits the compression extension, if any, from a file name
+
+        :return: tuple (name without the compression extension, compression extension or None)
+    """
+    base, extension = os.path.splitext(name)
+    if extension in DECOMPRESSORS:
+        return base, extension
+    else:
+        return name, None
+
+
+def _chunks(stream, size=None):
+    """ Reads a stream in chunks, stopping after `size` bytes if given """
+    while size is None or size > 0:
+        chunk = stream.read(CHUNK_SIZE if size is None else min(size, CHUNK_SIZE))
+        if not chunk:
+            break
+        elif size is not None:
+            size -= len(chunk)
+        yield chunk
+
+
+def _decompress(chunks, compression):
+    """ Decompresses a stream of chunks. Concatenated streams, such as the ones
+        produced by parallel compressors, are decompressed one after the other
+    """
+    decompressor = DECOMPRESSORS[compression]()
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = getattr(decompressor, 'unused_data', '')
+            if chunk:
+                decompressor = DECOMPRESSORS[compression]()
+
+
+def read_lines(name, stream, size=None):
+    """ Reads the lines of a stream, transparently decompressing it
+
+        :param name: Name of the file, its extension tells how it is compressed:
+         gzip (.gz), bzip2 (.bz2), zstandard (.zst) or not compressed at all
+        :param stream: File-like object, opened in binary mode
+        :param size: Stop reading after these many (compressed) bytes
+        :return: The lines, without the newline character
+        :rtype: generator
+    """
+    _, compression = _split_compression(name)
+    if not compression and size is None:
+        # iterating over files is faster, as it is done natively
+        for line in stream:
+            yield line.rstrip('\n')
+        return
+
+    chunks = _chunks(stream, size)
+    if compression:
+        chunks = _decompress(chunks, compression)
+
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+
+    if pending:
+        yield pending
+
+
+def _load_lines(name, lines):
+    logger.info("Loaded input file '%s'" % name)
+    for n, line in enumerate(lines):
+        logger.debug("Processing item #%d ...", n)
+        try:
+            yield codec.loads(line)
+        except ValueError:
+            logger.warn('cannot load item at row %d of file %s' % (n, name))
+
+
+def _list_files(location):
+    """ Lists the jsonlines files, possibly compressed, in a directory or
+        the file itself
+
+        :return: tuples (name, path)
+        :rtype: generator
+    """
+    if os.path.isfile(location):
+        yield location, location
+    else:
+        for name in sorted(os.listdir(location)):
+            if _split_compression(name)[0].endswith(JSONLINES_EXTENSIONS):
+                yield name, os.path.join(location, name)
+
+
 def load_scraped_items(location):
     """ Loads all the items from a directory or file.
 
     :param location: Where is the corpus.
 
-        * If it is a directory, all files with extension jsonlines will be loaded.
-        * if it is a file, it can be either a jsonlines of a tar compressed file.
+        * If it is a directory, all files with extension jsonl or jsonlines will be loaded.
+          They can be compressed with gzip (.gz), bzip2 (.bz2) or zstandard (.zst), as in
+          ``items-000.jsonl.gz``
+        * if it is a file, it can be either a jsonlines, possibly compressed, or a tar
+          (possibly compressed) whose members can be compressed as well.
+        * if it is a corpus in columnar format, see :mod:`strephit.commons.columnar`,
+          its items are loaded with the tags.
     """
-    def list_files():
-        if os.path.isfile(location):
-            if tarfile.is_tarfile(location):
-                tar = tarfile.open(location)
-                for file in tar:
-                    yield file.name, tar.extractfile(file)
-            else:
-                yield location, location
-        else:
-            for name in os.listdir(location):
-                if name.endswith('.jsonl') or name.endswith('.jsonlines'):
-                    yield name, os.path.join(location, name)
-
-    def process_stream(name, stream):
-        logger.info("Loaded input file '%s'" % name)
-        for n, line in enumerate(stream):
-            logger.debug("Processing item #%d ..." % n)
-            try:
-                yield json.loads(line)
-            except ValueError:
-                logger.warn('cannot load item at row %d of file %s' % (n, name))
-
-    for name, file in list_files():
-        if hasattr(file, 'read'):
-            try:
-                for each in process_stream(name, file):
-                    yield each
-            finally:
-                file.close()
-        else:
-            with open(file) as f:
-                for each in process_stream(name, f):
+    if columnar.is_columnar(location):
+        for each in columnar.ColumnarReader(location):
+            yield each
+    elif os.path.isfile(location) and tarfile.is_tarfile(location):
+        with tarfile.open(location) as tar:
+            for member in tar:
+                if member.isfile():
+                    for each in _load_lines(member.name,
+                                            read_lines(member.name, tar.extractfile(member))):
+                        yield each
+    else:
+        for name, path in _list_files(location):
+            with open(path, 'rb') as f:
+                for each in _load_lines(name, read_lines(name, f)):
                     yield each
 
     logger.debug('all items loaded')
 
 
+def _load_shard((name, path, offset, size)):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for each in _load_lines(name, read_lines(name, f, size)):
+            yield each
+
+
+def load_scraped_shards(location, processes=0, ordered=False):
+    """ Loads all the items from a corpus split in several files, decoding
+        the files in parallel. Accepts the same corpora as :func:`load_scraped_items`,
+        but members of compressed tar archives and columnar corpora can only be read sequentially.
+        Each file is entirely decoded by one process, so files should be
+        split in shards of manageable size.
+
+    :param location: Where is the corpus, see :func:`load_scraped_items`
+    :param processes: How many files to decode concurrently
+    :param ordered: Whether to load the items in the same order as :func:`load_scraped_items`
+    :return: The items
+    :rtype: generator
+    """
+    if columnar.is_columnar(location):
+        for each in load_scraped_items(location):
+            yield each
+        return
+    elif os.path.isfile(location) and tarfile.is_tarfile(location):
+        try:
+            with tarfile.open(location, 'r:') as tar:
+                shards = [(member.name, location, member.offset_data, member.size)
+                          for member in tar if member.isfile()]
+        except tarfile.ReadError:
+            logger.warn('Cannot read the members of the compressed archive %s in parallel, '
+                        'loading them sequentially', location)
+            for each in load_scraped_items(location):
+                yield each
+            return
+    else:
+        shards = [(name, path, 0, None) for name, path in _list_files(location)]
+
+    logger.info('Loading %d shards with %s processes', len(shards), processes or 'all the')
+    for each in parallel.map(_load_shard, shards, processes, flatten=True, ordered=ordered):
+        yield each
+
+    logger.debug('all items loaded')
+
+
+class JsonLinesIndex(object):
+    """ Sidecar index of an uncompressed jsonlines file, stored next to it with
+        the `.idx` extension. For each item, i.e. each non-empty line, it records
+        the byte offset and the length of the line, so that items can be fetched
+        in constant time, counted without parsing them and split in byte ranges
+        to be read in parallel or on different machines.
+
+        Values of some key fields of the items, such as `url`, `lu` or `id`, can
+        be stored as well, in a second sidecar with the `.idx.keys` extension.
+
+        The index is a JSON header line followed by the records, (little-endian)
+        unsigned 64-bit offset and 32-bit length, which are memory-mapped when loaded.
+
+        Sample usage:
+
+        >>> import json, tempfile
+        >>> from strephit.commons.io import JsonLinesIndex
+        >>> path = tempfile.mktemp()
+        >>> with open(path, 'w') as f:
+        ...     f.writelines(json.dumps({'id': i}) + '\\n' for i in range(10))
+        >>> index = JsonLinesIndex.open(path, keys=('id',))
+        >>> len(index), index[3], index.find('id', 7)
+        (10, {u'id': 3}, [7])
+        >>> index.partitions(3)
+        [(0, 4), (4, 7), (7, 10)]
+    """
+
+    VERSION = 1
+    RECORD = np.dtype([('offset', '<u8'), ('length', '<u4')])
+    PARTITION_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path, header, records):
+        self.path = path
+        self.header = header
+        self.records = records
+        self._keys = self._lookup = None
+
+    @staticmethod
+    def index_path(path):
+        return path + '.idx'
+
+    @classmethod
+    def build(cls, path, keys=()):
+        """ Scans the file and writes its index
+
+            :param path: Path of the jsonlines file
+            :param keys: Fields of the items whose values are stored in the index
+            :return: The index
+            :rtype: JsonLinesIndex
+        """
+        logger.info("Indexing '%s' ...", path)
+        offsets, lengths, values = [], [], []
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                    lengths.append(len(line.rstrip('\n')))
+                    if keys:
+                        try:
+                            item = codec.loads(line)
+                        except ValueError:
+                            logger.warn('cannot load item at row %d of file %s', len(offsets), path)
+                            item = {}
+                        values.append([item.get(key) for key in keys])
+                offset += len(line)
+
+        records = np.empty(len(offsets), dtype=cls.RECORD)
+        records['offset'] = offsets
+        records['length'] = lengths
+
+        stat = os.stat(path)
+        header = {'version': cls.VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                  'count': len(records), 'keys': list(keys)}
+
+        index_path = cls.index_path(path)
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(json.dumps(header) + '\n')
+            f.write(records.tostring())
+        os.rename(index_path + '.tmp', index_path)
+
+        if keys:
+            with open(index_path + '.keys', 'wb') as f:
+                for each in values:
+                    f.write(codec.dumps(each) + '\n')
+
+        logger.info('Indexed %d items', len(records))
+        return cls(path, header, records)
+
+    @classmethod
+    def load(cls, path):
+        """ Loads the index of the given file, without checking whether it is up to date
+
+            :param path: Path of the jsonlines file, not of the index
+            :rtype: JsonLinesIndex
+        """
+        index_path = cls.index_path(path)
+        with open(index_path, 'rb') as f:
+            header_line = f.readline()
+        header = json.loads(header_line)
+
+        if header['count']:
+            records = np.memmap(index_path, dtype=cls.RECORD, mode='r',
+                                offset=len(header_line), shape=(header['count'],))
+        else:
+            records = np.empty(0, dtype=cls.RECORD)
+        return cls(path, header, records)
+
+    @classmethod
+    def open(cls, path, keys=()):
+        """ Loads the index of the given file, building it if missing, out of date
+            or lacking some of the requested key fields
+
+            :param path: Path of the jsonlines file
+            :param keys: Fields of the items whose values must be in the index
+            :rtype: JsonLinesIndex
+        """
+        if os.path.exists(cls.index_path(path)):
+            index = cls.load(path)
+            if index.is_fresh() and set(keys).issubset(index.header['keys']):
+                return index
+            logger.info("The index of '%s' is out of date", path)
+        return cls.build(path, keys)
+
+    def is_fresh(self):
+        """ Whether the indexed file did not change since the index was built """
+        stat = os.stat(self.path)
+        return (self.header['version'] == self.VERSION and self.header['size'] == stat.st_size
+                and self.header['mtime'] == stat.st_mtime)
+
+    def __len__(self):
+        return len(self.records)
+
+    def raw(self, n):
+        """ Returns the n-th line of the file, undecoded """
+        record = self.records[n]
+        with open(self.path, 'rb') as f:
+            f.seek(int(record['offset']))
+            return f.read(int(record['length']))
+
+    def __getitem__(self, n):
+        return codec.loads(self.raw(n))
+
+    def keys(self, field):
+        """ Returns the values of the given key field for all the items, in order """
+        if self._keys is None:
+            with open(self.index_path(self.path) + '.keys', 'rb') as f:
+                self._keys = zip(*map(codec.loads, f)) or [()] * len(self.header['keys'])
+        return self._keys[self.header['keys'].index(field)]
+
+    def find(self, field, value):
+        """ Returns the numbers of the items with the given value of a key field """
+        if self._lookup is None:
+            self._lookup = {}
+        if field not in self._lookup:
+            lookup = defaultdict(list)
+            for n, each in enumerate(self.keys(field)):
+                lookup[each].append(n)
+            self._lookup[field] = lookup
+        return self._lookup[field].get(value, [])
+
+    def partitions(self, parts):
+        """ Splits the items in ranges of roughly the same size in bytes
+
+            :param parts: How many ranges
+            :return: List of ranges (start, end) of item numbers, end excluded
+        """
+        if not len(self):
+            return []
+
+        bounds = np.linspace(0, self.header['size'], parts + 1)[1:-1]
+        splits = [0] + np.searchsorted(self.records['offset'], bounds).tolist() + [len(self)]
+        return [(start, end) for start, end in zip(splits, splits[1:]) if start < end]
+
+    def _byte_range(self, start, end):
+        """ Returns the offset and the size of the bytes containing the given items """
+        first = self.records[start]
+        last = self.records[end - 1]
+        return int(first['offset']), int(last['offset'] + last['length'] - first['offset'])
+
+    def read(self, start=0, end=None):
+        """ Reads the items in the given range, end excluded
+
+            :return: The items
+            :rtype: generator
+        """
+        end = len(self) if end is None else end
+        if start < end:
+            offset, size = self._byte_range(start, end)
+            for each in _load_shard((self.path, self.path, offset, size)):
+                yield each
+
+    def load_parallel(self, processes=0, ordered=False):
+        """ Reads all the items, decoding ranges of the file in parallel
+
+            :param processes: How many ranges to decode concurrently
+            :param ordered: Whether to return the items in the same order as in the file
+            :return: The items
+            :rtype: generator
+        """
+        parts = max(1, self.header['size'] // self.PARTITION_SIZE)
+        ranges = [(self.path, self.path) + self._byte_range(start, end)
+                  for start, end in self.partitions(parts)]
+        for each in parallel.map(_load_shard, ranges, processes, flatten=True, ordered=ordered):
+            yield each
+
+
+def count_items(path):
+    """ Counts the items in a jsonlines file using its index, building it if needed """
+    return len(JsonLinesIndex.open(path))
+
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--keys', '-k', multiple=True, help='Store the values of these key fields')
+def main(path, keys):
+    """ Builds the index of a jsonlines file, to read it randomly or in parallel
+    """
+    index = JsonLinesIndex.build(path, keys)
+    logger.info("Index of %d items written to '%s'", len(index), index.index_path(path))
+
+
 # Sometimes the document may be a list of strings, depending on how it was scraped
 def _join_text(document):
     if type(document) == list:
@@ -89,7 +464,7 @@ def load_corpus(location, document_key, text_only=False):
 def load_dumped_corpus(dump_file_handle, document_key, text_only=False):
     """ Load a previously dumped corpus file, in a memory-efficient way. """
     for line in dump_file_handle:
-        item = json.loads(line)
+        item = codec.loads(line)
         # The document key should always exist here, so raise KeyError if not
         document = _join_text(item[document_key])
         if text_only:
@@ -103,30 +478,163 @@ def dump_corpus(corpus, dump_file_handle):
     """ Dump a loaded corpus to a file with one JSON object per line ."""
     logger.info("Will dump corpus to '%s' ... Format: JSON objects with metadata, one per line" % dump_file_handle.name)
     for item in corpus:
-        dump_file_handle.write(json.dumps(item) + '\n')
+        dump_file_handle.write(codec.dumps(item) + '\n')
     return 0
 
 
-def get_and_cache(url, use_cache=True, **kwargs):
+def _page_key(url, kwargs):
+    return url + json.dumps(kwargs)
+
+
+def get_and_cache(url, use_cache=True, namespace=None, ttl=None, **kwargs):
     """
     Perform an HTTP GET request to the given url and optionally cache the
     result somewhere in the file system. The cached content will be used
     in the subsequent requests.
-    Raises all HTTP errors
+    Raises all HTTP errors. Pages which are not found are remembered for
+    a while, so that the subsequent requests fail without hitting the network.
+    When several processes ask for the same page at the same time only one
+    of them downloads it, see :func:`cache.lock`
 
     :param url: URL of the page to retrieve
     :param use_cache: Whether to use cache
-    :param \*\*kwargs: keyword arguments to pass to `requests.get`
+    :param namespace: Cache namespace in which to store the page
+    :param ttl: Time to live of the cached page, in seconds. Defaults
+     to the one of the namespace
+    :param \*\*kwargs: keyword arguments to pass to :func:`web.get`
     :return: The content page at the given URL, unicode
     """
     if not use_cache:
-        r = requests.get(url, **kwargs)
+        r = web.get(url, **kwargs)
         r.raise_for_status()
         content = r.text
     else:
-        key = url + json.dumps(kwargs)
-        content = cache.get(key)
-        if content is None:
-            content = get_and_cache(url, use_cache=False, **kwargs)
-            cache.set(key, content)
+        key = _page_key(url, kwargs)
+        content = cache.get(key, namespace=namespace, negative=cache.NEGATIVE)
+        if content is cache.NEGATIVE:
+            _raise_not_found(url)
+        elif content is None:
+            with cache.lock(key, namespace):
+                # another process may have downloaded it while this one was waiting
+                content = cache.get(key, namespace=namespace, negative=cache.NEGATIVE)
+                if content is cache.NEGATIVE:
+                    _raise_not_found(url)
+                elif content is None:
+                    try:
+                        content = get_and_cache(url, use_cache=False, **kwargs)
+                    except requests.HTTPError as e:
+                        if e.response is not None and e.response.status_code == 404:
+                            cache.set_negative(key, namespace=namespace)
+                        raise
+                    cache.set(key, content, namespace=namespace, ttl=ttl)
     return content
+
+
+def get_many_and_cache(urls, use_cache=True, namespace=None, ttl=None, threads=16, **kwargs):
+    """ Same as :func:`get_and_cache`, for many pages. The pages which are not
+        cached are downloaded concurrently, see :func:`web.fetch_many`.
+        HTTP errors are returned rather than raised. When several processes ask
+        for the same pages at the same time only one of them downloads each page,
+        see :func:`cache.lock_many`. Pages are locked :data:`LOCKED_PAGES` at a time
+
+    :param urls: URLs of the pages to retrieve, or tuples (url, kwargs) to
+     give specific arguments to some requests
+    :param use_cache: Whether to use cache
+    :param namespace: Cache namespace in which to store the pages
+    :param ttl: Time to live of the cached pages, in seconds
+    :param threads: How many pages to download at the same time
+    :param \*\*kwargs: keyword arguments to pass to :func:`web.get` for all the pages
+    :return: Tuples (url, content, exception), where url is as given. Content
+     is None if the page could not be retrieved because of the exception.
+     Cached pages come first
+    :rtype: generator
+    """
+    missing, requested = [], {}
+    for each in urls:
+        url, specific = (each, {}) if isinstance(each, basestring) else each
+        arguments = dict(kwargs, **specific)
+        key = _page_key(url, arguments)
+
+        if use_cache:
+            content = cache.get(key, namespace=namespace, negative=cache.NEGATIVE)
+            if content is cache.NEGATIVE:
+                try:
+                    _raise_not_found(url)
+                except requests.HTTPError as e:
+                    yield each, None, e
+                continue
+            elif content is not None:
+                yield each, content, None
+                continue
+        request = url, arguments
+        missing.append(request)
+        requested[id(request)] = each, key
+
+    if not missing:
+        return
+    elif not use_cache:
+        for result in _download_many(missing, requested, use_cache, namespace, ttl, threads):
+            yield result
+        return
+
+    for i in xrange(0, len(missing), LOCKED_PAGES):
+        batch, results = missing[i:i + LOCKED_PAGES], []
+        with cache.lock_many([requested[id(request)][1] for request in batch], namespace):
+            # another process may have downloaded some while this one was waiting
+            to_download = []
+            for request in batch:
+                each, key = requested[id(request)]
+                content = cache.get(key, namespace=namespace, negative=cache.NEGATIVE)
+                if content is cache.NEGATIVE:
+                    try:
+                        _raise_not_found(request[0])
+                    except requests.HTTPError as e:
+                        results.append((each, None, e))
+                elif content is not None:
+                    results.append((each, content, None))
+                else:
+                    to_download.append(request)
+
+            if to_download:
+                results.extend(_download_many(to_download, requested, use_cache,
+                                              namespace, ttl, threads))
+
+        # yielded after releasing the locks, as the caller may take others
+        for result in results:
+            yield result
+
+
+def _download_many(missing, requested, use_cache, namespace, ttl, threads):
+    """ Downloads the given pages for :func:`get_many_and_cache`, caching them if requested
+
+        :param missing: Tuples (url, kwargs) of the pages to download
+        :param requested: Dictionary id of the tuple -> (url as given, cache key)
+        :return: Tuples (url as given, content, exception)
+        :rtype: generator
+    """
+    for request, response, error in web.fetch_many(missing, threads):
+        each, key = requested[id(request)]
+        if error is None:
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                error = e
+
+        if error is None:
+            if use_cache:
+                cache.set(key, response.text, namespace=namespace, ttl=ttl)
+            yield each, response.text, None
+        else:
+            if use_cache and isinstance(error, requests.HTTPError) and \
+                    error.response.status_code == 404:
+                cache.set_negative(key, namespace=namespace)
+            yield each, None, error
+
+
+def _raise_not_found(url):
+    """ Raises the same exception requests would raise for a page not found """
+    response = requests.Response()
+    response.url = url
+    response.status_code = 404
+    response.reason = 'Not Found'
+    response.raise_for_status()
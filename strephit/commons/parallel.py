@@ -1,10 +1,36 @@
 from __future__ import absolute_import
+import cPickle as pickle
+import itertools
+import json
 import logging
 import multiprocessing as mp
+import select
 import signal
+import sys
+import threading
+import time
+import traceback
 
 logger = logging.getLogger(__name__)
 
+# how many tasks can wait to be processed, for each worker
+PREFETCH = 4
+
+# with automatic batching, how long each batch should take to process, in seconds
+AUTO_BATCH_DURATION = 0.5
+
+# with automatic batching, maximum size of the batches, in items and in pickled bytes
+AUTO_BATCH_MAX_SIZE = 10000
+AUTO_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# how many times a task is tried again when its worker dies, and where tasks
+# which raise an exception or keep killing their workers are dumped
+RETRIES = 2
+DEAD_LETTER = None
+
+# how often to check whether some worker died, in seconds
+CRASH_CHECK_INTERVAL = 1
+
 
 def make_batches(iterable, size):
     if size > 0:
@@ -21,45 +47,552 @@ def make_batches(iterable, size):
             yield each
 
 
-def _master(function, iterable, processes, task_queue, result_queue, flatten, batch_size):
-    """ Controls the computation. Starts/stops the workers and assigns tasks """
-    workers = [mp.Process(target=_worker,
-                          args=(function, task_queue, result_queue, flatten))
-               for _ in xrange(processes)]
-    [p.start() for p in workers]
+class AdaptiveBatcher(object):
+    """ Groups items in batches whose size is continuously adjusted, so that each batch
+        takes about `duration` seconds to process and is not too large to be sent to
+        the workers. Starts from single items and at most doubles the size at each step
+    """
+
+    # weight of the last measure in the moving averages
+    smoothing = 0.3
+
+    # the pickled size is measured every this many batches
+    sample_every = 16
+
+    def __init__(self, duration=None, max_size=None, max_bytes=None):
+        self.duration = duration or AUTO_BATCH_DURATION
+        self.max_size = max_size or AUTO_BATCH_MAX_SIZE
+        self.max_bytes = max_bytes or AUTO_BATCH_MAX_BYTES
+        self.size = self.logged_size = 1
+        self.item_time = self.item_bytes = None
+        self.batches_count = self.items_count = 0
+
+    def batches(self, iterable):
+        """ Groups the items in batches, each one of the size current at the time
+            it is created
+
+            :param iterable: The items to group
+            :return: lists of items
+            :rtype: generator
+        """
+        iterator = iter(iterable)
+        while True:
+            bulk = list(itertools.islice(iterator, self.size))
+            if not bulk:
+                break
+
+            if self.batches_count % self.sample_every == 0:
+                payload = len(pickle.dumps(bulk, pickle.HIGHEST_PROTOCOL))
+                self.item_bytes = self._average(self.item_bytes, float(payload) / len(bulk))
+
+            self.batches_count += 1
+            self.items_count += len(bulk)
+            yield bulk
+
+        if self.batches_count:
+            logger.info('Automatic batching: %d items in %d batches, %.1f items per batch '
+                        'on average, last size %d', self.items_count, self.batches_count,
+                        float(self.items_count) / self.batches_count, self.size)
+
+    def record(self, items, elapsed):
+        """ Records how long it took to process a batch, and resizes the
+            next batches accordingly
+
+            :param int items: How many items were in the batch
+            :param float elapsed: Processing time in seconds
+        """
+        self.item_time = self._average(self.item_time, elapsed / items)
+
+        size = self.duration / max(self.item_time, 1e-6)
+        if self.item_bytes:
+            size = min(size, self.max_bytes / self.item_bytes)
+        size = int(max(1, min(size, 2 * self.size, self.max_size)))
+
+        if size >= 2 * self.logged_size or 2 * size <= self.logged_size:
+            logger.info('Batch size changed from %d to %d items, each taking about %.3f ms '
+                        'and %d bytes', self.logged_size, size, 1000 * self.item_time,
+                        self.item_bytes or 0)
+            self.logged_size = size
+        self.size = size
+
+    def _average(self, current, measure):
+        if current is None:
+            return measure
+        return (1 - self.smoothing) * current + self.smoothing * measure
+
+
+class ResultChannel(object):
+    """ Carries results from the workers to the calling process. Each worker
+        writes to its own pipe, synchronously and without locks, so that a
+        worker dying while sending a message can only break its own pipe,
+        which is replaced together with the worker, see :meth:`open`.
+        The calling process has a pipe too, for the messages of the feeder
+    """
+
+    def __init__(self):
+        self.readers, self.writers, self.broken = {}, {}, set()
+        self.open(None)
+
+    def open(self, sender):
+        """ Creates the pipe of the given worker, discarding the old one
+
+            :return: The end of the pipe to write to
+        """
+        if sender in self.readers:
+            self.readers[sender].close()
+        self.broken.discard(sender)
+        self.readers[sender], self.writers[sender] = mp.Pipe(duplex=False)
+        return self.writers[sender]
+
+    def started(self, sender):
+        """ Closes the writing end of the pipe of a worker once it is started,
+            so that reading fails rather than hangs if the worker dies
+        """
+        self.writers.pop(sender).close()
+
+    def put(self, message):
+        """ Sends a message from the calling process """
+        self.writers[None].send(message)
+
+    def _receive(self, sender, messages):
+        try:
+            messages.append(self.readers[sender].recv())
+        except (EOFError, IOError):
+            # the worker died, possibly in the middle of a message
+            self.broken.add(sender)
+
+    def get(self, timeout=None):
+        """ Waits at most `timeout` seconds for some messages
 
+            :return: One message from each pipe which has some, none if the time ran out
+            :rtype: list
+        """
+        senders = [sender for sender in self.readers if sender not in self.broken]
+        ready, _, _ = select.select([self.readers[sender] for sender in senders], [], [], timeout)
+        messages = []
+        for sender in senders:
+            if self.readers[sender] in ready:
+                self._receive(sender, messages)
+        return messages
+
+    def drain(self, senders):
+        """ Returns all the messages the given workers already sent, without waiting """
+        messages = []
+        for sender in senders:
+            while sender not in self.broken and self.readers[sender].poll(0):
+                self._receive(sender, messages)
+        return messages
+
+    def close(self):
+        for connection in self.readers.values() + self.writers.values():
+            connection.close()
+
+
+def _feeder(iterable, batch_size, pool, result_queue, window, generation, state):
+    """ Runs in a thread of the calling process and assigns tasks to the workers,
+        waiting for a free slot in the window before submitting each of them.
+        Tells the calling process how many tasks were submitted once the
+        iterable is exhausted
+    """
+    batcher = state['batcher']
+    index = 0
     try:
-        for each in make_batches(iterable, batch_size):
+        if batcher:
+            tasks = batcher.batches(iterable)
+        else:
+            tasks = make_batches(iterable, batch_size)
+
+        for each in tasks:
             if each is None:
                 logger.debug('received None task, ignoring it')
-            else:
-                task_queue.put(each)
-    except KeyboardInterrupt:
-        logger.error('caught KeyboardInterrupt, brutally slaughtering workers')
-        result_queue.cancel_join_thread()
-        task_queue.cancel_join_thread()
-        [p.terminate() for p in workers]
-    else:
-        for _ in xrange(processes):
-            task_queue.put(None)
-        [p.join() for p in workers]
+                continue
 
-    result_queue.put(None)
+            window.acquire()
+            if state['stop']:
+                return
+
+            state['inflight'][index] = each
+            if not pool._assign(generation, index, each, state):
+                return
+            index += 1
+    except:
+        state['error'] = sys.exc_info()
 
+    result_queue.put((generation, index, None, None, 0, None))
 
-def _worker(function, task_queue, result_queue, flatten):
-    """ Worker process: gets tasks, applies the function and sends back results
-        Stop with a `None` task.
+
+def _worker(function, initializer, initargs, task_queue, result_pipe, generation, started, slot):
+    """ Worker process: runs the initializer, then gets tasks from its own queue, applies
+        the function and sends back results together with the index of the task, the slot
+        of the worker, the time it took and the error, if it failed. The queue also carries
+        the function to apply, every time a new map is started. Tasks of a map which is not
+        running anymore are skipped, but still acknowledged. The task being processed is
+        stored in the `slot`-th pair of `started`, so that only that one is blamed if the
+        worker dies. Stop with a `None` task.
     """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    if initializer is not None:
+        initializer(*initargs)
+
+    current = None
     task = task_queue.get()
     while task is not None:
-        for result in _process_task(function, task, flatten, False):
-            result_queue.put(result)
+        if task[0] == 'map':
+            _, map_generation, payload, flatten = task
+            current = (map_generation,
+                       pickle.loads(payload) if payload is not None else function,
+                       flatten)
+        else:
+            _, task_generation, index, args = task
+            results = error = None
+            start = time.time()
+            if current is not None and current[0] == task_generation == generation.value:
+                started[2 * slot + 1] = -1
+                started[2 * slot] = task_generation
+                started[2 * slot + 1] = index
+                try:
+                    results = list(_process_task(current[1], args, current[2], True))
+                except Exception:
+                    logger.exception('caught exception in worker process')
+                    results, error = [], traceback.format_exc()
+            result_pipe.send((task_generation, index, slot, results, time.time() - start, error))
+
         task = task_queue.get()
 
 
+def _dead_letter(path, task, error, attempts):
+    """ Gives up on a task, appending it to the dead letter file, if any """
+    logger.error('task failed %d times, giving up on it', attempts)
+    if path:
+        with open(path, 'a') as f:
+            f.write(json.dumps({'task': task, 'error': error, 'attempts': attempts},
+                               default=repr))
+            f.write('\n')
+
+
+class Pool(object):
+    """ Pool of worker processes which can be used for several maps, so that
+        expensive resources are built only once per worker by the initializer.
+        Use as a context manager, or call `close` when done
+
+        Sample usage:
+
+        >>> from strephit.commons import parallel
+        >>> with parallel.Pool(2) as pool:
+        ...     list(pool.map(abs, [-1, -2, -3], ordered=True))
+        ...     list(pool.map(str, [1, 2, 3], ordered=True))
+        [1, 2, 3]
+        ['1', '2', '3']
+    """
+
+    def __init__(self, processes=0, initializer=None, initargs=(), queue_size=None,
+                 function=None):
+        """ Starts the workers
+
+            :param processes: How many workers to start. Use zero or a negative number
+             to use all the available processors. No additional processes will be used
+             if the value is 1, the tasks are processed by the calling process.
+            :param initializer: Function called by each worker when it starts,
+             usually to build resources shared by all the tasks the worker processes
+             and store them in module globals
+            :param initargs: Arguments for the initializer
+            :param queue_size: How many tasks can wait to be processed. Defaults to
+             `PREFETCH` tasks per process
+            :param function: Function used by `map` when none is given. It is handed to
+             the workers when they are started, so, unlike the functions given to
+             `map`, it does not need to be picklable
+
+            Workers which die are replaced by new ones, which run the initializer again.
+            Each worker has its own queue of tasks, so that the tasks it was processing
+            when it died are known exactly and can be tried again.
+        """
+        if processes <= 0:
+            processes = mp.cpu_count()
+
+        self.processes = processes
+        self.queue_size = queue_size or PREFETCH * processes
+        self.function = function
+        self.initializer = initializer
+        self.initargs = initargs
+        self.running = None
+
+        if processes == 1:
+            if initializer is not None:
+                initializer(*initargs)
+            return
+
+        self.generation = mp.RawValue('i', 0)
+        self.started = mp.RawArray('i', [-1] * 2 * processes)
+        self.result_queue = ResultChannel()
+        self.task_queues = [None] * processes
+        self.workers = [None] * processes
+
+        # tasks given to each worker and not acknowledged yet, (generation, index) -> task
+        self.assigned = [{} for _ in xrange(processes)]
+        self.capacity = max(1, self.queue_size // processes)
+        self.dispatch = threading.Condition()
+
+        for slot in xrange(processes):
+            self._start_worker(slot)
+
+    def _start_worker(self, slot):
+        """ Starts a worker in the given slot, telling it which function to use
+            if a map is running
+        """
+        self.started[2 * slot + 1] = -1
+        self.task_queues[slot] = mp.Queue()
+        if self.running:
+            self.task_queues[slot].put(('map',) + self.running)
+
+        self.workers[slot] = mp.Process(target=_worker, args=(
+            self.function, self.initializer, self.initargs, self.task_queues[slot],
+            self.result_queue.open(slot), self.generation, self.started, slot
+        ))
+        self.workers[slot].start()
+        self.result_queue.started(slot)
+
+    def _assign(self, generation, index, task, state=None):
+        """ Gives a task to the worker with the fewest tasks, recording it before sending it.
+            Unless `state` is None, waits until some worker has less than `capacity` tasks
+
+            :return: False if the map stopped while waiting, True otherwise
+        """
+        with self.dispatch:
+            while True:
+                slot = min(xrange(self.processes), key=lambda each: len(self.assigned[each]))
+                if state is None or len(self.assigned[slot]) < self.capacity:
+                    break
+                elif state['stop']:
+                    return False
+                self.dispatch.wait()
+
+            self.assigned[slot][generation, index] = task
+            self.task_queues[slot].put(('task', generation, index, task))
+        return True
+
+    def _acknowledge(self, slot, generation, index):
+        """ Records that a worker is done with a task """
+        with self.dispatch:
+            self.assigned[slot].pop((generation, index), None)
+            self.dispatch.notify_all()
+
+    def _respawn(self, slots):
+        """ Replaces the workers in the given slots, which died
+
+            :return: the tasks of the current map given to the dead workers and not
+             acknowledged, as tuples (index, reason why they failed, whether the worker
+             was processing it), the others were waiting in the queue of the worker
+            :rtype: list
+        """
+        lost = []
+        for slot in slots:
+            worker = self.workers[slot]
+            logger.error('worker %d died with exit code %s, starting a new one',
+                         worker.pid, worker.exitcode)
+
+            with self.dispatch:
+                assigned, self.assigned[slot] = self.assigned[slot], {}
+                self.dispatch.notify_all()
+
+            running = self.started[2 * slot], self.started[2 * slot + 1]
+            for generation, index in assigned:
+                if generation == self.generation.value:
+                    lost.append((index, 'worker died with exit code %s' % worker.exitcode,
+                                 (generation, index) == running))
+
+            # nobody reads the tasks left in the queue anymore
+            self.task_queues[slot].cancel_join_thread()
+            self.task_queues[slot].close()
+            self._start_worker(slot)
+        return lost
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        """ Stops the workers once they are done with the tasks they have
+        """
+        if self.processes > 1:
+            for task_queue in self.task_queues:
+                task_queue.put(None)
+            [p.join() for p in self.workers]
+            self.result_queue.close()
+
+    def terminate(self):
+        """ Stops the workers immediately
+        """
+        if self.processes > 1:
+            for task_queue in self.task_queues:
+                task_queue.cancel_join_thread()
+            [p.terminate() for p in self.workers]
+            self.result_queue.close()
+
+    def map(self, function=None, iterable=(), flatten=False, raise_exc=True, batch_size=0,
+            ordered=False, window=None, retries=None, dead_letter=None):
+        """ Applies the given function to each element of the iterable using the workers
+            of the pool. See :func:`map` for the meaning of the parameters. The function
+            must be picklable, unless it is the one given when creating the pool.
+            Only one map at a time can run on the same pool.
+
+            :returns: iterable with the results
+        """
+        if function is None:
+            function = self.function
+        if retries is None:
+            retries = RETRIES
+        if dead_letter is None:
+            dead_letter = DEAD_LETTER
+        batcher = AdaptiveBatcher() if batch_size == 'auto' else None
+
+        if self.processes == 1:
+            if batcher:
+                tasks = batcher.batches(iterable)
+            else:
+                tasks = make_batches(iterable, batch_size)
+
+            for task in tasks:
+                if task is None:
+                    continue
+
+                start = time.time()
+                try:
+                    results = list(_process_task(function, task, flatten, True))
+                except Exception:
+                    if raise_exc:
+                        raise
+                    logger.exception('caught exception while processing task')
+                    _dead_letter(dead_letter, task, traceback.format_exc(), 1)
+                    continue
+
+                if batcher:
+                    batcher.record(len(task), time.time() - start)
+                for each in results:
+                    yield each
+            return
+
+        if self.running:
+            raise RuntimeError('only one map at a time can run on the same pool')
+
+        self.generation.value += 1
+        generation = self.generation.value
+        payload = None if function is self.function else \
+            pickle.dumps(function, pickle.HIGHEST_PROTOCOL)
+        self.running = generation, payload, flatten
+        for task_queue in self.task_queues:
+            task_queue.put(('map',) + self.running)
+
+        slots = threading.Semaphore(window or 4 * self.queue_size)
+        state = {'stop': False, 'error': None, 'batcher': batcher, 'inflight': {}}
+        inflight, attempts = state['inflight'], {}
+        feeder = threading.Thread(target=_feeder, args=(iterable, batch_size, self,
+                                                        self.result_queue, slots,
+                                                        generation, state))
+        feeder.daemon = True
+        feeder.start()
+
+        finished = False
+        try:
+            total, received, pending, next_index = None, 0, {}, 0
+            last_check = time.time()
+            while total is None or received < total:
+                completed, failed, lost, dead = [], [], [], []
+                messages = self.result_queue.get(timeout=CRASH_CHECK_INTERVAL)
+
+                if time.time() - last_check >= CRASH_CHECK_INTERVAL:
+                    dead = [slot for slot, worker in enumerate(self.workers) if not worker.is_alive()]
+                    if dead:
+                        # dead workers cannot send anything else, get what they sent before dying
+                        messages.extend(self.result_queue.drain(dead))
+                    last_check = time.time()
+
+                for message_generation, index, slot, results, elapsed, error in messages:
+                    if slot is not None:
+                        self._acknowledge(slot, message_generation, index)
+
+                    if message_generation != generation:
+                        continue
+                    elif slot is None:
+                        total = index
+                    elif error is not None:
+                        failed.append((index, error))
+                    elif results is not None:
+                        completed.append((index, results, elapsed))
+
+                if dead:
+                    lost = self._respawn(dead)
+
+                for index, error in failed:
+                    # exceptions raised by the function would be raised again, give up
+                    if index in inflight:
+                        _dead_letter(dead_letter, inflight[index], error, attempts.get(index, 0) + 1)
+                        completed.append((index, [], None))
+
+                for index, error, blamed in lost:
+                    if index not in inflight:
+                        continue
+                    elif not blamed:
+                        self._assign(generation, index, inflight[index])
+                        continue
+
+                    attempts[index] = attempts.get(index, 0) + 1
+                    if attempts[index] <= retries:
+                        logger.warn('task %d was lost, trying again (%d of %d)',
+                                    index, attempts[index], retries)
+                        self._assign(generation, index, inflight[index])
+                    else:
+                        _dead_letter(dead_letter, inflight[index], error, attempts[index])
+                        completed.append((index, [], None))
+
+                for index, results, elapsed in completed:
+                    # a task tried again may complete more than once
+                    if index not in inflight:
+                        continue
+
+                    task = inflight.pop(index)
+                    received += 1
+                    if batcher and elapsed is not None:
+                        batcher.record(len(task), elapsed)
+
+                    if not ordered:
+                        slots.release()
+                        for each in results:
+                            yield each
+                        continue
+
+                    pending[index] = results
+                    while next_index in pending:
+                        slots.release()
+                        for each in pending.pop(next_index):
+                            yield each
+                        next_index += 1
+
+            finished = True
+        except KeyboardInterrupt:
+            logger.error('caught KeyboardInterrupt, brutally slaughtering workers')
+            self.terminate()
+            raise
+        finally:
+            self.running = None
+            if not finished:
+                # workers skip the tasks of this map still in the queue
+                self.generation.value += 1
+                state['stop'] = True
+                slots.release()
+                with self.dispatch:
+                    self.dispatch.notify_all()
+
+        if state['error'] is not None:
+            exc_type, exc_value, exc_traceback = state['error']
+            raise exc_type, exc_value, exc_traceback
+
+
 def _process_task(function, task, flatten, raise_exc):
     """ Actually processes a task, flattening the results if needed and logging or
         raising exceptions.
@@ -82,7 +615,9 @@ def _process_task(function, task, flatten, raise_exc):
             logger.exception('caught exception in worker process')
 
 
-def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_size=0):
+def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_size=0,
+        ordered=False, queue_size=None, window=None, initializer=None, initargs=(),
+        retries=None, dead_letter=None):
     """ Applies the given function to each element of the iterable in parallel.
         `None` values are not allowed in the iterable nor as return values, they will
         simply be discarded. Can be "safely" stopped with a keboard interrupt.
@@ -96,41 +631,49 @@ def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_si
         :param raise_exc: Only when `processes` equals 1, controls whether to propagate
          the exception raised by the mapping function to the called or simply to log
          them and carry on the computation. When `processes` is different than 1 this
-         parameter is not used.
+         parameter is not used, and tasks which raise are always logged and skipped.
         :param batch_size: If larger than 0, the input iterable will be grouped in groups
          of this size and the resulting list passed to as argument to the worker.
+         Use `'auto'` to let the size vary according to how long batches take to be
+         processed, see :class:`AdaptiveBatcher`
+        :param ordered: Whether to return the results in the same order as the
+         corresponding elements of the iterable
+        :param queue_size: How many tasks can wait to be processed. Defaults to
+         `PREFETCH` tasks per process
+        :param window: How many tasks can be submitted before their results are
+         collected. Limits how many results are kept in memory waiting to be put in
+         order. Defaults to four times `queue_size`
+        :param initializer: Function called once by each worker before processing
+         any task, see :class:`Pool`
+        :param initargs: Arguments for the initializer
+        :param retries: How many times to try again a task whose worker died. Tasks which
+         raise an exception are not tried again, as they would likely raise it again after
+         repeating their side effects. Defaults to `RETRIES`
+        :param dead_letter: Path of a JSONL file where to append the tasks which raised an
+         exception or still killed their worker after all the retries. Defaults to
+         `DEAD_LETTER`, if not set these tasks are only logged
         :returns: iterable with the results. Order is not guaranteed to be preserved
+         unless `ordered` is true
 
         Sample usage:
 
         >>> from strephit.commons import parallel
-        >>> list(parallel.map(lambda x: 2*x, range(10)))
-        [0, 8, 10, 12, 14, 16, 18, 2, 4, 6]
+        >>> list(parallel.map(lambda x: 2*x, range(10), ordered=True))
+        [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
 
     """
-    if processes == 1:
-        for task in make_batches(iterable, batch_size):
-            if task is not None:
-                for each in _process_task(function, task, flatten, raise_exc):
-                    yield each
-    else:
-        if processes <= 0:
-            processes = mp.cpu_count()
-
-        task_queue = mp.Queue(50)
-        result_queue = mp.Queue(50)
-
-        master = mp.Process(target=_master,
-                            args=(function, iterable, processes, task_queue,
-                                  result_queue, flatten, batch_size))
-        master.start()
-
-        result = result_queue.get()
-        while result is not None:
-            yield result
-            result = result_queue.get()
-
-        master.join()
+    pool = Pool(processes, initializer, initargs, queue_size, function)
+    finished = False
+    try:
+        for each in pool.map(function, iterable, flatten, raise_exc, batch_size,
+                             ordered, window, retries, dead_letter):
+            yield each
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
 
 
 def execute(processes=0, *specs):
@@ -151,7 +694,7 @@ def execute(processes=0, *specs):
         [0, 10]
     """
     functions, arguments = specs[::2], specs[1::2]
-    res = list(map(lambda (i, args): (i, functions[i](*args)),
-                   enumerate(arguments),
-                   processes))
-    return [result for _, result in sorted(res, key=lambda (i, _): i)]
+    res = map(lambda (i, args): (i, functions[i](*args)),
+              enumerate(arguments),
+              processes, ordered=True)
+    return [result for _, result in res]
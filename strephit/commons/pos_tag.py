@@ -2,22 +2,113 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
 
+import cPickle as pickle
+import hashlib
 import json
 import logging
+import multiprocessing as mp
+import os
+import sys
+import threading
+from collections import Counter, defaultdict, deque
+from functools import partial
 from sys import exit
 
 import click
 import treetaggerwrapper
 from treetaggerpoll import TaggerProcessPoll
-from treetaggerwrapper import make_tags, NotTag, TreeTagger
+from treetaggerwrapper import make_tags, NotTag, Tag, TreeTagger, TreeTaggerError
 from nltk import pos_tag, word_tokenize, pos_tag_sents
+from nltk.tag.perceptron import PerceptronTagger
 
+from strephit.commons import cache, codec, columnar, parallel
 from strephit.commons.io import load_scraped_items
 from strephit.commons.tokenize import Tokenizer
 
 logger = logging.getLogger(__name__)
 treetaggerwrapper.logger.setLevel(logging.WARN)  # they are too verbose
 
+# Explicit TAGOPT: the default has the '-no-unknown' option,
+# which prints the token rather than '<unknown>' for unknown lemmas
+# We'd rather skip unknown lemmas, as they are likely to be wrong tags
+TAGOPT = u'-token -lemma -sgml -quiet'
+
+# whether to cache the tags of each text, so that the same sentence is tagged only once
+# across the stages of the pipeline, see :meth:`TTPosTagger.tag_one`. Off by default,
+# as there is an item for each sentence: use it with the sqlite backend of the cache
+CACHE = False
+CACHE_NAMESPACE = 'pos_tag'
+
+# log the hit rate of the cache every this many lookups
+CACHE_STATS_EVERY = 10000
+
+# most documents and most bytes of text waiting to be tagged by
+# :meth:`TTPosTagger.tag_many` at any time. Jobs in flight by default
+# are a few per TreeTagger process, to keep all of them busy
+JOBS_PER_PROCESS = 4
+MAX_BYTES_IN_FLIGHT = 64 * 1024 * 1024
+
+# lookups in the cache performed by this process
+cache_stats = Counter()
+
+# where the models of :class:`PerceptronPosTagger` are, by language
+PERCEPTRON_MODEL = 'dev/perceptron-pos-tagger-{language}.pickle'
+
+# SGML lines around each of the sentences tagged together, TreeTagger copies them to the output
+SENTENCE_START = u'<strephit-sentence>'
+SENTENCE_END = u'</strephit-sentence>'
+
+_taggers = {}
+_taggers_lock = threading.Lock()
+
+
+def _tokenize_chunks(tokenizer, tagger, text_list):
+    """ Tokenization logic with the signature required by the TreeTagger CHUNKERPROC kwarg.
+        Chunks given as lists are already tokenized and are passed through untouched
+    """
+    tokens = []
+    for text in text_list:
+        if isinstance(text, list):
+            tokens.extend(text)
+        else:
+            tokens.extend(tokenizer.tokenize(text))
+    return tokens
+
+
+def get_tree_tagger(language, tt_home=None, **kwargs):
+    """ Returns the TreeTagger of this process for the given language and options,
+        starting it the first time. All the callers in the same process share it,
+        so the TreeTagger process is started once and kept running. Forked
+        processes start their own, as the pipes of the parent cannot be shared
+
+        :param language: Language of the tagger
+        :param tt_home: Home directory of TreeTagger
+        :param kwargs: Other options of `treetaggerwrapper.TreeTagger`
+        :rtype: treetaggerwrapper.TreeTagger
+    """
+    key = os.getpid(), language, tt_home, tuple(sorted(kwargs.iteritems()))
+    with _taggers_lock:
+        # taggers inherited from the parent are never dropped, as their
+        # destructor would terminate the TreeTagger process of the parent
+        if key not in _taggers:
+            _taggers[key] = TreeTagger(
+                TAGLANG=language,
+                TAGDIR=tt_home,
+                TAGOPT=TAGOPT,
+                # Use our tokenization logic (CHUNKERPROC here)
+                CHUNKERPROC=partial(_tokenize_chunks, Tokenizer(language)),
+                **kwargs
+            )
+        return _taggers[key]
+
+
+def log_cache_stats():
+    """ Logs the hit rate of the cache of POS tags in this process """
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    if lookups:
+        logger.info('POS tag cache: %d lookups, %d hits (%.1f%%)',
+                    lookups, cache_stats['hits'], 100.0 * cache_stats['hits'] / lookups)
+
 
 class NLTKPosTagger(object):
     """part-of-speech tagger implemented using the NLTK library"""
@@ -31,7 +122,7 @@ class NLTKPosTagger(object):
 
     def tag_one(self, text, tagset, **kwargs):
         """ POS-Tags the given text """
-        return pos_tag(word_tokenize(text, tagset))
+        return pos_tag(word_tokenize(text), tagset)
 
 
 class TTPosTagger(object):
@@ -40,27 +131,48 @@ class TTPosTagger(object):
     def __init__(self, language, tt_home=None, **kwargs):
         self.language = language
         self.tt_home = tt_home
+        self.tagger_options = kwargs
         self.tokenizer = Tokenizer(language)
-        self.tagger = TreeTagger(
-            TAGLANG=language,
-            TAGDIR=tt_home,
-            # Explicit TAGOPT: the default has the '-no-unknown' option,
-            # which prints the token rather than '<unknown>' for unknown lemmas
-            # We'd rather skip unknown lemmas, as they are likely to be wrong tags
-            TAGOPT=u'-token -lemma -sgml -quiet',
-            # Use our tokenization logic (CHUNKERPROC here)
-            CHUNKERPROC=self._tokenizer_wrapper,
-            **kwargs
-        )
+        # start it now, so that a missing installation is reported early
+        get_tree_tagger(language, tt_home, **kwargs)
+
+    @property
+    def tagger(self):
+        """ The TreeTagger shared by this process, see :func:`get_tree_tagger` """
+        return get_tree_tagger(self.language, self.tt_home, **self.tagger_options)
+
+    def _cache_key(self, text, options):
+        """ Key of the tags of a text in the cache: the language, the options
+            of the tagger and the SHA1 of the text
+        """
+        options = dict(self.tagger_options, TAGOPT=TAGOPT, **options)
+        if isinstance(text, str):
+            text = text.decode('utf8')
+        return u'%s %s %s' % (self.language, json.dumps(options, sort_keys=True),
+                              hashlib.sha1(text.encode('utf8')).hexdigest())
+
+    def _cached_tags(self, key):
+        """ Returns the tags cached under the given key, or None """
+        if not CACHE:
+            return None
+
+        tags = cache.get(key, namespace=CACHE_NAMESPACE)
+        cache_stats['hits' if tags is not None else 'misses'] += 1
+        if sum(cache_stats.itervalues()) % CACHE_STATS_EVERY == 0:
+            log_cache_stats()
+
+        if tags is not None:
+            return [Tag(*tag) if len(tag) == 3 else NotTag(*tag) for tag in tags]
+
+    def _cache_tags(self, key, tags):
+        """ Caches all the tags of a text, unknown lemmas included """
+        if CACHE:
+            cache.set(key, [list(tag) for tag in tags], namespace=CACHE_NAMESPACE)
 
     def _tokenizer_wrapper(self, tagger, text_list):
         """ Wrap the tokenization logic with the signature required by the TreeTagger CHUNKERPROC kwarg
         """
-        tokens = []
-        for text in text_list:
-            for token in self.tokenizer.tokenize(text):
-                tokens.append(token)
-        return tokens
+        return _tokenize_chunks(self.tokenizer, tagger, text_list)
 
     def _postprocess_tags(self, tags, skip_unknown=True):
         """ Clean tagged data from non-tags and unknown lemmas (optionally) """
@@ -78,7 +190,8 @@ class TTPosTagger(object):
         return self.tokenizer.tokenize(text)
 
     def tag_one(self, text, skip_unknown=True, **kwargs):
-        """ POS-Tags the given text, optionally skipping unknown lemmas
+        """ POS-Tags the given text, optionally skipping unknown lemmas. The tags are
+            cached by language, options of the tagger and SHA1 of the text, see :data:`CACHE`
 
             :param unicode text: Text to be tagged
             :param bool skip_unknown: Automatically emove unrecognized tags from the result
@@ -94,15 +207,102 @@ class TTPosTagger(object):
              Tag(word=u'be', pos=u'VB', lemma=u'be'),
              Tag(word=u'tagged', pos=u'VVN', lemma=u'tag')]
         """
-        return self._postprocess_tags(make_tags(self.tagger.tag_text(text, **kwargs)),
-                                      skip_unknown)
+        key = self._cache_key(text, kwargs)
+        tags = self._cached_tags(key)
+        if tags is None:
+            tags = make_tags(self.tagger.tag_text(text, **kwargs))
+            self._cache_tags(key, tags)
+        return self._postprocess_tags(tags, skip_unknown)
+
+    def tag_sentences(self, sentences, skip_unknown=True, batch_size=500, **kwargs):
+        """ POS-Tags many sentences, sending each batch to TreeTagger at once rather than
+            one sentence at a time as :meth:`tag_one`. The sentences are enclosed by
+            :data:`SENTENCE_START` and :data:`SENTENCE_END` so that the tags can be split
+            back, and separated by what TreeTagger reads between two calls of :meth:`tag_one`,
+            so that each sentence gets exactly the same tags as if it was tagged alone.
+            Only the sentences missing from the cache are sent, see :meth:`tag_one`
+
+            :param sentences: Iterable of unicode sentences
+            :param bool skip_unknown: Automatically remove unrecognized tags from the result
+            :param int batch_size: How many sentences to send to TreeTagger at once
+            :return: The tags of each sentence, in the same order as the sentences
+            :rtype: list
+
+            Sample usage:
 
-    def tag_many(self, items, document_key, pos_tag_key, batch_size=10000, **kwargs):
-        """ POS-Tags many text documents of the given items. Use this for massive text tagging
+            >>> from strephit.commons.pos_tag import TTPosTagger
+            >>> tagged = TTPosTagger('en').tag_sentences([u'He was born in Rome', u'She wrote a book'])
+            >>> [[tag.word for tag in tags] for tags in tagged]
+            [[u'He', u'was', u'born', u'in', u'Rome'], [u'She', u'wrote', u'a', u'book']]
+        """
+        tagged = []
+        for batch in parallel.make_batches(sentences, batch_size):
+            keys = [self._cache_key(sentence, kwargs) for sentence in batch]
+            tags = [self._cached_tags(key) for key in keys]
+
+            missing = [i for i, each in enumerate(tags) if each is None]
+            if missing:
+                for i, each in zip(missing, self._tag_together([batch[i] for i in missing], **kwargs)):
+                    tags[i] = each
+                    self._cache_tags(keys[i], each)
+
+            tagged.extend(self._postprocess_tags(each, skip_unknown) for each in tags)
+
+        return tagged
+
+    def _tag_together(self, sentences, **kwargs):
+        """ Tags the given sentences with a single call of TreeTagger,
+            see :meth:`tag_sentences`
+
+            :return: All the tags of each sentence, unknown lemmas included
+            :rtype: list
+        """
+        tagger = self.tagger
+        # the final dot and the flushing sentence sent by treetaggerwrapper after each text
+        padding = [SENTENCE_END, u'.'] + tagger.dummysequence.split(u'\n') + [SENTENCE_START]
+
+        text = [[SENTENCE_START]]
+        for sentence in sentences:
+            text.extend([sentence, padding])
+        text[-1] = [SENTENCE_END]
+
+        groups, inside = [], False
+        for line in tagger.tag_text(text, **kwargs):
+            if line == SENTENCE_START:
+                groups.append([])
+                inside = True
+            elif line == SENTENCE_END:
+                inside = False
+            elif inside:
+                groups[-1].append(line)
+
+        if len(groups) != len(sentences):
+            logger.warn('could not split the tags of %d sentences, tagging them one by one',
+                        len(sentences))
+            groups = [tagger.tag_text(sentence, **kwargs) for sentence in sentences]
+
+        return [make_tags(lines) for lines in groups]
+
+    def tag_many(self, items, document_key, pos_tag_key, window=None, ordered=True,
+                 max_bytes=None, batch_size=100, **kwargs):
+        """ POS-Tags many text documents of the given items. Use this for massive text tagging.
+            Items are read lazily and yielded while the next ones are being tagged, keeping at
+            most `window` documents in flight to the pool of TreeTagger processes, so that
+            they never idle and memory does not grow with the corpus
 
             :param items: Iterable of items to tag. Generator preferred
             :param document_key: Where to find the text to tag inside each item. Text must be unicode
             :param pos_tag_key: Where to put pos tagged text
+            :param window: How many documents can be in flight at the same time, by default
+             :data:`JOBS_PER_PROCESS` for each process of the pool
+            :param ordered: Whether to yield the items in the same order as they are given,
+             otherwise they are yielded as soon as they are tagged
+            :param max_bytes: How many bytes of text can be in flight at the same time, by default
+             :data:`MAX_BYTES_IN_FLIGHT`. A single larger document is still tagged, alone
+            :param batch_size: Ignored, documents are sent to TreeTagger one at a time. Accepted
+             so that all the taggers have the same interface, see :meth:`PerceptronPosTagger.tag_many`
+            :return: The tagged items. Items without text are skipped
+            :rtype: generator
 
             Sample usage:
 
@@ -132,7 +332,7 @@ class TTPosTagger(object):
             tt_pool = TaggerProcessPoll(
                 TAGLANG=self.language,
                 TAGDIR=self.tt_home,
-                TAGOPT=u'-token -lemma -sgml -quiet',
+                TAGOPT=TAGOPT,
                 CHUNKERPROC=self._tokenizer_wrapper
             )
         except TypeError:
@@ -144,69 +344,293 @@ class TTPosTagger(object):
                     yield each
         else:
             logging.getLogger('TreeTagger').setLevel(logging.WARNING)
+            window = window or JOBS_PER_PROCESS * mp.cpu_count()
+            max_bytes = max_bytes or MAX_BYTES_IN_FLIGHT
             try:
-                jobs = []
-                s = 0
-                for i, item in enumerate(items):
-                    if not item.get(document_key):
-                        s += 1
+                # (item, cache key, job or None if cached, cached tags, size of the text)
+                in_flight = deque()
+                bytes_in_flight = 0
+                for item in items:
+                    text = item.get(document_key)
+                    if not text:
                         continue
 
-                    jobs.append((item, tt_pool.tag_text_async(item[document_key], **kwargs)))
-                    if len(jobs) % batch_size == 0:
-                        for each in self._finalize_batch(jobs, pos_tag_key):
-                            yield each
-                        jobs = []
-                for each in self._finalize_batch(jobs, pos_tag_key):
-                    yield each
+                    key = self._cache_key(text, kwargs)
+                    tags = self._cached_tags(key)
+                    if tags is not None and not (ordered and in_flight):
+                        item[pos_tag_key] = self._postprocess_tags(tags)
+                        yield item
+                        continue
+
+                    size = sys.getsizeof(text) if tags is None else 0
+                    while in_flight and (len(in_flight) >= window or bytes_in_flight + size > max_bytes):
+                        done = self._next_done(in_flight, ordered)
+                        bytes_in_flight -= done[-1]
+                        if self._finalize_job(done, pos_tag_key):
+                            yield done[0]
+
+                    job = tt_pool.tag_text_async(text, **kwargs) if tags is None else None
+                    in_flight.append((item, key, job, tags, size))
+                    bytes_in_flight += size
+
+                while in_flight:
+                    done = self._next_done(in_flight, ordered)
+                    if self._finalize_job(done, pos_tag_key):
+                        yield done[0]
             finally:
                 tt_pool.stop_poll()
 
-    def _finalize_batch(self, jobs, pos_tag_key):
-        for item, job in jobs:
+    @staticmethod
+    def _next_done(in_flight, ordered):
+        """ Removes from the jobs in flight the next one to collect: the oldest one
+            if ordered, otherwise the first one which is finished, or the oldest one
+            if none is, as TreeTagger processes them in order
+        """
+        if not ordered:
+            for i, (_, _, job, _, _) in enumerate(in_flight):
+                if job is None or job.finished:
+                    done = in_flight[i]
+                    del in_flight[i]
+                    return done
+        return in_flight.popleft()
+
+    def _finalize_job(self, (item, key, job, tags, size), pos_tag_key):
+        """ Waits for a job and adds its tags to the item
+
+            :return: False if the job failed, True otherwise
+        """
+        if job is not None:
             job.wait_finished()
-            item[pos_tag_key] = self._postprocess_tags(make_tags(job.result))
-            yield item
+            if isinstance(job.result, basestring):
+                # the pool gives back the message of the exception
+                logger.warn('failed to tag an item: %s', job.result)
+                return False
+
+            tags = make_tags(job.result)
+            self._cache_tags(key, tags)
+
+        item[pos_tag_key] = self._postprocess_tags(tags)
+        return True
+
+
+class PerceptronPosTagger(object):
+    """ part-of-speech tagger running in-process, without TreeTagger: an averaged perceptron
+        (see `nltk.tag.perceptron`) and a table of lemmas, both learned from the output of
+        TreeTagger with :meth:`train`, so that they use the same tagset and lemmas.
+        It has the same interface as :class:`TTPosTagger`
+    """
+
+    def __init__(self, language, model=None, processes=0):
+        """ :param language: Language of the texts to tag
+            :param model: Path of the model, defaults to :data:`PERCEPTRON_MODEL`
+            :param processes: How many processes :meth:`tag_many` uses
+        """
+        self.language = language
+        self.processes = processes
+        self.model = model or PERCEPTRON_MODEL.format(language=language)
+        self.tokenizer = Tokenizer(language)
+        self.tagger = PerceptronTagger(load=False)
+
+        with open(self.model, 'rb') as f:
+            weights, tagdict, classes, self.lemmas = pickle.load(f)
+        self.tagger.model.weights, self.tagger.tagdict, self.tagger.classes = weights, tagdict, classes
+        self.tagger.model.classes = classes
+
+    @classmethod
+    def train(cls, documents, language, model=None, iterations=5):
+        """ Learns a model from documents tagged by TreeTagger
+
+            :param documents: Iterable of tags of each document, lists of
+             `(token, pos, lemma)`. Documents are split in sentences after the
+             tags in :data:`columnar.SENTENCE_TAGS`
+            :param language: Language of the documents
+            :param model: Where to save the model, defaults to :data:`PERCEPTRON_MODEL`
+            :param iterations: How many times the perceptron goes through the sentences
+            :return: The trained tagger
+            :rtype: PerceptronPosTagger
+        """
+        model = model or PERCEPTRON_MODEL.format(language=language)
+
+        sentences, lemmas = [], defaultdict(Counter)
+        for tags in documents:
+            sentence = []
+            for token, pos, lemma in tags:
+                sentence.append((token, pos))
+                if lemma != u'<unknown>':
+                    # None when the lemma is the token itself, so that it works with any case
+                    lemmas[token.lower(), pos][lemma if lemma != token else None] += 1
+                if pos in columnar.SENTENCE_TAGS:
+                    sentences.append(sentence)
+                    sentence = []
+            if sentence:
+                sentences.append(sentence)
+
+        logger.info('Training on %d sentences with %d tags', len(sentences), sum(map(len, sentences)))
+        tagger = PerceptronTagger(load=False)
+        tagger.train(sentences, nr_iter=iterations)
+
+        lemmas = {key: counter.most_common(1)[0][0] for key, counter in lemmas.iteritems()}
+        with open(model, 'wb') as f:
+            pickle.dump((tagger.model.weights, tagger.tagdict, tagger.classes, lemmas), f, 2)
+
+        logger.info("Saved the model with %d lemmas to '%s'", len(lemmas), model)
+        return cls(language, model)
+
+    def tokenize(self, text):
+        """ Splits a text into tokens
+        """
+        return self.tokenizer.tokenize(text)
+
+    def lemmatize(self, token, pos):
+        """ Returns the lemma of a tagged token, `<unknown>` if it was never seen """
+        lemma = self.lemmas.get((token.lower(), pos), u'<unknown>')
+        return token if lemma is None else lemma
+
+    def tag_one(self, text, skip_unknown=True, **kwargs):
+        """ POS-Tags the given text, optionally skipping unknown lemmas
+
+            :param unicode text: Text to be tagged
+            :param bool skip_unknown: Automatically remove unrecognized tags from the result
+            :rtype: list of `treetaggerwrapper.Tag`
+        """
+        tags = []
+        for token, pos in self.tagger.tag(self.tokenize(text)):
+            tag = Tag(token, pos, self.lemmatize(token, pos))
+            if skip_unknown and tag.lemma == u'<unknown>':
+                logger.debug("Unknown lemma found: %s. Skipping ..." % repr(tag))
+            else:
+                tags.append(tag)
+        return tags
+
+    def tag_sentences(self, sentences, skip_unknown=True, **kwargs):
+        """ POS-Tags many sentences, see :meth:`TTPosTagger.tag_sentences`
+        """
+        return [self.tag_one(sentence, skip_unknown) for sentence in sentences]
+
+    def tag_many(self, items, document_key, pos_tag_key, window=None, ordered=True,
+                 max_bytes=None, batch_size=100, **kwargs):
+        """ POS-Tags many text documents of the given items, in parallel with
+            as many processes as requested when creating the tagger. It takes
+            the same parameters as :meth:`TTPosTagger.tag_many`, so pass them by keyword
+
+            :param items: Iterable of items to tag. Generator preferred
+            :param document_key: Where to find the text to tag inside each item. Text must be unicode
+            :param pos_tag_key: Where to put pos tagged text
+            :param window: Ignored, the processes take batches of items
+            :param ordered: Whether to yield the items in the same order as they are given,
+             otherwise they are yielded as soon as they are tagged
+            :param max_bytes: Ignored, the processes take batches of items
+            :param batch_size: How many items are sent to each process at a time
+        """
+        def worker(batch):
+            tagged = []
+            for item in batch:
+                text = item.get(document_key)
+                if text:
+                    item[pos_tag_key] = self.tag_one(text, **kwargs)
+                    tagged.append(item)
+            return tagged
+
+        for each in parallel.map(worker, items, self.processes, flatten=True,
+                                 batch_size=batch_size, ordered=ordered):
+            yield each
 
 
 def get_pos_tagger(language, **kwargs):
-    """ Returns an initialized instance of the preferred POS tagger for the given language """
-    return TTPosTagger(language, **kwargs)
+    """ Returns an initialized instance of the preferred POS tagger for the given language:
+        TreeTagger or, if it is not installed, :class:`PerceptronPosTagger` if it has a model
+    """
+    try:
+        return TTPosTagger(language, **kwargs)
+    except TreeTaggerError:
+        if not os.path.exists(PERCEPTRON_MODEL.format(language=language)):
+            raise
+        logger.warn('TreeTagger is not available, using the perceptron tagger')
+        return PerceptronPosTagger(language)
 
 
 @click.command()
 @click.argument('corpus', type=click.Path(exists=True, file_okay=True, resolve_path=True))
 @click.argument('document-key')
 @click.argument('language-code')
-@click.option('-t', '--tagger', type=click.Choice(['tt', 'nltk']), default='tt')
+@click.option('-t', '--tagger', type=click.Choice(['tt', 'nltk', 'perceptron']), default='tt')
 @click.option('-o', '--outfile', type=click.File('w'), default='output/pos_tagged.jsonlines')
 @click.option('-T', '--pos-tag-key', default='pos_tag')
 @click.option('--tt-home', type=click.Path(exists=True, resolve_path=True),
               help="home directory for TreeTagger")
-@click.option('--batch-size', '-b', default=10000)
-def main(corpus, document_key, pos_tag_key, language_code, tagger, outfile, tt_home, batch_size):
+@click.option('--model', type=click.Path(exists=True, dir_okay=False),
+              help='Model of the perceptron tagger, see train_pos_tagger')
+@click.option('--processes', '-p', default=0, help='How many processes the perceptron tagger uses')
+@click.option('--batch-size', '-b', default=100, help='How many items are sent to each process '
+                                                    'of the perceptron tagger at a time')
+@click.option('--window', '-w', default=0, help='How many documents TreeTagger can be tagging at '
+                                                'the same time, by default a few for each CPU')
+@click.option('--max-bytes', default=MAX_BYTES_IN_FLIGHT,
+              help='How many bytes of text TreeTagger can be tagging at the same time')
+@click.option('--unordered', is_flag=True, help='Write the items as soon as they are tagged, '
+                                                'not in the same order as the corpus')
+@click.option('--columnar', 'columnar_path', type=click.Path(file_okay=False, resolve_path=True),
+              help='Write the tagged corpus in columnar format to this directory instead of the outfile')
+def main(corpus, document_key, pos_tag_key, language_code, tagger, outfile, tt_home, model, processes,
+         batch_size, window, max_bytes, unordered, columnar_path):
     """ Perform part-of-speech (POS) tagging over an input corpus.
     """
     if tagger == 'tt':
         pos_tagger = TTPosTagger(language_code, tt_home)
         logger.info("About to perform part-of-speech tagging with TreeTagger ...")
+    elif tagger == 'perceptron':
+        pos_tagger = PerceptronPosTagger(language_code, model, processes)
+        logger.info("About to perform part-of-speech tagging with the perceptron tagger ...")
     else:
         pos_tagger = NLTKPosTagger(language_code)
         logger.info("About to perform part-of-speech tagging with NLTK tagger ...")
 
     corpus = load_scraped_items(corpus)
     
+    writer = columnar.ColumnarWriter(columnar_path, pos_tag_key) if columnar_path else None
+
+    tagged = pos_tagger.tag_many(corpus, document_key, pos_tag_key, window=window, ordered=not unordered,
+                                 max_bytes=max_bytes, batch_size=batch_size)
+
     total = 0
-    for i, tagged_document in enumerate(pos_tagger.tag_many(corpus, document_key, pos_tag_key, batch_size)):
+    for i, tagged_document in enumerate(tagged):
         total += 1
-        outfile.write(json.dumps(tagged_document) + '\n')
+        if writer:
+            writer.write(tagged_document)
+        else:
+            outfile.write(codec.dumps(tagged_document) + '\n')
         if (i + 1) % 10000 == 0:
             logger.info('processed %d items', i + 1)
+
+    if writer:
+        writer.close()
     
     logger.info("Done, total tagged items: %d" % total)
+    log_cache_stats()
     
     return 0
 
 
+@click.command()
+@click.argument('corpus', type=click.Path(exists=True, resolve_path=True))
+@click.argument('language-code')
+@click.option('-T', '--pos-tag-key', default='pos_tag')
+@click.option('-o', '--outfile', type=click.Path(dir_okay=False),
+              help='Where to save the model, by default where the perceptron tagger looks for it')
+@click.option('--iterations', '-i', default=5)
+def train_command(corpus, language_code, pos_tag_key, outfile, iterations):
+    """ Trains the perceptron POS tagger on a corpus tagged by TreeTagger,
+        in JSON lines or columnar format
+    """
+    if columnar.is_columnar(corpus):
+        items = columnar.ColumnarReader(corpus)
+    else:
+        items = load_scraped_items(corpus)
+
+    documents = (item[pos_tag_key] for item in items if item.get(pos_tag_key))
+    tagger = PerceptronPosTagger.train(documents, language_code, outfile, iterations)
+    logger.info("Done, the model is in '%s'", tagger.model)
+
+
 if __name__ == '__main__':
     exit(main())
@@ -6,7 +6,8 @@ import json
 
 import click
 from collections import defaultdict
-from strephit.commons import wikidata, parallel, text
+from strephit.commons import wikidata, parallel, text, codec
+from strephit.commons.checkpoint import Checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +77,35 @@ class ClassificationSerializer:
 
             yield name, wid
 
+    def search_terms(self, data, input_encoded=True):
+        """ Finds the terms which will be searched on Wikidata to convert the
+            classification results into statements, so that they can be
+            searched in advance
+
+            :param data: Data from the classifier. Can be either str or dict
+            :param bool input_encoded: Whether data is a str or a dict
+            :rtype: list
+        """
+        data = codec.loads(data) if input_encoded else data
+        if not data.get('url'):
+            return []
+
+        terms = []
+        if data['lu'] in self.frame_data:
+            frame = self.frame_data[data['lu']]
+            terms.extend(text.fix_name(fe['chunk'])[0] for fe in data['fes']
+                         if fe['fe'] in frame['core_fes'])
+
+        if not terms and data['url'] not in self.url_to_wid and data.get('name'):
+            terms.append(text.fix_name(data['name'])[0])
+
+        for fe in data['fes']:
+            prop = self.lu_fe_map.get((data['lu'], fe['fe']), {}).get('wid')
+            if prop and 'link' not in fe and fe['fe'] not in ['Time', 'Duration']:
+                terms.extend(wikidata.resolver_terms(prop, fe['chunk']))
+
+        return terms
+
     def serialize_numerical(self, subj, fe, data):
         """ Serializes a numerical FE found by the normalizer
         """
@@ -142,7 +172,7 @@ class ClassificationSerializer:
              is true else it is a named entity which could not be resolved
             :type: generator
         """
-        data = json.loads(data) if input_encoded else data
+        data = codec.loads(data) if input_encoded else data
 
         url = data.get('url')
         if not url:
@@ -231,8 +261,11 @@ def map_url_to_wid(semistructured):
 @click.option('--semistructured', type=click.File('r'))
 @click.option('--processes', '-p', default=0)
 @click.option('--dump-unresolved', type=click.File('w'))
+@click.option('--resume', is_flag=True, help='Resume from the last checkpoint, appending to the outfile')
+@click.option('--prefetch', default=100, help='Search on Wikidata the chunks of this many sentences '
+                                              'at once, 0 to search them one by one')
 def main(classified, lexical_db, outfile, language,
-         semistructured, processes, dump_unresolved):
+         semistructured, processes, dump_unresolved, resume, prefetch):
     """ Serialize classification results into quickstatements
     """
 
@@ -247,23 +280,28 @@ def main(classified, lexical_db, outfile, language,
 
     lexical_db = json.load(lexical_db)
 
-    count = skipped = 0
+    skipped = 0
     serializer = ClassificationSerializer(language, lexical_db, url_to_wid)
-    for success, item in parallel.map(serializer.to_statements, classified,
-                                      processes=processes, flatten=True):
-        if success:
-            outfile.write(item.encode('utf8'))
-            outfile.write('\n')
-
-            count += 1
-        else:
-            skipped += 1
-            if dump_unresolved:
-                dump_unresolved.write(json.dumps(item))
-                dump_unresolved.write('\n')
+    with Checkpoint(outfile, resume) as checkpoint:
+        if dump_unresolved:
+            dump_unresolved = checkpoint.track(dump_unresolved)
+
+        count = checkpoint.outputs
+        classified = wikidata.prefetch(classified, serializer.search_terms, language, prefetch)
+        for success, item in checkpoint.map(serializer.to_statements, classified,
+                                            processes=processes, flatten=True):
+            if success:
+                checkpoint.write(item.encode('utf8') + '\n')
+
+                count += 1
+            else:
+                skipped += 1
+                if dump_unresolved:
+                    dump_unresolved.write(codec.dumps(item))
+                    dump_unresolved.write('\n')
 
-        if count % 1000 == 0 and count > 0:
-            logger.info('Produced %d statements so far, skipped %d names', count, skipped)
+            if count % 1000 == 0 and count > 0:
+                logger.info('Produced %d statements so far, skipped %d names', count, skipped)
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
     logger.info("Dataset serialized to '%s'" % outfile.name)
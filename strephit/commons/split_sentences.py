@@ -4,14 +4,13 @@
 from __future__ import absolute_import
 
 import logging
-import json
 from sys import exit
 
 import click
 from nltk.data import load
 
 from strephit.commons.io import load_corpus
-from strephit.commons import parallel
+from strephit.commons import parallel, codec
 
 logger = logging.getLogger(__name__)
 
@@ -119,9 +118,9 @@ def main(corpus, document_key, language_code, outfile, processes):
 
     def worker((i, text)):
         sentences = list(s.split(text))
-        return json.dumps({i: sentences}) if sentences else None
+        return codec.dumps({i: sentences}) if sentences else None
 
-    for sentences in parallel.map(worker, enumerate(corpus), processes):
+    for sentences in parallel.map(worker, enumerate(corpus), processes, ordered=True):
         outfile.write(sentences)
         outfile.write('\n')
 
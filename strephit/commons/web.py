@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+""" Shared HTTP layer: every process keeps one session, so that connections
+    to the same host are kept alive and reused, limits how many requests
+    are sent concurrently to each host and retries, with exponential backoff,
+    requests which fail because of the network or because the server is
+    overloaded (HTTP 429 and 5xx).
+
+    Sample usage:
+
+    >>> from strephit.commons import web
+    >>> web.get_session() is web.get_session()
+    True
+"""
+from __future__ import absolute_import
+import logging
+import os
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# how many times to try again requests which fail, and how long to wait
+# before the first retry, in seconds. The wait doubles at every retry
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 60
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# requests sent at the same time to each host by a process
+CONCURRENCY = 4
+HOST_CONCURRENCY = {}
+
+TIMEOUT = 60
+
+_local = {'pid': None, 'session': None, 'semaphores': {}, 'pools': {}}
+_lock = threading.Lock()
+
+
+def get_session():
+    """ Returns the session of this process, creating it if needed. Forked
+        processes get a new session, as connections cannot be shared
+    """
+    with _lock:
+        if _local['pid'] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(
+                [CONCURRENCY] + HOST_CONCURRENCY.values()))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _local.update(pid=os.getpid(), session=session, semaphores={}, pools={})
+        return _local['session']
+
+
+def _pool(threads):
+    """ Returns the pool of threads of this process with the given size, creating it if needed.
+        Pools are kept for the life of the process, as starting threads at every call is slow
+    """
+    get_session()
+    with _lock:
+        pools = _local['pools']
+        if threads not in pools:
+            pools[threads] = ThreadPool(threads)
+        return pools[threads]
+
+
+def _semaphore(host):
+    """ Returns the semaphore limiting the concurrent requests to the given host """
+    with _lock:
+        semaphores = _local['semaphores']
+        if host not in semaphores:
+            semaphores[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, CONCURRENCY))
+        return semaphores[host]
+
+
+def _backoff(attempt, response=None):
+    """ How long to wait before trying again, honoring the Retry-After header, if any """
+    if response is not None:
+        try:
+            return min(float(response.headers['Retry-After']), MAX_BACKOFF)
+        except (KeyError, ValueError):
+            pass
+    return min(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5), MAX_BACKOFF)
+
+
+def request(method, url, retries=None, **kwargs):
+    """ Sends an HTTP request through the shared session, waiting if too many requests
+        are in flight to the same host and trying again if it fails because of the
+        network or because the server is overloaded. Other HTTP errors are not
+        raised, check the response.
+
+        :param method: HTTP method
+        :param url: URL of the request
+        :param retries: How many times to try again, defaults to :data:`RETRIES`
+        :param kwargs: Other arguments of `requests.request`. The timeout defaults
+         to :data:`TIMEOUT`
+        :return: The response of the last attempt
+        :rtype: requests.Response
+        :raises requests.RequestException: if the request fails at every attempt
+         because of the network
+    """
+    retries = RETRIES if retries is None else retries
+    kwargs.setdefault('timeout', TIMEOUT)
+    session = get_session()
+    semaphore = _semaphore(urlparse(url).netloc)
+
+    attempt = 0
+    while True:
+        try:
+            with semaphore:
+                response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            delay = _backoff(attempt)
+            logger.warn('%s %s failed (%s), trying again in %.1f seconds', method, url, e, delay)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+            delay = _backoff(attempt, response)
+            logger.warn('%s %s returned HTTP %d, trying again in %.1f seconds',
+                        method, url, response.status_code, delay)
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    """ Sends a GET request, see :func:`request` """
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """ Sends a POST request, see :func:`request` """
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    """ Sends a PUT request, see :func:`request` """
+    return request('PUT', url, **kwargs)
+
+
+def fetch_many(requests_, threads=16, ordered=False, method='GET'):
+    """ Sends many requests concurrently, from a pool of threads. Concurrent requests
+        to the same host are still limited, see :data:`CONCURRENCY`
+
+        :param requests_: Iterable of URLs, or of tuples (url, kwargs) to give
+         specific arguments to some requests
+        :param threads: How many requests to send at the same time
+        :param ordered: Whether to return the results in the same order as the requests
+        :param method: HTTP method of all the requests
+        :return: Tuples (request, response, exception), either the response or the
+         exception which made the request fail is None
+        :rtype: generator
+    """
+    def fetch(each):
+        url, kwargs = (each, {}) if isinstance(each, basestring) else each
+        try:
+            return each, request(method, url, **kwargs), None
+        except requests.RequestException as e:
+            logger.debug('%s %s failed: %s', method, url, e)
+            return each, None, e
+
+    pool = _pool(threads)
+    mapper = pool.imap if ordered else pool.imap_unordered
+    for each in mapper(fetch, requests_):
+        yield each
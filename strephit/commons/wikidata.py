@@ -4,15 +4,17 @@
 from __future__ import absolute_import
 import json
 import logging
-from itertools import product
+from itertools import islice
 import os
 from urlparse import urlparse
 from strephit.commons import cache, io, datetime
+from strephit.commons.wikidata_index import WikidataIndex
 import requests
 
 logger = logging.getLogger(__name__)
 
 WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
+ENTITIES_BATCH = 50  # most IDs accepted by wbgetentities at once
 PROPERTIES_NAMESPACE = 120
 PROPERTY_TO_WIKIDATA = {
     'Died of:': 'P509',
@@ -61,6 +63,12 @@ PROPERTY_TO_WIKIDATA = {
 PROPERTY_TO_WIKIDATA.update({'Family %d' % i: 'P1038' for i in xrange(1, 21)})
 
 PROPERTY_RESOLVERS = {}
+
+# path of a local index of labels and aliases, see :mod:`wikidata_index`. When
+# set, searches only find the entities whose label or alias is the search term,
+# without using the network
+INDEX = None
+_index = None
 NATIONALITY_TO_COUNTRY = {}
 
 
@@ -102,8 +110,8 @@ def identity_resolver(property, value, language, **kwargs):
     return '%s:"%s"' % (language, unicode(value).replace('"', '\\"')) if value else None
 
 
-@cache.cached
 @resolver('P21')
+@cache.cached(ignored=('kwargs',))
 def gender_resolver(property, value, language, **kwargs):
     """ Resolve gender """
     results = search(value, language, type_=4369513)
@@ -113,8 +121,8 @@ def gender_resolver(property, value, language, **kwargs):
         return ''  # cache, but do not serialize
 
 
-@cache.cached
 @resolver('P569', 'P570')
+@cache.cached(ignored=('kwargs',))
 def date_resolver(property, value, language, **kwargs):
     """ Resolves dates """
     value = value.lower().replace('(circa)', '').replace('(probable)', '') \
@@ -140,70 +148,119 @@ def resolver_with_hints(property, value, language, **kwargs):
     type_ = {'type_': kwargs.pop('type_')} if 'type_' in kwargs else {}
     results = search(value, language, label_exact=False, **type_)
 
-    def date_matches(their_dates, our_dates):
-        """ Finds how many dates match between the ones we have and
-            the ones they provide
-        """
-        matches = 0
-        for theirs, ours in product(their_dates, our_dates):
-            val = theirs['mainsnak']['datavalue']['value']
-            their_date = parse_date(val['time'], val['precision'])
-            our_date = parse_date(ours)
-            matches += all(
-                their_date[k] == our_date[k]
-                for k in {'year', 'month', 'day'}
-                if their_date.get(k) and our_date.get(k)  # consider precision
-            )
-        return matches
-
     # no additional info provided, return first match and pray
     if not kwargs:
         return results[0]['id'] if results else ''  # cache, but do not serialize
 
     # try to disambiguate using provided info
     logger.debug('disambiguating %d entities, searching for %s', len(results), value)
-    most_matches = None
-    known_properties = set(PROPERTY_TO_WIKIDATA.values()) | set(kwargs)
-    for entity in results:
-        # for disambiguation pages
-        if 'claims' not in entity:
-            continue
+    return Hints(kwargs).best_match(results, value)
+
+
+def _date_parts(date):
+    """ Returns the year, month and day of a date parsed by :func:`parse_date` """
+    return date['year'], date['month'], date['day']
+
+
+class Hints(object):
+    """ Information about an entity, such as its birth date or its nationality,
+        used to pick it among many candidates. The dates are parsed and the
+        values collected in sets once, then each candidate is scored with a
+        single pass over the properties of the hints
+    """
+
+    # properties whose values are dates
+    date_properties = {'P569', 'P570'}
 
+    # weight of the matches of each property, gender alone should not be enough
+    weights = {'P21': 0.5}
+
+    def __init__(self, hints):
+        """ :param dict hints: dictionary of wikidata property -> list of values.
+             Keys which are not properties are ignored
+        """
+        self.dates, self.values = {}, {}
+        for property, values in hints.iteritems():
+            if property in self.date_properties:
+                self.dates[property] = []
+                for value in values:
+                    try:
+                        self.dates[property].append(_date_parts(parse_date(value)))
+                    except ValueError:
+                        logger.debug('ignoring malformed date %s of property %s', value, property)
+            else:
+                try:
+                    self.values[property] = set(filter(None, values))
+                except TypeError:
+                    continue
+
+    def _date_matches(self, claim, ours):
+        """ Finds how many dates match between the ones we have and
+            the ones they provide, considering their precision
+        """
+        theirs = []
+        for each in claim:
+            value = each['mainsnak']['datavalue']['value']
+            theirs.append(_date_parts(parse_date(value['time'], value['precision'])))
+
+        return sum(
+            all(t == o for t, o in zip(their_date, our_date) if t and o)
+            for their_date in theirs for our_date in ours
+        )
+
+    def score(self, entity):
+        """ Computes how well the claims of an entity match the hints
+
+            :param dict entity: Entity, as returned by the APIs
+            :return: How many values match, weighted by property
+        """
+        claims = entity['claims']
         matches = 0
-        for property, claim in entity['claims'].iteritems():
-            try:
-                if property == 'P569':
-                    if 'P569' in kwargs:
-                        matches += date_matches(claim, kwargs['P569'])
-
-                elif property == 'P570':
-                    if 'P570' in kwargs:
-                        matches += date_matches(claim, kwargs['P570'])
-
-                elif property in known_properties:
-                    entity_val = set(filter(None, ('Q%d' % v['mainsnak']['datavalue']['value']['numeric-id']
-                                                   for v in claim)))
-                    our_val = set(filter(None, kwargs.get(property, [])))
-                    weight = 0.5 if property == 'P21' else 1  # avoid matching only by gender
-                    m = len(our_val.intersection(entity_val))
-                    matches += m * weight
-
-                    logger.debug('property %s of entity %s is "%s" while provided value is "%s", '
-                                 'match is %d', property, entity['id'], entity_val,
-                                 our_val, m)
-
-            except (KeyError, TypeError):
+        for property, ours in self.dates.iteritems():
+            if property in claims:
+                try:
+                    matches += self._date_matches(claims[property], ours)
+                except (KeyError, TypeError):
+                    continue
+
+        for property, ours in self.values.iteritems():
+            if property in claims:
+                try:
+                    theirs = set('Q%d' % each['mainsnak']['datavalue']['value']['numeric-id']
+                                 for each in claims[property])
+                except (KeyError, TypeError):
+                    continue
+
+                m = len(ours & theirs)
+                matches += m * self.weights.get(property, 1)
+                logger.debug('property %s of entity %s is "%s" while provided value is "%s", '
+                             'match is %d', property, entity['id'], theirs, ours, m)
+
+        return matches
+
+    def best_match(self, entities, value=None):
+        """ Finds the entity which matches the most hints, the first one in case of ties
+
+            :param list entities: Candidate entities, as returned by the APIs
+            :param value: What was searched to find the candidates, for logging
+            :return: The Wikidata ID of the best entity, or an empty string if
+             no entity matches at least one hint
+        """
+        most_matches = None
+        for entity in entities:
+            # for disambiguation pages
+            if 'claims' not in entity:
                 continue
 
-        logger.debug('entity %s matched %d properties', entity['id'], matches)
-        if most_matches is None or matches > most_matches[0]:
-            most_matches = matches, entity
+            matches = self.score(entity)
+            logger.debug('entity %s matched %d properties', entity['id'], matches)
+            if most_matches is None or matches > most_matches[0]:
+                most_matches = matches, entity
 
-    if most_matches is None:
-        logger.debug('failed to resolve "%s"; no entity matches', value)
-        return ''  # if no results
-    else:
-        if most_matches[0] >= 1:
+        if most_matches is None:
+            logger.debug('failed to resolve "%s"; no entity matches', value)
+            return ''  # if no results
+        elif most_matches[0] >= 1:
             logger.debug('Resolved %s to %s', value, most_matches[1]['id'])
             return most_matches[1]['id']
         else:
@@ -211,8 +268,8 @@ def resolver_with_hints(property, value, language, **kwargs):
             return ''
 
 
-@cache.cached
 # @resolver('P108', 'P97', 'P166')
+@cache.cached(ignored=('kwargs',))
 def generic_search_resolver(property, value, language, **kwargs):
     """ Last-hope resolver, searches wikidata hoping to find something
         which exactly matches the given value
@@ -221,8 +278,8 @@ def generic_search_resolver(property, value, language, **kwargs):
     return results[0]['id'] if results else ''
 
 
-@cache.cached
 @resolver('P106')
+@cache.cached(ignored=('kwargs',))
 def profession_resolver(property, value, language, **kwargs):
     for occupation in value.split('/'):
         # Q28640 = profession, Q12737077 = occupation
@@ -234,8 +291,8 @@ def profession_resolver(property, value, language, **kwargs):
             logger.debug('could not find occupation %s', occupation)
 
 
-@cache.cached
 @resolver('P27')
+@cache.cached(ignored=('kwargs',))
 def nationality_resolver(property, value, language, **kwargs):
     """ Resolves nationalities (French --> France)
     """
@@ -269,8 +326,8 @@ def nationality_resolver(property, value, language, **kwargs):
     return country
 
 
-@cache.cached
 @resolver('P19', 'P20', 'P1444')
+@cache.cached(ignored=('kwargs',))
 def place_resolver(property, value, language, **kwargs):
     """ Resolves place names
     """
@@ -303,52 +360,97 @@ def honorifics_resolver(property, value, language, **kwargs):
     }.get(value.strip().lower(), '')
 
 
+def get_index():
+    """ Returns the local index in use, according to :data:`INDEX` """
+    global _index
+    if _index is None or _index.path != INDEX:
+        _index = WikidataIndex(INDEX)
+    return _index
+
+
 def call_api(action, cache=True, **kwargs):
-    """ Invoke the given method of wikidata APIs with the given parameters
+    """ Invoke the given method of wikidata APIs with the given parameters.
+        Responses are cached in the namespace `wikidata.<action>`
     """
     kwargs['format'] = 'json'
     kwargs['action'] = action
-    resp = io.get_and_cache(WIKIDATA_API_URL, use_cache=cache, params=kwargs)
+    resp = io.get_and_cache(WIKIDATA_API_URL, use_cache=cache,
+                            namespace='wikidata.' + action, params=kwargs)
     return json.loads(resp)
 
 
-def search(term, language, type_=None, label_exact=True, limit='15'):
-    """ Uses the wikidata APIs to search for a term. Can optionally specify a type
-        (corresponding to the 'instance of' P31 wikidata property. If no type is
-        specified simply returns all the items containing `term` in `label`
+def call_api_many(action, params, use_cache=True, threads=8):
+    """ Invokes the given method of wikidata APIs once for each set of parameters,
+        sending the requests concurrently. Responses are cached in the namespace
+        `wikidata.<action>`
 
-        :param str term: The term to look for
-        :param str language: Search in this language
-        :param iterable type_: Type of the entity to look for, wikidata numeric id (i.e. without starting Q)
-         Can be int or anything iterable
-        :param bool label_exact: Filter entities whose labels matches exactly the search term
-        :param str limit: How many results to return at most
-        :returns: List of dicts with details (which details depend on `type_`)
-        :rtype: list of dicts
+        :param action: The method to invoke
+        :param params: List of dictionaries with the parameters of each call
+        :param use_cache: Whether to use the cache
+        :param threads: How many calls to perform at the same time
+        :return: The responses, in the same order as the parameters
+        :rtype: list
+        :raises requests.HTTPError: if any of the calls fails
     """
-    term = term.strip().lower()
-    results = call_api('wbsearchentities', search=term, language=language, limit=limit).get('search', [])
-    logger.debug('found %d entities with term "%s"', len(results), term)
-
-    titles = call_api('query', list='search', srsearch=term, srlimit=limit).get('query', {}).get('search', [])
-    logger.debug('found %d pages with term "%s"', len(titles), term)
+    if not params:
+        return []
+
+    calls = [(WIKIDATA_API_URL, {'params': dict(each, format='json', action=action)})
+             for each in params]
+    positions = {id(call): i for i, call in enumerate(calls)}
+    responses = [None] * len(calls)
+    for call, content, error in io.get_many_and_cache(calls, use_cache=use_cache, threads=threads,
+                                                      namespace='wikidata.' + action):
+        if error is not None:
+            raise error
+        responses[positions[id(call)]] = json.loads(content)
+    return responses
+
+
+def get_entities_details(ids, use_cache=True):
+    """ Retrieves the claims and labels of the given entities, asking for
+        :data:`ENTITIES_BATCH` of them at a time. Entities are cached one by
+        one in the namespace `wikidata.entities`, so that they are retrieved
+        only once no matter which searches found them
+
+        :param ids: Wikidata IDs of the entities
+        :param use_cache: Whether to use the cache
+        :return: dict ID -> entity, without the entities which do not exist
+        :rtype: dict
+    """
+    details, missing = {}, []
+    for each in set(ids):
+        entity = cache.get(each, namespace='wikidata.entities', negative=cache.NEGATIVE) \
+            if use_cache else None
+        if entity is None:
+            missing.append(each)
+        elif entity is not cache.NEGATIVE:
+            details[each] = entity
+
+    missing.sort()
+    batches = ['|'.join(missing[i:i + ENTITIES_BATCH]) for i in xrange(0, len(missing), ENTITIES_BATCH)]
+    responses = call_api_many('wbgetentities', [{'ids': batch, 'props': 'claims|labels'} for batch in batches],
+                              use_cache=False)
+
+    for response in responses:
+        for eid, entity in response.get('entities', {}).iteritems():
+            if 'missing' in entity:
+                if use_cache:
+                    cache.set_negative(eid, namespace='wikidata.entities')
+                continue
+            elif use_cache:
+                cache.set(eid, entity, namespace='wikidata.entities')
+            details[eid] = entity
 
-    for each in titles:
-        title = each['title']
-        entities = call_api('wbsearchentities', search=title, language=language, limit=limit).get('search', [])
-        results.extend(entities)
+    logger.debug('retrieved %d entities with %d calls, %d were cached',
+                 len(details), len(batches), len(details) - len(missing))
+    return details
 
-    logger.debug('obtained %d entities for "%s"', len(results), term)
-    if type_:
-        if not isinstance(type_, (list, set)):
-            type_ = set([type_])
-        else:
-            type_ = set(type_)
 
-    ids = '|'.join(r['id'] for r in results)
-    details = call_api('wbgetentities', ids=ids, props='claims|labels')
+def _refine(term, entities, language, type_, label_exact):
+    """ Keeps the entities of the given types and, optionally, whose label is the term """
     results = []
-    for eid, entity in details.get('entities', {}).iteritems():
+    for entity in entities:
         entity_type = entity.get('claims', {}).get('P31', [])
         if type_ and not any(t['mainsnak']['datavalue']['value']['numeric-id'] in type_ for t in entity_type):
             continue
@@ -374,6 +476,150 @@ def search(term, language, type_=None, label_exact=True, limit='15'):
     return results
 
 
+def _search_api(terms, language, limit):
+    """ Finds the entities matching the given terms using the APIs, see :func:`search_many`
+
+        :return: dict term -> list of entities
+        :rtype: dict
+    """
+    found = call_api_many('wbsearchentities', [{'search': term, 'language': language, 'limit': limit}
+                                               for term in terms])
+    pages = call_api_many('query', [{'list': 'search', 'srsearch': term, 'srlimit': limit}
+                                    for term in terms])
+
+    titles = [[each['title'] for each in response.get('query', {}).get('search', [])]
+              for response in pages]
+    unique_titles = sorted(set(title for each in titles for title in each))
+    found_by_title = dict(zip(unique_titles, call_api_many(
+        'wbsearchentities', [{'search': title, 'language': language, 'limit': limit}
+                             for title in unique_titles]
+    )))
+    logger.debug('searched %d terms and %d distinct pages', len(terms), len(unique_titles))
+
+    ids = {}
+    for term, response, term_titles in zip(terms, found, titles):
+        results = response.get('search', [])
+        logger.debug('found %d entities and %d pages with term "%s"', len(results), len(term_titles), term)
+        for title in term_titles:
+            results.extend(found_by_title[title].get('search', []))
+
+        ids[term] = []
+        for each in results:
+            if each['id'] not in ids[term]:
+                ids[term].append(each['id'])
+        logger.debug('obtained %d entities for "%s"', len(ids[term]), term)
+
+    details = get_entities_details(eid for each in ids.itervalues() for eid in each)
+    return {term: [details[eid] for eid in ids[term] if eid in details] for term in terms}
+
+
+def _search_index(terms, language):
+    """ Finds the entities whose label or alias is one of the given terms
+        using the local index, see :data:`INDEX`
+
+        :return: dict term -> list of entities
+        :rtype: dict
+    """
+    found = get_index().lookup(terms, language)
+    results = {}
+    for term in terms:
+        results[term] = found[term.decode('utf8') if isinstance(term, str) else term]
+        logger.debug('found %d entities with term "%s" in the local index', len(results[term]), term)
+    return results
+
+
+def search_many(terms, language, type_=None, label_exact=True, limit='15'):
+    """ Same as :func:`search`, for many terms at once. The calls are performed
+        concurrently and batched: the pages found for more than one term are
+        searched only once, and the details of all the entities are retrieved
+        together, so that the whole batch needs few round-trips
+
+        :param iterable terms: The terms to look for
+        :return: dict term -> list of dicts with details, the terms are
+         stripped and lowercased
+        :rtype: dict
+    """
+    terms = sorted(set(term.strip().lower() for term in terms))
+    if INDEX:
+        found = _search_index(terms, language)
+    else:
+        found = _search_api(terms, language, limit)
+
+    if type_:
+        if not isinstance(type_, (list, set)):
+            type_ = set([type_])
+        else:
+            type_ = set(type_)
+
+    return {term: _refine(term, found[term], language, type_, label_exact) for term in terms}
+
+
+def search(term, language, type_=None, label_exact=True, limit='15'):
+    """ Uses the wikidata APIs to search for a term. Can optionally specify a type
+        (corresponding to the 'instance of' P31 wikidata property. If no type is
+        specified simply returns all the items containing `term` in `label`.
+        See :func:`search_many` to search many terms at once. If a local index
+        is in use (see :data:`INDEX`) only the items whose label or alias is
+        `term` are found
+
+        :param str term: The term to look for
+        :param str language: Search in this language
+        :param iterable type_: Type of the entity to look for, wikidata numeric id (i.e. without starting Q)
+         Can be int or anything iterable
+        :param bool label_exact: Filter entities whose labels matches exactly the search term
+        :param str limit: How many results to return at most
+        :returns: List of dicts with details (which details depend on `type_`),
+         in order of relevance
+        :rtype: list of dicts
+    """
+    return search_many([term], language, type_, label_exact, limit)[term.strip().lower()]
+
+
+def resolver_terms(property, value):
+    """ Finds the terms which the resolver of the given property searches
+        to resolve the given value, if any, see :func:`prefetch`
+    """
+    if property == 'P106':
+        return value.split('/')
+    elif property in {'P21', 'P19', 'P20', 'P1444'}:
+        return [value]
+    else:
+        return []
+
+
+def prefetch(items, terms, language, batch_size=100):
+    """ Iterates over the given items, searching in advance all the terms of
+        each batch of them with :func:`search_many`. The searches performed later
+        on while processing the items then find the results in the cache
+
+        :param items: Iterable of items
+        :param terms: Function returning the terms which will be searched
+         when processing an item
+        :param language: Search in this language
+        :param batch_size: How many items to look ahead, 0 to not search in advance
+        :rtype: generator
+    """
+    if batch_size <= 0:
+        for item in items:
+            yield item
+        return
+
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+
+        batch_terms = [term for item in batch for term in terms(item) if term and term.strip()]
+        try:
+            search_many(batch_terms, language)
+        except requests.RequestException as e:
+            logger.warn('could not search %d terms in advance: %s', len(batch_terms), e)
+
+        for item in batch:
+            yield item
+
+
 def finalize_statement(subject, property, value, language, url=None, qualifiers=None,
                        resolve_property=True, resolve_value=True, **kwargs):
     """ Given the components of a statement, convert it into a quick statement.
@@ -0,0 +1,211 @@
+# -*- encoding: utf-8 -*-
+""" Local index of the labels and aliases of Wikidata entities, built from a
+    JSON dump (https://www.wikidata.org/wiki/Wikidata:Database_download) or
+    from a subset of it in the same format, one entity per line. It maps
+    labels and aliases to the entities, which are stored with their labels
+    and the claims needed by the resolvers, so that :func:`wikidata.search`
+    can find them without using the network, see :data:`wikidata.INDEX`.
+
+    The index is a SQLite database. Entities are ordered by how many sitelinks
+    they have, the most popular first.
+
+    Sample usage:
+
+    >>> import tempfile
+    >>> from strephit.commons.wikidata_index import WikidataIndex
+    >>> dump = tempfile.mktemp()
+    >>> with open(dump, 'w') as f:
+    ...     f.write('[\\n{"id": "Q90", "labels": {"en": {"language": "en", "value": "Paris"}}, '
+    ...             '"aliases": {"en": [{"language": "en", "value": "City of Light"}]}, '
+    ...             '"claims": {}, "sitelinks": {}}\\n]\\n')
+    >>> index = WikidataIndex.build(dump, tempfile.mktemp(), ['en'])
+    >>> [entity['id'] for entity in index.lookup(['city of light'], 'en')['city of light']]
+    [u'Q90']
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import sqlite3
+from functools import partial
+
+import click
+
+from strephit.commons import codec, io, parallel
+
+logger = logging.getLogger(__name__)
+
+# claims kept in the index, the ones used by the resolvers to disambiguate
+KEY_PROPERTIES = {
+    'P19', 'P20', 'P21', 'P22', 'P25', 'P26', 'P27', 'P31', 'P40', 'P106',
+    'P166', 'P551', 'P569', 'P570', 'P1035', 'P1038',
+}
+
+# most entities returned for each term, the most popular ones are kept
+MAX_CANDIDATES = 250
+
+# most parameters of a single SQLite query
+_QUERY_BATCH = 500
+
+
+def _claim(claim):
+    """ Keeps only the value of a claim, None if it has no value """
+    datavalue = claim.get('mainsnak', {}).get('datavalue')
+    return {'mainsnak': {'datavalue': datavalue}} if datavalue else None
+
+
+def parse_entity(line, languages):
+    """ Parses an entity of a JSON dump, reducing it to what the index needs
+
+        :param str line: Line of the dump
+        :param set languages: Languages of the labels and aliases to keep
+        :return: Tuple (entity, number of sitelinks, terms) where terms are
+         tuples (language, lowercase label or alias), or None if the line
+         is not an entity
+        :rtype: tuple
+    """
+    line = line.strip().rstrip(',')
+    if not line or line in {'[', ']'}:
+        return None
+
+    entity = codec.loads(line)
+    labels = {language: {'value': label['value']}
+              for language, label in entity.get('labels', {}).iteritems()
+              if language in languages}
+
+    terms = set((language, label['value'].lower()) for language, label in labels.iteritems())
+    for language, aliases in entity.get('aliases', {}).iteritems():
+        if language in languages:
+            terms.update((language, alias['value'].lower()) for alias in aliases)
+
+    claims = {}
+    for property, values in entity.get('claims', {}).iteritems():
+        if property in KEY_PROPERTIES:
+            values = filter(None, map(_claim, values))
+            if values:
+                claims[property] = values
+
+    reduced = {'id': entity['id'], 'labels': labels, 'claims': claims}
+    return reduced, len(entity.get('sitelinks', {})), sorted(terms)
+
+
+def _parse_batch(lines, languages):
+    return filter(None, (parse_entity(line, languages) for line in lines))
+
+
+class WikidataIndex(object):
+    """ Looks up Wikidata entities by label or alias in a local index
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError("Wikidata index '%s' does not exist" % path)
+
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # sqlite connections cannot be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path)
+            self._pid = os.getpid()
+        return self._connection
+
+    @classmethod
+    def build(cls, dump, path, languages, processes=0, batch_size=1000):
+        """ Builds the index from a dump, replacing the existing one, if any
+
+            :param dump: Path of the dump, optionally compressed,
+             see :func:`io.read_lines`
+            :param path: Path of the index
+            :param languages: Languages of the labels and aliases to index
+            :param processes: How many processes to use to parse the dump
+            :param batch_size: How many entities each process parses at a time
+            :return: The index
+            :rtype: WikidataIndex
+        """
+        languages = frozenset(languages)
+        building = path + '.tmp'
+        if os.path.exists(building):
+            os.remove(building)
+
+        connection = sqlite3.connect(building)
+        connection.execute('PRAGMA journal_mode=OFF')
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE entities (id TEXT PRIMARY KEY, sitelinks INTEGER, data TEXT)')
+        connection.execute('CREATE TABLE terms (language TEXT, term TEXT, id TEXT, '
+                           'PRIMARY KEY (language, term, id))')
+
+        def batches():
+            with open(dump) as f:
+                for batch in parallel.make_batches(io.read_lines(dump, f), batch_size):
+                    yield batch
+
+        count = 0
+        for parsed in parallel.map(partial(_parse_batch, languages=languages), batches(), processes):
+            connection.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)', (
+                (entity['id'], sitelinks, json.dumps(entity)) for entity, sitelinks, _ in parsed
+            ))
+            connection.executemany('INSERT OR IGNORE INTO terms VALUES (?, ?, ?)', (
+                (language, term, entity['id']) for entity, _, terms in parsed for language, term in terms
+            ))
+            connection.commit()
+
+            count += len(parsed)
+            if count % 100000 < len(parsed):
+                logger.info('Indexed %d entities', count)
+
+        connection.commit()
+        connection.close()
+        os.rename(building, path)
+        logger.info("Indexed %d entities in '%s'", count, path)
+        return cls(path)
+
+    def lookup(self, terms, language):
+        """ Finds the entities having any of the given terms as label or alias
+
+            :param terms: The terms to look for, compared case-insensitively
+            :param language: Language of the labels and aliases
+            :return: dict term -> list of entities, in the same format as the
+             Wikidata APIs with only labels and the claims in :data:`KEY_PROPERTIES`,
+             the most popular first. The terms are lowercased
+            :rtype: dict
+        """
+        terms = sorted(set(
+            (term.decode('utf8') if isinstance(term, str) else term).lower() for term in terms
+        ))
+
+        found = {term: [] for term in terms}
+        for i in xrange(0, len(terms), _QUERY_BATCH):
+            batch = terms[i:i + _QUERY_BATCH]
+            rows = self.connection.execute(
+                'SELECT terms.term, entities.data FROM terms JOIN entities ON entities.id = terms.id '
+                'WHERE terms.language = ? AND terms.term IN (%s) '
+                'ORDER BY entities.sitelinks DESC, entities.id' % ', '.join('?' * len(batch)),
+                [language] + batch
+            )
+
+            for term, data in rows:
+                if len(found[term]) < MAX_CANDIDATES:
+                    found[term].append(json.loads(data))
+
+        return found
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+
+@click.command()
+@click.argument('dump', type=click.Path(exists=True, dir_okay=False))
+@click.argument('outfile', type=click.Path(dir_okay=False))
+@click.option('--language', '-l', multiple=True, default=['en'],
+              help='Index labels and aliases in this language, can be repeated')
+@click.option('--processes', '-p', default=0)
+def main(dump, outfile, language, processes):
+    """ Builds a local index of Wikidata labels and aliases from a JSON dump.
+        Use it with the global --wikidata-index option
+    """
+    index = WikidataIndex.build(dump, outfile, language, processes)
+    logger.info('The index contains %d entities', len(index))
@@ -1,12 +1,14 @@
 import click
 
-from strephit.corpus_analysis import extract_framenet_frames, rank_verbs, compute_lu_distribution, statistics
+from strephit.corpus_analysis import extract_framenet_frames, rank_verbs, compute_lu_distribution, statistics, \
+    test_pos_taggers
 
 CLI_COMMANDS = {
     'extract_framenet_frames': extract_framenet_frames.main,
     'rank_verbs': rank_verbs.main,
     'compute_lu_distribution': compute_lu_distribution.main,
     'find_statistics': statistics.main,
+    'compare_pos_taggers': test_pos_taggers.main,
 }
 
 
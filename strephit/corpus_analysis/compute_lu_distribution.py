@@ -4,19 +4,31 @@ from itertools import imap
 from collections import defaultdict, OrderedDict
 
 import click
+import numpy as np
 from nltk.parse.stanford import StanfordParser
 from nltk.tree import Tree
 
 from strephit.commons.split_sentences import PunktSentenceSplitter
 from strephit.commons.io import load_corpus
-from strephit.commons.pos_tag import TTPosTagger
-from strephit.commons import parallel
+from strephit.commons.pos_tag import get_pos_tagger
+from strephit.commons import parallel, columnar
 
 logger = logging.getLogger(__name__)
 # some globals for the workers (some of them cannot be pickled)
 splitter = tagger = all_verbs = parser = None
 
 
+def setup_worker():
+    """ Builds the resources used by the workers, each worker gets its own
+    """
+    global splitter, tagger, parser
+    splitter = PunktSentenceSplitter('en')
+    tagger = get_pos_tagger('en')
+    parser = StanfordParser(path_to_jar='dev/stanford-corenlp-3.6.0.jar',
+                            path_to_models_jar='dev/stanford-corenlp-3.6.0-models.jar',
+                            java_options=' -mx1G -Djava.ext.dirs=dev/')  # no way to make classpath work
+
+
 def worker_with_sub_sentences(bio):
     """ Produces an histogram counting the number of verbs
         for each phrase appearing in the biography
@@ -68,12 +80,8 @@ def worker_with_sentences(bio):
         :type: dict
     """
     counter = defaultdict(int)
-    for sent in splitter.split(bio):
-        sent = sent.strip().lower()
-        if len(sent) < 5:
-            continue
-
-        tagged = tagger.tag_one(sent)
+    sentences = [sent.strip().lower() for sent in splitter.split(bio)]
+    for tagged in tagger.tag_sentences(sent for sent in sentences if len(sent) >= 5):
         if not tagged:
             continue
 
@@ -83,6 +91,43 @@ def worker_with_sentences(bio):
     return counter
 
 
+def _lus_per_sentence(reader, start, end, verbs):
+    """ Produces an histogram counting the number of verbs for each sentence
+        in a range of a columnar POS-tagged corpus, as :func:`worker_with_sentences`
+        does: verbs are compared in lower case, and sentences shorter than 5
+        characters, with a space between the tokens, are skipped. The result
+        differs where the tags themselves do, as sentences end with the tags
+        of sentence-final punctuation rather than where the sentence splitter
+        splits them, and the corpus was tagged without lowercasing the text
+
+        :param reader: The columnar corpus
+        :param start: First tag of the range
+        :param end: Last tag of the range, excluded
+        :param verbs: The verbs to count, lower case
+        :return: histogram of frequencies, the n-th element is how many
+         sentences have n verbs
+        :type: numpy.ndarray
+    """
+    lower = columnar.Vocabulary()
+    lower_ids = reader.lookup('token', lambda token: lower.id(token.lower()), name='lower')
+    lengths = reader.lookup('token', len, name='length')
+    is_lu = reader.lookup('token', lambda token: token.lower() in verbs,
+                          name='lu:%d' % hash(frozenset(verbs)))
+    is_verb = reader.lookup('pos', lambda pos: pos.startswith('V'), name='verb')
+
+    tokens = reader.columns['token'][start:end]
+    mask = is_verb[reader.columns['pos'][start:end]] & is_lu[tokens]
+    sentences = reader.sentence_ids(start, end)
+    sentences -= sentences[0]
+    characters = np.bincount(sentences, weights=lengths[tokens] + 1) - 1
+
+    # count distinct verbs only
+    size = int(lower_ids.max()) + 1 if len(lower_ids) else 1
+    pairs = np.unique(sentences[mask] * size + lower_ids[tokens[mask]])
+    lus = np.bincount(pairs // size, minlength=sentences[-1] + 1)
+    return np.bincount(lus[characters >= 5], minlength=1)
+
+
 @click.command()
 @click.argument('corpus', type=click.Path(exists=True))
 @click.argument('verbs', type=click.File('r'))
@@ -90,28 +135,32 @@ def worker_with_sentences(bio):
 @click.option('--processes', '-p', default=0)
 @click.option('--outfile', '-o', default='output/lus_per_sent.json', type=click.File('w'))
 def main(corpus, verbs, processes, outfile, sub_sentences):
-    """ Compute the LU distribution in the corpus, i.e. how many LUs per sentence
+    """ Compute the LU distribution in the corpus, i.e. how many LUs per sentence.
+        A POS-tagged corpus in columnar format is analyzed directly, without splitting
+        and tagging it again, unless sub-sentences are requested
     """
-    global splitter, tagger, parser, all_verbs
-    splitter = PunktSentenceSplitter('en')
-    tagger = TTPosTagger('en')
-    parser = StanfordParser(path_to_jar='dev/stanford-corenlp-3.6.0.jar',
-                            path_to_models_jar='dev/stanford-corenlp-3.6.0-models.jar',
-                            java_options=' -mx1G -Djava.ext.dirs=dev/')  # no way to make classpath work
+    global all_verbs
     all_verbs = reduce(lambda x, y: x.union(y), imap(set, json.load(verbs).values()), set())
     all_verbs.discard('be')
     all_verbs.discard('have')
 
-    args = load_corpus(corpus, 'bio', text_only=True)
-    worker = worker_with_sub_sentences if sub_sentences else worker_with_sentences
     counter = defaultdict(int)
-
-    for i, counts in enumerate(parallel.map(worker, args, processes)):
-        for k, v in counts.iteritems():
-            counter[k] += v
-
-        if (i + 1) % 10000 == 0:
-            logger.info('Processed %d documents', i + 1)
+    if columnar.is_columnar(corpus) and not sub_sentences:
+        for counts in columnar.map_sentences(corpus, _lus_per_sentence, (all_verbs,), processes):
+            for k, v in enumerate(counts.tolist()):
+                if v:
+                    counter[k] += v
+    else:
+        args = load_corpus(corpus, 'bio', text_only=True)
+        worker = worker_with_sub_sentences if sub_sentences else worker_with_sentences
+
+        for i, counts in enumerate(parallel.map(worker, args, processes,
+                                                initializer=setup_worker)):
+            for k, v in counts.iteritems():
+                counter[k] += v
+
+            if (i + 1) % 10000 == 0:
+                logger.info('Processed %d documents', i + 1)
 
     counter = OrderedDict(sorted(counter.items(), key=lambda (k, v): k))
     for k, v in counter.iteritems():
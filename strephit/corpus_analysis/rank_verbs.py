@@ -5,6 +5,7 @@ import json
 import logging
 from collections import defaultdict, OrderedDict
 from sys import exit
+import numpy as np
 from numpy import average
 
 import click
@@ -12,7 +13,7 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import linear_kernel
 
 from strephit.commons.io import load_corpus, load_scraped_items
-from strephit.commons import parallel
+from strephit.commons import parallel, columnar
 
 logger = logging.getLogger(__name__)
 
@@ -40,18 +41,59 @@ def get_similarity_scores(verb_token, vectorizer, tf_idf_matrix):
     return scores
 
 
-def produce_lemma_tokens(pos_tagged_path, pos_tag_key, language):
+def _is_columnar(pos_tagged_path, pos_tag_key):
+    """ Whether the pos-tagged corpus is in columnar format with the tags in the given key """
+    return (columnar.is_columnar(pos_tagged_path) and
+            columnar.open_reader(pos_tagged_path).key == pos_tag_key)
+
+
+def _verbs_mask(reader, start, end, prefix):
+    """ Finds the tags in a range of a columnar corpus whose POS starts with the given prefix """
+    verbal = reader.lookup('pos', lambda pos: pos.startswith(prefix), name='pos:' + prefix)
+    return verbal[reader.columns['pos'][start:end]]
+
+
+def _verb_lemma_tokens(reader, start, end, prefix):
+    """ Finds the distinct pairs of lemma and token IDs of the verbs in a range of a
+        columnar corpus, encoded as `lemma * len(tokens) + token`
+    """
+    mask = _verbs_mask(reader, start, end, prefix)
+    return np.unique(reader.columns['lemma'][start:end][mask].astype(np.int64) *
+                     len(reader.vocabularies['token']) + reader.columns['token'][start:end][mask])
+
+
+def _count_verb_lemmas(reader, start, end):
+    """ Counts how many times each lemma is used as a verb in a range of a columnar corpus """
+    mask = _verbs_mask(reader, start, end, 'V')
+    return np.bincount(reader.columns['lemma'][start:end][mask],
+                       minlength=len(reader.vocabularies['lemma']))
+
+
+def produce_lemma_tokens(pos_tagged_path, pos_tag_key, language, processes=1):
     """ Extracts a map from lemma to all its tokens
 
-        :param str pos_tagged_path: path of the pos-tagged corpus
+        :param str pos_tagged_path: path of the pos-tagged corpus, either
+         jsonlines or columnar
         :param str pos_tag_key: where the pos tag data is in each item
         :param language: language of the corpus
+        :param int processes: how many processes to use for a columnar corpus
         :return: mapping from lemma to tokens
         :rtype: dict
     """
-    corpus = load_scraped_items(pos_tagged_path)
     lemma_tokens = defaultdict(set)
 
+    if _is_columnar(pos_tagged_path, pos_tag_key):
+        reader = columnar.open_reader(pos_tagged_path)
+        partial = columnar.map_sentences(pos_tagged_path, _verb_lemma_tokens,
+                                         (VERBAL_PREFIXES[language],), processes)
+        pairs = np.unique(np.concatenate(list(partial) or [np.empty(0, np.int64)]))
+
+        tokens, lemmas = reader.vocabularies['token'], reader.vocabularies['lemma']
+        for lemma, token in zip(*np.divmod(pairs, max(len(tokens), 1))):
+            lemma_tokens[lemmas[lemma].lower()].add(tokens[token].lower())
+        return lemma_tokens
+
+    corpus = load_scraped_items(pos_tagged_path)
     for item in corpus:
         for token, pos, lemma in item.get(pos_tag_key, []):
             if pos.startswith(VERBAL_PREFIXES[language]):
@@ -122,7 +164,10 @@ class PopularityRanking:
     """
 
     def __init__(self, corpus_path, pos_tag_key):
-        self.tags = self._flatten(item.get(pos_tag_key) for item in load_scraped_items(corpus_path))
+        self.corpus_path = corpus_path
+        self.is_columnar = _is_columnar(corpus_path, pos_tag_key)
+        if not self.is_columnar:
+            self.tags = self._flatten(item.get(pos_tag_key) for item in load_scraped_items(corpus_path))
 
     @staticmethod
     def _flatten(iterable):
@@ -150,14 +195,28 @@ class PopularityRanking:
                 scores[lemma.lower()] += 1
         return scores
 
+    def score_columnar(self, processes=0):
+        """ Counts the verbal lemmas of a columnar corpus, in parallel """
+        lemmas = columnar.open_reader(self.corpus_path).vocabularies['lemma']
+        counts = sum(columnar.map_sentences(self.corpus_path, _count_verb_lemmas,
+                                            processes=processes), np.zeros(len(lemmas), np.int64))
+
+        scores = defaultdict(int)
+        for lemma in np.flatnonzero(counts):
+            scores[lemmas[lemma].lower()] += int(counts[lemma])
+        return scores
+
     def find_ranking(self, processes=0, bulk_size=10000, normalize=True):
-        ranking = defaultdict(int)
-        for score in parallel.map(self.score_from_tokens,
-                                  self._bulkenize(self.tags, bulk_size),
-                                  processes):
+        if self.is_columnar:
+            ranking = self.score_columnar(processes)
+        else:
+            ranking = defaultdict(int)
+            for score in parallel.map(self.score_from_tokens,
+                                      self._bulkenize(self.tags, bulk_size),
+                                      processes):
 
-            for k, v in score.iteritems():
-                ranking[k] += v
+                for k, v in score.iteritems():
+                    ranking[k] += v
 
         ranking = OrderedDict(sorted(ranking.items(), key=lambda x: x[1], reverse=True))
 
@@ -193,7 +252,7 @@ def harmonic_ranking(*rankings):
 
 
 @click.command()
-@click.argument('pos_tagged', type=click.Path(exists=True, dir_okay=False))
+@click.argument('pos_tagged', type=click.Path(exists=True))
 @click.argument('document_key')
 @click.argument('language')
 @click.option('--pos-tag-key', default='pos_tag')
@@ -45,8 +45,8 @@ def about_sources(corpus, processes, with_bio):
         return sources
 
     aggregated_sources = defaultdict(int)
-    corpus = parallel.make_batches(load_scraped_items(corpus), 1000)
-    for sources in parallel.map(worker, corpus, processes):
+    for sources in parallel.map(worker, load_scraped_items(corpus), processes,
+                                batch_size='auto'):
         for k, v in sources.iteritems():
             aggregated_sources[k] += v
 
@@ -3,75 +3,129 @@
 
 import json
 import logging
+from difflib import SequenceMatcher
 from sys import exit
 from time import time
 
 import click
-from nltk import pos_tag, word_tokenize
-from treetaggerwrapper import TreeTagger, make_tags
+from treetaggerwrapper import TreeTaggerError
+
+from strephit.commons import pos_tag
+from strephit.commons.io import load_scraped_items
 
 logger = logging.getLogger(__name__)
 
 
-def tag(text, tt_home):
-    # Default NLTK's tokenizer
-    # TreebankWordTokenizer + PunktSentenceTokenizer
-    nltk_start = time()
-    tokens = word_tokenize(text)
-    # Default NLTK's POS tagger
-    # ?
-    # Use tagset='universal' for universal tagset
-    nltk_tagged = pos_tag(tokens)
-    nltk_end = time()
-    nltk_execution = nltk_end - nltk_start
-    logger.info("NLTK took %f seconds" % nltk_execution)
-
-    # TreeTagger wrapper
-    # Tokenization: ?
-    # Default language: English
-    # English: trained on Penn treebank
-    # Default flags: -token -lemma -sgml -quiet -no-unknown
-    tt_start = time()
-    tt = TreeTagger(TAGDIR=tt_home)
-    raw_tags = tt.tag_text(text)
-    tt_end = time()
-    tt_execution = tt_end - tt_start
-    tt_tagged = make_tags(raw_tags)
-    logger.info("TreeTagger took %f seconds" % tt_execution)
-    return (nltk_tagged, nltk_execution), (tt_tagged, tt_execution)
+def get_taggers(language, tt_home, model):
+    """ Builds the taggers to compare, skipping the ones which are not available
+
+        :return: dict name -> function tagging a text, returning tuples (token, pos, lemma)
+         or (token, pos) if the tagger does not lemmatize
+        :rtype: dict
+    """
+    taggers = {}
+    try:
+        tt = pos_tag.TTPosTagger(language, tt_home)
+        taggers['TreeTagger'] = lambda text: tt.tag_one(text, skip_unknown=False)
+    except TreeTaggerError as e:
+        logger.warn('TreeTagger is not available: %s', e)
+
+    try:
+        perceptron = pos_tag.PerceptronPosTagger(language, model)
+        taggers['perceptron'] = lambda text: perceptron.tag_one(text, skip_unknown=False)
+    except IOError as e:
+        logger.warn('The perceptron tagger has no model: %s', e)
+
+    # Default NLTK's tokenizer and POS tagger, Penn treebank tagset
+    nltk = pos_tag.NLTKPosTagger(language)
+    try:
+        nltk.tag_one(u'test', None)
+        taggers['NLTK'] = lambda text: nltk.tag_one(text, None)
+    except LookupError as e:
+        logger.warn('The NLTK tagger has no data: %s', e)
+
+    return taggers
+
+
+def compare(reference, tagged):
+    """ Compares tags with the reference ones. Tokens are aligned first,
+        as different taggers may split the text differently
+
+        :param reference: The reference tags, tuples (token, pos, lemma)
+        :param tagged: The tags to evaluate, tuples (token, pos, lemma) or (token, pos)
+        :return: How many tokens of the reference got the same POS tag and the same lemma
+        :rtype: tuple
+    """
+    same_pos = same_lemma = 0
+    matcher = SequenceMatcher(None, [tag[0] for tag in reference],
+                              [tag[0] for tag in tagged], autojunk=False)
+    for i, j, size in matcher.get_matching_blocks():
+        for expected, actual in zip(reference[i:i + size], tagged[j:j + size]):
+            if expected[1] == actual[1]:
+                same_pos += 1
+            if len(actual) > 2 and expected[2] == actual[2]:
+                same_lemma += 1
+    return same_pos, same_lemma
 
 
 @click.command()
-@click.argument('input-file', type=click.File('r'))
-@click.option('--outfile', '-o', type=click.File('w'), default='output/tagged.json')
-@click.option('--tt-home')
-def main(input_file, outfile, tt_home):
-    output = []
-    source = json.load(input_file)
-    logger.info("Loaded input file '%s'" % input_file.name)
-    nltk_total_execution = float()
-    tt_total_execution = float()
-    for item in source:
-        output_item = item
-        text = item.get('bio')
+@click.argument('corpus', type=click.Path(exists=True))
+@click.argument('document-key')
+@click.argument('language-code')
+@click.option('--reference-key', help='Compare with the tags already in the items under this key, '
+                                      'by default with the tags given by TreeTagger')
+@click.option('--model', type=click.Path(exists=True, dir_okay=False),
+              help='Model of the perceptron tagger')
+@click.option('--tt-home', type=click.Path(exists=True, resolve_path=True),
+              help='home directory for TreeTagger')
+@click.option('--limit', '-l', default=1000, help='How many documents to tag')
+@click.option('--outfile', '-o', type=click.File('w'), default='output/pos_taggers.json')
+def main(corpus, document_key, language_code, reference_key, model, tt_home, limit, outfile):
+    """ Compares the accuracy and the throughput of the available POS taggers,
+        taking TreeTagger as reference
+    """
+    # time the taggers, not the cache
+    pos_tag.CACHE = False
+    taggers = get_taggers(language_code, tt_home, model)
+    if not reference_key and 'TreeTagger' not in taggers:
+        raise click.UsageError('TreeTagger is not available, use --reference-key')
+
+    results = {name: {'seconds': 0.0, 'tokens': 0, 'same_pos': 0, 'same_lemma': 0}
+               for name in taggers}
+    documents = total = 0
+    for item in load_scraped_items(corpus):
+        text = item.get(document_key)
         if not text:
-            logger.info("No bio for '%s'. Skipping ..." % item.get('name'))
             continue
-        else:
-            (nltk_tagged, nltk_execution), (tt_tagged, tt_execution) = tag(text, tt_home)
-            nltk_total_execution += nltk_execution
-            tt_total_execution += tt_execution
-            logger.debug("NLTK output: %s" % nltk_tagged)
-            logger.debug("TreeTagger output: %s" % tt_tagged)
-            output_item['nltk'] = nltk_tagged
-            output_item['TreeTagger'] = tt_tagged
-            output.append(output_item)
-
-    json.dump(output, outfile, indent=2)
-    logger.info("Tagged data dumped to '%s'" % outfile.name)
-    logger.info("Total items = %d" % len(source))
-    logger.info("NLTK total execution time = %f seconds" % nltk_total_execution)
-    logger.info("TreeTagger total execution time = %f seconds" % tt_total_execution)
+
+        tagged = {}
+        for name, tag in taggers.iteritems():
+            start = time()
+            tagged[name] = tag(text)
+            results[name]['seconds'] += time() - start
+            results[name]['tokens'] += len(tagged[name])
+
+        reference = item[reference_key] if reference_key else tagged['TreeTagger']
+        total += len(reference)
+        for name, tags in tagged.iteritems():
+            same_pos, same_lemma = compare(reference, tags)
+            results[name]['same_pos'] += same_pos
+            results[name]['same_lemma'] += same_lemma
+
+        documents += 1
+        if documents == limit:
+            break
+
+    logger.info('Tagged %d documents with %d reference tokens', documents, total)
+    for name, result in sorted(results.iteritems()):
+        result['tokens_per_second'] = result['tokens'] / result['seconds'] if result['seconds'] else 0
+        result['pos_accuracy'] = float(result['same_pos']) / total if total else 0
+        result['lemma_accuracy'] = float(result['same_lemma']) / total if total else 0
+        logger.info('%-10s  %8.0f tokens/second  POS accuracy %.4f  lemma accuracy %.4f',
+                    name, result['tokens_per_second'], result['pos_accuracy'], result['lemma_accuracy'])
+
+    json.dump(results, outfile, indent=2)
+    logger.info("Results dumped to '%s'" % outfile.name)
     return 0
 
 
@@ -1,9 +1,8 @@
 import logging
 from collections import defaultdict
 from urlparse import urlparse
-import json
 import click
-from strephit.commons import parallel
+from strephit.commons import parallel, io, codec
 import random
 
 
@@ -26,12 +25,12 @@ def lu_count(sentences, processes=0, input_encoded=False):
     def worker(batch):
         freqs = defaultdict(lambda: 0)
         for row in batch:
-            sentence = json.loads(row) if input_encoded else row
+            sentence = codec.loads(row) if input_encoded else row
 
-            parsed = urlparse(sentence['url'])
+            parsed = urlparse(sentence.get('url') or '')
             if not parsed.netloc:
-                logger.warn('cannot parse URL: %s', sentence['url'])
-                return
+                logger.warn('cannot parse URL: %s', sentence.get('url'))
+                continue
 
             lu = sentence['lu']
             freqs[(parsed.netloc, lu)] += 1
@@ -40,11 +39,30 @@ def lu_count(sentences, processes=0, input_encoded=False):
 
     frequencies = defaultdict(lambda: defaultdict(lambda: 0))
     for (source, lemma), count in parallel.map(worker, sentences, processes,
-                                               batch_size=100, flatten=True):
+                                               batch_size='auto', flatten=True):
         frequencies[source][lemma] += count
     return frequencies
 
 
+def lu_count_indexed(index):
+    """ Count how many sentences per LU there are for each source, using
+        the values of `url` and `lu` stored in the index of the corpus,
+        without reading the sentences themselves
+
+        :param JsonLinesIndex index: Index of the corpus, with the `url` and `lu` keys
+        :return: A dictionary source -> frequencies, where frequencies is
+         another dictionary lemma -> count
+    """
+    frequencies = defaultdict(lambda: defaultdict(lambda: 0))
+    for url, lu in zip(index.keys('url'), index.keys('lu')):
+        parsed = urlparse(url or '')
+        if not parsed.netloc:
+            logger.warn('cannot parse URL: %s', url)
+            continue
+        frequencies[parsed.netloc][lu] += 1
+    return frequencies
+
+
 def extract_sentences(sentences, probabilities, processes=0, input_encoded=False, output_encoded=False):
     """ Extracts some sentences from the corpus following the given probabilities
 
@@ -63,21 +81,21 @@ def extract_sentences(sentences, probabilities, processes=0, input_encoded=False
 
     def worker(batch):
         for row in batch:
-            sentence = json.loads(row) if input_encoded else row
-            parsed = urlparse(sentence['url'])
+            sentence = codec.loads(row) if input_encoded else row
+            parsed = urlparse(sentence.get('url') or '')
             if not parsed.netloc:
-                logger.warn('cannot parse URL: %s', sentence['url'])
-                return
+                logger.warn('cannot parse URL: %s', sentence.get('url'))
+                continue
 
             lu = sentence['lu']
             p = probabilities[(parsed.netloc, lu)]
 
             if random.random() < p:
-                yield parsed.netloc, lu, json.dumps(sentence) if output_encoded else sentence
+                yield parsed.netloc, lu, codec.dumps(sentence) if output_encoded else sentence
 
     counts = defaultdict(lambda: 0)
     for source, lu, sentence in parallel.map(worker, sentences, processes,
-                                             batch_size=100, flatten=True):
+                                             batch_size='auto', flatten=True):
         counts[(source, lu)] += 1
         yield sentence
 
@@ -97,13 +115,18 @@ def extract_sentences(sentences, probabilities, processes=0, input_encoded=False
 @click.option('--processes', '-p', default=0)
 @click.option('--outfile', '-o', type=click.File('w'),
               default='output/sentences_balanced.jsonlines')
-def main(sentences, sentences_per_lu, processes, outfile):
+@click.option('--index', is_flag=True, help='Count the LUs with the index of the sentences, '
+                                            'building it if needed')
+def main(sentences, sentences_per_lu, processes, outfile, index):
     """ Stochastically extracts sentences so that there are a given number
         of sentences for each LU equally spread amongst the different sources
     """
 
     logger.info('Obtaining the LU distribution amongst sources')
-    frequencies = lu_count(sentences, processes, input_encoded=True)
+    if index:
+        frequencies = lu_count_indexed(io.JsonLinesIndex.open(sentences.name, keys=('url', 'lu')))
+    else:
+        frequencies = lu_count(sentences, processes, input_encoded=True)
 
     number_of_sources = len(frequencies)
     number_of_lus = len(reduce(lambda x, y: x | y, map(set, frequencies.values())))
@@ -127,7 +150,8 @@ def main(sentences, sentences_per_lu, processes, outfile):
     logger.debug('Expect roughly %d sentences, unless some sources are lacking',
                  sentences_per_lu * number_of_lus)
 
-    sentences.seek(0)
+    if not index:
+        sentences.seek(0)
     count = 0
     for i, sentence in enumerate(extract_sentences(sentences, probabilities, processes,
                                                    input_encoded=True, output_encoded=True)):
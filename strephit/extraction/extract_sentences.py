@@ -12,10 +12,11 @@ from nltk.parse.stanford import StanfordParser
 from nltk.tree import Tree
 
 from strephit.commons.tokenize import Tokenizer
-from strephit.commons.pos_tag import TTPosTagger
+from strephit.commons.pos_tag import get_pos_tagger
 from strephit.commons.io import load_scraped_items
 from strephit.commons.split_sentences import PunktSentenceSplitter
-from strephit.commons import parallel
+from strephit.commons import parallel, codec, columnar, pos_tag
+from strephit.commons.checkpoint import Checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +25,8 @@ class SentenceExtractor:
     """ Base class for sentence extractors.
     """
 
-    def __init__(self, corpus, document_key, sentences_key, language, lemma_to_token, match_base_form):
+    def __init__(self, corpus, document_key, sentences_key, language, lemma_to_token, match_base_form,
+                 tag_document=True):
         """ Initializes the extractor.
 
             :param iterable corpus: The corpus, iterable of `dict`s
@@ -32,6 +34,8 @@ class SentenceExtractor:
             :param str sentences_key: The key to which the extracted sentences should be stored
             :param str language: The language the text is in
             :param dict lemma_to_token: Mapping from lemma to list of tokens
+            :param bool tag_document: Whether to POS-tag all the sentences of a document
+             at once or one by one, see :meth:`tag_sentences`
         """
         self.corpus = corpus
         self.sentences_key = sentences_key
@@ -40,7 +44,8 @@ class SentenceExtractor:
         self.language = language
         self.lemma_to_token = lemma_to_token if match_base_form else self._filter_base_form(lemma_to_token)
         self.tokenizer = Tokenizer(self.language)
-        self.tagger = TTPosTagger(self.language)
+        self.tagger = get_pos_tagger(self.language)
+        self.tag_document = tag_document
 
     def extract_from_item(self, item):
         """ Extract sentences from an item. Relies on `setup_extractor`
@@ -52,6 +57,23 @@ class SentenceExtractor:
         """
         raise NotImplementedError()
 
+    def tag_sentences(self, sentences, skip_unknown=True):
+        """ POS-Tags the sentences of a document, skipping the blank ones. When
+            `tag_document` is set the whole document is sent to TreeTagger at once,
+            otherwise each sentence is sent by itself. The tags are the same
+
+            :param list sentences: The sentences of the document
+            :param bool skip_unknown: Whether to remove the tags with unknown lemmas
+            :return: The sentences with their tags
+            :rtype: list of tuples (sentence, tags)
+        """
+        sentences = [sentence for sentence in sentences if sentence.strip()]
+        if self.tag_document:
+            tagged = self.tagger.tag_sentences(sentences, skip_unknown, batch_size=len(sentences) or 1)
+        else:
+            tagged = [self.tagger.tag_one(sentence, skip_unknown) for sentence in sentences]
+        return zip(sentences, tagged)
+
     def setup_extractor(self):
         """ Optional setup code, run before starting the extraction
         """
@@ -62,20 +84,31 @@ class SentenceExtractor:
         """
         pass
 
-    def extract(self, processes=0):
+    def setup_worker(self):
+        """ Setup code run by each worker process before extracting, when
+            using more than one process. TreeTagger runs in a subprocess,
+            so each worker needs its own tagger
+        """
+        self.tagger = get_pos_tagger(self.language)
+
+    def extract(self, processes=0, checkpoint=None):
         """ Processes the corpus extracting sentences from each item
             and storing them in the item itself.
 
             :param int processes: how many processes to use for parallel tagging
+            :param checkpoint: Optional :class:`Checkpoint` used to skip the items
+             already processed, sentence IDs continue from its count of outputs
             :return: the extracted sentences
             :type: generator of dicts
         """
         self.setup_extractor()
 
         try:
-            count = 0
-            for i, (item, extracted) in enumerate(parallel.map(self.extract_from_item,
-                                                               self.corpus, processes)):
+            count = checkpoint.outputs if checkpoint else 0
+            mapper = checkpoint.map if checkpoint else parallel.map
+            for i, (item, extracted) in enumerate(mapper(
+                    self.extract_from_item, self.corpus, processes, ordered=True,
+                    initializer=self.setup_worker if processes != 1 else None)):
 
                 if not item.get('name') or not item.get('url'):
                     logger.warn('Skipping item without name or URL')
@@ -143,11 +176,7 @@ class OneToOneExtractor(SentenceExtractor):
             document = '\n'.join(document)
 
         sentences = self.splitter.split(document)
-        for sentence in sentences:
-            if not sentence.strip():
-                continue
-
-            tagged = self.tagger.tag_one(sentence, skip_unknown=False)
+        for sentence, tagged in self.tag_sentences(sentences, skip_unknown=False):
             sentence_verbs = [token for token, pos, lemma in tagged if pos.startswith('V')]
 
             matched = []
@@ -192,11 +221,7 @@ class ManyToManyExtractor(SentenceExtractor):
             text = '\n'.join(text)
 
         sentences = self.splitter.split(text)
-        for sentence in sentences:
-            if not sentence.strip():
-                continue
-
-            tagged = self.tagger.tag_one(sentence, skip_unknown=False)
+        for sentence, tagged in self.tag_sentences(sentences, skip_unknown=False):
             sentence_verbs = {token.lower() for token, pos, lemma in tagged if pos.startswith('V')}
 
             for lemma, match_tokens in self.lemma_to_token.iteritems():
@@ -358,11 +383,8 @@ class GrammarExtractor(SentenceExtractor):
         # Sentence splitting
         sentences = self.splitter.split(document)
         tokens = 0
-        for sentence in sentences:
-            if not sentence.strip():
-                continue
-
-            tagged = [(token, pos) for token, pos, lemma in self.tagger.tag_one(sentence)]
+        for sentence, tags in self.tag_sentences(sentences):
+            tagged = [(token, pos) for token, pos, lemma in tags]
 
             # Parsing via grammar
             parsed = self.parser.parse(tagged)
@@ -399,7 +421,8 @@ class GrammarExtractor(SentenceExtractor):
 
 
 def extract_sentences(corpus, sentences_key, document_key, language,
-                      lemma_to_tokens, strategy, match_base_form, processes=0):
+                      lemma_to_tokens, strategy, match_base_form, processes=0,
+                      checkpoint=None, tag_document=True):
     """
     Extract sentences from the given corpus by matching tokens against a given set.
 
@@ -411,6 +434,8 @@ def extract_sentences(corpus, sentences_key, document_key, language,
     :param str strategy: One of the 4 extraction strategies ['121', 'n2n', 'grammar', 'syntactic']
     :param bool match_base_form: whether to match verbs base form
     :param int processes: How many concurrent processes to use
+    :param checkpoint: Optional :class:`Checkpoint` to resume an interrupted extraction
+    :param bool tag_document: Whether to POS-tag whole documents at once or sentence by sentence
     :return: the corpus, updated with the extracted sentences and the number of extracted sentences
     :rtype: generator of tuples
     """
@@ -435,8 +460,8 @@ def extract_sentences(corpus, sentences_key, document_key, language,
         raise ValueError("Malformed or unsupported extraction strategy: "
                          "please use one of ['121', 'n2n', 'grammar', or 'syntactic']")
 
-    for each in extractor(corpus, document_key, sentences_key, language,
-                          lemma_to_tokens, match_base_form).extract(processes):
+    for each in extractor(corpus, document_key, sentences_key, language, lemma_to_tokens,
+                          match_base_form, tag_document).extract(processes, checkpoint):
         yield each
 
 
@@ -450,16 +475,35 @@ def extract_sentences(corpus, sentences_key, document_key, language,
 @click.option('--document-key', default='bio')
 @click.option('--processes', '-p', default=0)
 @click.option('--match-base-form', is_flag=True, default=False)
+@click.option('--resume', is_flag=True, help='Resume from the last checkpoint, appending to the outfile')
+@click.option('--tag-document/--tag-sentences', default=True,
+              help='POS-tag whole documents at once (faster) or each sentence by itself')
+@click.option('--columnar', 'columnar_path', type=click.Path(file_okay=False, resolve_path=True),
+              help='Write the sentences in columnar format to this directory instead of the outfile')
 def main(corpus, lemma_to_tokens, language_code, strategy, outfile, processes,
-         sentences_key, document_key, match_base_form):
+         sentences_key, document_key, match_base_form, resume, tag_document, columnar_path):
     """ Extract corpus sentences containing at least one token in the given set. """
     corpus = load_scraped_items(corpus)
-    updated = extract_sentences(corpus, sentences_key, document_key, language_code,
-                                json.load(lemma_to_tokens), strategy, match_base_form, processes)
-
-    for item in updated:
-        outfile.write(json.dumps(item) + '\n')
+    if columnar_path:
+        if resume:
+            raise click.UsageError('Columnar output cannot be resumed')
+
+        updated = extract_sentences(corpus, sentences_key, document_key, language_code,
+                                    json.load(lemma_to_tokens), strategy, match_base_form,
+                                    processes, tag_document=tag_document)
+        columnar.convert(updated, columnar_path, 'tagged')
+        pos_tag.log_cache_stats()
+        return 0
+
+    with Checkpoint(outfile, resume) as checkpoint:
+        updated = extract_sentences(corpus, sentences_key, document_key, language_code,
+                                    json.load(lemma_to_tokens), strategy, match_base_form,
+                                    processes, checkpoint, tag_document)
+
+        for item in updated:
+            checkpoint.write(codec.dumps(item) + '\n')
     logger.info("Dumped sentences to '%s'" % outfile.name)
+    pos_tag.log_cache_stats()
     
     return 0
 
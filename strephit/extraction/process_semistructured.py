@@ -1,12 +1,11 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
-import json
 import logging
 from collections import defaultdict
 
 import click
 
-from strephit.commons import io, wikidata, parallel, text
+from strephit.commons import io, wikidata, parallel, text, cache, codec
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +15,64 @@ class SemistructuredSerializer:
         self.language = language
         self.sourced_only = sourced_only
 
+    @staticmethod
+    def _strings(value):
+        """ Finds the strings in the value of a field, including keys and values of dictionaries """
+        if not isinstance(value, list):
+            value = [value]
+
+        strings = []
+        for val in value:
+            if isinstance(val, basestring):
+                strings.append(val)
+            elif isinstance(val, dict):
+                strings.extend(val.keys())
+                strings.extend(val.values())
+        return strings
+
+    @staticmethod
+    def _fields(item):
+        """ Merges the fields of an item with its other fields, if any """
+        other = item.get('other', {})
+        data = {}
+        try:
+            data = codec.loads(other)
+        except ValueError:
+            pass
+        except TypeError:
+            if isinstance(other, dict):
+                data = other
+            else:
+                return None
+
+        data = dict(data)
+        data.update((key, value) for key, value in item.iteritems()
+                    if key not in {'name', 'other', 'url'})
+        data.pop('bio', None)
+        return data
+
+    def search_terms(self, item):
+        """ Finds the terms which will be searched on Wikidata to serialize
+            an item, so that they can be searched in advance
+
+            :param item: Scraped item, either str (json) or dict
+            :rtype: list
+        """
+        if isinstance(item, basestring):
+            item = codec.loads(item)
+
+        data = self._fields(item)
+        if not item.get('name') or data is None:
+            return []
+
+        terms = [text.fix_name(item['name'])[0]]
+        for key, value in data.iteritems():
+            property = wikidata.PROPERTY_TO_WIKIDATA.get(key)
+            for val in self._strings(value):
+                if val and isinstance(val, basestring) and property:
+                    terms.extend(wikidata.resolver_terms(property, val))
+        return terms
+
     def serialize_item(self, item):
         """ Converts an item to quick statements.
 
@@ -27,11 +84,10 @@ class SemistructuredSerializer:
         """
 
         if isinstance(item, basestring):
-            item = json.loads(item)
+            item = codec.loads(item)
 
-        name = item.pop('name', '')
-        other = item.pop('other', {})
-        url = item.pop('url', '')
+        name = item.get('name', '')
+        url = item.get('url', '')
 
         if self.sourced_only and not url:
             logger.debug('item %s has no url, skipping it')
@@ -41,38 +97,18 @@ class SemistructuredSerializer:
             logger.debug('item %s has no name, skipping it')
             return
 
-        data = {}
-        try:
-            data = json.loads(other)
-        except ValueError:
-            pass
-        except TypeError:
-            if isinstance(other, dict):
-                data = other
-            else:
-                return
+        data = self._fields(item)
+        if data is None:
+            return
 
         name, honorifics = text.fix_name(name)
-        data.update(item)
-        data.pop('bio', None)
 
         # the name will be the last one to be resolved because it is the hardest
         # one to get right, so we will use all the other statements to help
         statements = defaultdict(list)
 
         for key, value in data.iteritems():
-            if not isinstance(value, list):
-                value = [value]
-
-            strings = []
-            for val in value:
-                if isinstance(val, basestring):
-                    strings.append(val)
-                elif isinstance(val, dict):
-                    strings.extend(val.keys())
-                    strings.extend(val.values())
-
-            for val in strings:
+            for val in self._strings(value):
                 if not val:
                     continue
                 elif not isinstance(val, basestring):
@@ -116,11 +152,14 @@ class SemistructuredSerializer:
             else:
                 yield False, {'chunk': each, 'additional': {'property': 'P1035', 'url': url}}
 
-    def process_corpus(self, items, output_file, dump_unresolved_file=None, genealogics=None, processes=0):
+    def process_corpus(self, items, output_file, dump_unresolved_file=None, genealogics=None, processes=0,
+                       prefetch=100):
         count = skipped = 0
 
         genealogics_url_to_id = {}
-        for success, item in parallel.map(self.serialize_item, items, processes, flatten=True):
+        items = wikidata.prefetch(items, self.search_terms, self.language, prefetch)
+        for success, item in parallel.map(self.serialize_item, items, processes,
+                                          flatten=True, ordered=True):
             if success:
                 subj, prop, val, url = item
                 statement = wikidata.finalize_statement(
@@ -143,7 +182,7 @@ class SemistructuredSerializer:
             else:
                 skipped += 1
                 if dump_unresolved_file:
-                    dump_unresolved_file.write(json.dumps(item))
+                    dump_unresolved_file.write(codec.dumps(item))
                     dump_unresolved_file.write('\n')
 
         logger.info('Produced %d statements so far, skipped %d names', count, skipped)
@@ -161,7 +200,7 @@ class SemistructuredSerializer:
         }
 
         for row in input_file:
-            data = json.loads(row)
+            data = codec.loads(row)
 
             if 'url' not in data or data['url'] not in url_to_id:
                 continue
@@ -204,8 +243,10 @@ class SemistructuredSerializer:
 @click.option('--language', default='en', help='The names are searched in this language')
 @click.option('--processes', '-p', default=0)
 @click.option('--dump-unresolved', type=click.File('w'))
+@click.option('--prefetch', default=100, help='Search on Wikidata the values of this many items '
+                                              'at once, 0 to search them one by one')
 def process_semistructured(corpus_dir, outfile, language, processes,
-                           sourced_only, genealogics, dump_unresolved):
+                           sourced_only, genealogics, dump_unresolved, prefetch):
     """ Processes the corpus and extracts semi-structured data serialized into QuickStatements.
         Needs a second pass on genealogics to correctly resolve family members.
     """
@@ -213,10 +254,11 @@ def process_semistructured(corpus_dir, outfile, language, processes,
     resolver = SemistructuredSerializer(language, sourced_only, )
 
     genealogics_url_to_id, count, skipped = resolver.process_corpus(
-        io.load_scraped_items(corpus_dir), outfile, dump_unresolved, genealogics, processes
+        io.load_scraped_items(corpus_dir), outfile, dump_unresolved, genealogics, processes, prefetch
     )
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
+    cache.log_stats()
     if not genealogics:
         logger.info("Dataset serialized to '%s'" % outfile.name)
         return
@@ -234,7 +276,7 @@ def process_semistructured(corpus_dir, outfile, language, processes,
         else:
             skipped += 1
             if dump_unresolved:
-                dump_unresolved.write(json.dumps(item))
+                dump_unresolved.write(codec.dumps(item))
                 dump_unresolved.write('\n')
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
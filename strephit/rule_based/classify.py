@@ -9,7 +9,8 @@ from collections import defaultdict
 import click
 
 from strephit.commons.date_normalizer import normalize_numerical_fes
-from strephit.commons import scoring, pos_tag, parallel
+from strephit.commons import scoring, pos_tag, parallel, codec, columnar
+from strephit.commons.checkpoint import Checkpoint
 from strephit.commons.stopwords import StopWords
 from strephit.commons.classification import apply_custom_classification_rules
 
@@ -24,7 +25,7 @@ class RuleBasedClassifier:
         a suitable type
     """
     def __init__(self, frame_data, language):
-        self.tagger = pos_tag.TTPosTagger(language)
+        self.tagger = pos_tag.get_pos_tagger(language)
         self.language = language
         self.frame_data = frame_data
 
@@ -165,7 +166,8 @@ class RuleBasedClassifier:
         return final
 
     def label_sentences(self, sentences, normalize_numerical, score_type, core_weight,
-                        processes=0, input_encoded=False, output_encoded=False):
+                        processes=0, input_encoded=False, output_encoded=False,
+                        checkpoint=None):
         """ Process all the given sentences with the rule-based classifier,
             optionally giving a confidence score
 
@@ -181,25 +183,32 @@ class RuleBasedClassifier:
              over large size dictionaries for performance reasons
             :param output_encoded: whether to return a generator of dictionaries or a generator
              of JSON-encoded documents. Prefer encoded output for performance reasons
+            :param checkpoint: optional :class:`Checkpoint` used to skip the sentences
+             labeled by a previous run and to record the progress
             :return: Generator of labeled sentences
         """
 
         def worker(item):
             if input_encoded:
-                item = json.loads(item)
+                item = codec.loads(item)
 
             labeled = self.label_sentence(item, normalize_numerical,
                                           score_type, core_weight)
 
             if labeled:
-                return json.dumps(labeled) if output_encoded else labeled
+                return codec.dumps(labeled) if output_encoded else labeled
 
-        for each in parallel.map(worker, sentences, processes):
+        if checkpoint:
+            results = checkpoint.map(worker, sentences, processes)
+        else:
+            results = parallel.map(worker, sentences, processes, ordered=True)
+
+        for each in results:
             yield each
 
 
 @click.command()
-@click.argument('sentences', type=click.File('r'))
+@click.argument('sentences', type=click.Path(exists=True, allow_dash=True))
 @click.argument('frame-data', type=click.File('r'))
 @click.argument('language')
 @click.option('--outfile', '-o', type=click.File('w'), default='output/rule_based_classified.jsonlines')
@@ -207,27 +216,33 @@ class RuleBasedClassifier:
 @click.option('--score-type', type=click.Choice(scoring.AVAILABLE_SCORES))
 @click.option('--core-weight', default=2)
 @click.option('--normalize-numerical', is_flag=True, default=True)
+@click.option('--resume', is_flag=True, help='Resume from the last checkpoint, appending to the outfile')
 def main(sentences, frame_data, language, outfile, score_type, core_weight,
-         normalize_numerical, processes):
-    """ Rule-based role labeling
+         normalize_numerical, processes, resume):
+    """ Rule-based role labeling. The sentences can be in columnar format, too
     """
 
     frame_data = json.load(frame_data)
-
-    labeled = RuleBasedClassifier(frame_data, language).label_sentences(
-        sentences, normalize_numerical, score_type, core_weight, processes,
-        input_encoded=True, output_encoded=True
-    )
-
-    count = 0
-    for i, each in enumerate(labeled):
-        outfile.write(each)
-        outfile.write('\n')
-
-        count = i + 1
-        if count % 1000 == 0:
-            logger.info('Labeled %d sentences', count)
+    if columnar.is_columnar(sentences):
+        sentences, input_encoded = columnar.ColumnarReader(sentences), False
+    else:
+        sentences, input_encoded = click.open_file(sentences), True
+
+    with Checkpoint(outfile, resume) as checkpoint:
+        labeled = RuleBasedClassifier(frame_data, language).label_sentences(
+            sentences, normalize_numerical, score_type, core_weight, processes,
+            input_encoded=input_encoded, output_encoded=True, checkpoint=checkpoint
+        )
+
+        count = checkpoint.outputs
+        for each in labeled:
+            checkpoint.write(each + '\n')
+
+            count += 1
+            if count % 1000 == 0:
+                logger.info('Labeled %d sentences', count)
     
     if count > 0:
         logger.info("Dumped labeled sentences to '%s'" % outfile.name)
     logger.info('Done, labeled %d sentences', count)
+    pos_tag.log_cache_stats()
@@ -16,8 +16,8 @@ COLUMN_TO_PROPERTY = {
     'WLMID': 'P2186',
 }
 
-@cache.cached
 @wikidata.resolver('P127', 'P131')
+@cache.cached(ignored=('kwargs',))
 def place_resolver(property, value, language, **kwargs):
     types = [
         3146899,      # diocese of the Catholic Church
@@ -49,8 +49,8 @@ def wlmid_resolver(property, value, language, **kwargs):
     return value
 
 
-@cache.cached
 @wikidata.resolver('P969')
+@cache.cached(ignored=('kwargs',))
 def indirizzo_resolver(property, value, language, **kwargs):
     return '%s@"%s"' % (language, value)
 
@@ -1,16 +1,62 @@
 # -*- encoding: utf-8 -*-
 import os
+import json
 import shutil
 import tempfile
 import yaml
 import random
 import unittest
 import itertools
-from strephit.commons import pos_tag, cache, parallel, datetime, text, wikidata, split_sentences, date_normalizer
+import inspect
+import requests
+import time
+import gzip
+import bz2
+import tarfile
+import threading
+import struct
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+from strephit.commons import io, codec, columnar, web, pos_tag, cache, parallel, datetime, text, wikidata, wikidata_index, split_sentences, date_normalizer
+from strephit.commons.checkpoint import Checkpoint
+from strephit.corpus_analysis import rank_verbs, compute_lu_distribution
 from collections import Counter
 from treetaggerwrapper import Tag
 
 
+worker_value = worker_initializations = None
+
+
+def initialize_worker(value):
+    global worker_value, worker_initializations
+    worker_value = value
+    worker_initializations = (worker_initializations or 0) + 1
+
+
+def use_worker_value(x):
+    return worker_value + x, worker_initializations
+
+
+calls_file = None
+
+
+def record_call(x):
+    with open(calls_file, 'a') as f:
+        f.write('%s\n' % x)
+    time.sleep(0.2)
+
+
+@cache.cached(namespace='single-flight')
+def slow_lookup(x):
+    record_call(x)
+    return 2 * x
+
+
+def get_many_pages(urls):
+    return sorted((url, content) for url, content, _ in io.get_many_and_cache(urls))
+
+
 class TestParallel(unittest.TestCase):
     def setUp(self):
         self.list_in = range(10)
@@ -86,6 +132,684 @@ class TestParallel(unittest.TestCase):
             data = range(batch_size * 5)
             self.assertTrue(all(parallel.map(consumer, data, processes=5, batch_size=batch_size)))
 
+    def test_auto_batches(self):
+        def consumer(bulk):
+            self.assertIsInstance(bulk, list)
+            return [2 * x for x in bulk]
+
+        for processes in [1, 3]:
+            list_out = parallel.map(consumer, xrange(5000), processes=processes,
+                                    batch_size='auto', flatten=True, ordered=True)
+            self.assertEqual(list(list_out), map(self.function, xrange(5000)))
+
+    def test_adaptive_batcher(self):
+        batcher = parallel.AdaptiveBatcher(duration=1, max_size=100)
+        for _ in xrange(10):
+            batcher.record(batcher.size, 0.001 * batcher.size)
+        self.assertEqual(batcher.size, 100)
+
+        for _ in xrange(10):
+            batcher.record(batcher.size, 10.0 * batcher.size)
+        self.assertEqual(batcher.size, 1)
+
+        batches = list(batcher.batches(xrange(10)))
+        self.assertEqual(batches, [[x] for x in xrange(10)])
+
+    def test_pool(self):
+        global worker_initializations
+        worker_initializations = None
+        with parallel.Pool(2, initializer=initialize_worker, initargs=(10,)) as pool:
+            for _ in xrange(3):
+                list_out = list(pool.map(use_worker_value, xrange(20), ordered=True))
+                self.assertEqual([x for x, _ in list_out], range(10, 30))
+                self.assertEqual(set(n for _, n in list_out), {1})
+
+    def test_pool_early_stop(self):
+        with parallel.Pool(2) as pool:
+            list_out = pool.map(abs, xrange(-1000, 0), ordered=True)
+            self.assertEqual(next(list_out), 1000)
+            list_out.close()
+            self.assertEqual(list(pool.map(abs, xrange(-5, 0), ordered=True)), range(5, 0, -1))
+
+    def test_map_initializer(self):
+        for processes in [1, 2]:
+            list_out = parallel.map(lambda x: use_worker_value(x)[0], xrange(5), processes,
+                                    initializer=initialize_worker, initargs=(5,))
+            self.assertEqual(set(list_out), set(xrange(5, 10)))
+
+    def test_worker_crash(self):
+        flag = tempfile.mktemp()
+
+        def crash_once(x):
+            if x == 5 and not os.path.exists(flag):
+                open(flag, 'w').close()
+                os._exit(1)
+            return 2 * x
+
+        try:
+            list_out = parallel.map(crash_once, self.list_in, processes=2, ordered=True)
+            self.assertEqual(list(list_out), map(self.function, self.list_in))
+        finally:
+            os.remove(flag)
+
+    def test_dead_letter(self):
+        dead_letter = tempfile.mktemp()
+
+        def fail(x):
+            if x == 3:
+                os._exit(1)
+            elif x == 5:
+                raise ValueError('hello!')
+            return 2 * x
+
+        try:
+            list_out = parallel.map(fail, self.list_in, processes=2, ordered=True,
+                                    retries=1, dead_letter=dead_letter)
+            self.assertEqual(list(list_out), [2 * x for x in self.list_in if x not in {3, 5}])
+
+            with open(dead_letter) as f:
+                failed = sorted(map(json.loads, f), key=lambda each: each['task'])
+            # only the crashes are tried again
+            self.assertEqual([(each['task'], each['attempts']) for each in failed],
+                             [(3, 2), (5, 1)])
+            self.assertIn('ValueError', failed[1]['error'])
+        finally:
+            os.remove(dead_letter)
+
+    def test_dead_letter_single_process(self):
+        dead_letter = tempfile.mktemp()
+        try:
+            list_out = parallel.map(self.exc_function, self.list_in, processes=1,
+                                    raise_exc=False, dead_letter=dead_letter)
+            self.assertEqual(list(list_out), [])
+            with open(dead_letter) as f:
+                self.assertEqual(len(f.readlines()), len(self.list_in))
+        finally:
+            os.remove(dead_letter)
+
+    def test_exception_not_retried(self):
+        calls = tempfile.mktemp()
+
+        def fail(x):
+            record_call(x)
+            raise ValueError('hello!')
+
+        global calls_file
+        calls_file = calls
+        try:
+            for processes in [1, 2]:
+                self.assertEqual(list(parallel.map(fail, xrange(3), processes=processes,
+                                                   raise_exc=False)), [])
+            with open(calls) as f:
+                self.assertEqual(sorted(f.read().split()), ['0', '0', '1', '1', '2', '2'])
+        finally:
+            os.remove(calls)
+
+    def test_partial_message(self):
+        channel = parallel.ResultChannel()
+        for sender in [0, 1]:
+            channel.open(sender)
+        # a worker dying halfway through a message of 100 bytes
+        os.write(channel.writers[0].fileno(), struct.pack('!i', 100) + 'abc')
+        channel.started(0)
+        channel.writers[1].send('hello')
+        try:
+            self.assertEqual(channel.drain([0]), [])
+            self.assertEqual(channel.get(timeout=1), ['hello'])
+            self.assertEqual(channel.get(timeout=0.1), [])
+        finally:
+            channel.close()
+
+    def test_ordered(self):
+        def slow_function(x):
+            time.sleep(random.random() / 100)
+            return 2 * x
+
+        list_out = parallel.map(slow_function, xrange(100), processes=4, ordered=True,
+                                queue_size=2, window=5)
+        self.assertEqual(list(list_out), map(self.function, xrange(100)))
+
+    def test_ordered_flatten(self):
+        list_out = parallel.map(self.multi_function, self.list_in_nones, processes=3,
+                                flatten=True, ordered=True)
+        self.assertEqual(list(list_out), list(itertools.chain(
+            *map(self.multi_function, filter(self.none_filter, self.list_in_nones)))))
+
+    def test_exception_in_iterable(self):
+        def iterable():
+            yield 1
+            raise ValueError('hello!')
+
+        self.assertRaises(ValueError, self.consume,
+                          parallel.map(self.function, iterable(), processes=2))
+
+    def test_early_stop(self):
+        list_out = parallel.map(self.function, xrange(1000), processes=2, ordered=True)
+        self.assertEqual(next(list_out), 0)
+        list_out.close()
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.outfile = tempfile.mktemp()
+        self.rows = range(10)
+
+    def tearDown(self):
+        for path in [self.outfile, self.outfile + '.checkpoint']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run_until(self, stop, resume, flatten=False, every=1):
+        function = (lambda x: [x] * (x % 3)) if flatten else (lambda x: 2 * x)
+        with Checkpoint(open(self.outfile, 'w') if not resume else open(self.outfile, 'a'),
+                        resume, every) as checkpoint:
+            for each in checkpoint.map(function, self.rows, processes=1, flatten=flatten):
+                if each == stop:
+                    raise ValueError('interrupted')
+                checkpoint.write('%d\n' % each)
+        return checkpoint
+
+    def read(self):
+        with open(self.outfile) as f:
+            return [int(line) for line in f]
+
+    def test_resume(self):
+        self.assertRaises(ValueError, self.run_until, 10, False)
+        checkpoint = self.run_until(None, True)
+        self.assertEqual(self.read(), [2 * x for x in self.rows])
+        self.assertEqual((checkpoint.offset, checkpoint.outputs), (10, 10))
+
+    def test_resume_flatten(self):
+        # interrupted in the middle of the outputs of row 8
+        self.assertRaises(ValueError, self.run_until, 8, False, True)
+        with open(self.outfile, 'a') as f:
+            f.write('8\n')
+
+        checkpoint = self.run_until(None, True, True)
+        expected = [x for x in self.rows for _ in xrange(x % 3)]
+        self.assertEqual(self.read(), expected)
+        self.assertEqual(checkpoint.outputs, len(expected))
+
+    def test_interrupted_row(self):
+        # row 5 writes its first output, then fails
+        def run(resume):
+            with Checkpoint(open(self.outfile, 'w' if not resume else 'a'), resume) as checkpoint:
+                unresolved = checkpoint.track(open(self.outfile + '.unresolved', 'w' if not resume else 'a'))
+                for each in checkpoint.map(lambda x: [x, x], self.rows, flatten=True):
+                    checkpoint.write('%d\n' % each)
+                    unresolved.write('%d\n' % each)
+                    if each == 5 and not resume:
+                        raise ValueError('interrupted')
+            return checkpoint
+
+        try:
+            self.assertRaises(ValueError, run, False)
+            with open(self.outfile + '.checkpoint') as f:
+                self.assertEqual(json.load(f)['outputs'], 10)
+
+            checkpoint = run(True)
+            expected = [x for x in self.rows for _ in xrange(2)]
+            self.assertEqual(self.read(), expected)
+            self.assertEqual(checkpoint.outputs, len(expected))
+            with open(self.outfile + '.unresolved') as f:
+                self.assertEqual([int(line) for line in f], expected)
+        finally:
+            os.remove(self.outfile + '.unresolved')
+
+    def test_every(self):
+        self.assertRaises(ValueError, self.run_until, 14, False, False, 4)
+        with open(self.outfile + '.checkpoint') as f:
+            self.assertEqual(json.load(f)['offset'], 7)
+
+        self.run_until(None, True)
+        self.assertEqual(self.read(), [2 * x for x in self.rows])
+
+    def test_no_checkpoint(self):
+        checkpoint = self.run_until(None, True)
+        self.assertEqual(checkpoint.offset, 10)
+        self.assertEqual(self.read(), [2 * x for x in self.rows])
+
+
+class TestIO(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.items = [{'name': 'item %d' % i, 'url': 'http://example.org/%d' % i}
+                      for i in xrange(30)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_shards(self, directory):
+        lines = [json.dumps(item) + '\n' for item in self.items]
+        with open(os.path.join(directory, 'items-0.jsonl'), 'w') as f:
+            f.writelines(lines[:10])
+
+        # concatenated gzip streams, as produced by parallel compressors
+        with open(os.path.join(directory, 'items-1.jsonl.gz'), 'w') as f:
+            for line in lines[10:20]:
+                gz = gzip.GzipFile(fileobj=f, mode='w')
+                gz.write(line)
+                gz.close()
+
+        with open(os.path.join(directory, 'items-2.jsonlines.bz2'), 'w') as f:
+            f.write(bz2.compress(''.join(lines[20:])))
+
+        with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+            f.write('not a shard\n')
+
+    def write_tar(self, mode):
+        shards = os.path.join(self.directory, 'shards')
+        os.mkdir(shards)
+        self.write_shards(shards)
+        os.remove(os.path.join(shards, 'notes.txt'))
+
+        path = os.path.join(self.directory, 'corpus.tar')
+        with tarfile.open(path, mode) as tar:
+            for name in sorted(os.listdir(shards)):
+                tar.add(os.path.join(shards, name), name)
+        return path
+
+    def test_read_lines(self):
+        content = 'a\nb\n\nc'
+        gz = StringIO()
+        with gzip.GzipFile(fileobj=gz, mode='w') as f:
+            f.write(content)
+
+        for name, compressed in [('a.jsonl', content), ('a.jsonl.gz', gz.getvalue()),
+                                 ('a.jsonl.bz2', bz2.compress(content))]:
+            lines = list(io.read_lines(name, StringIO(compressed)))
+            self.assertEqual(lines, ['a', 'b', '', 'c'])
+
+        lines = list(io.read_lines('a.jsonl', StringIO(content), size=4))
+        self.assertEqual(lines, ['a', 'b'])
+
+    def test_directory(self):
+        self.write_shards(self.directory)
+        self.assertEqual(list(io.load_scraped_items(self.directory)), self.items)
+
+    def test_single_file(self):
+        self.write_shards(self.directory)
+        path = os.path.join(self.directory, 'items-1.jsonl.gz')
+        self.assertEqual(list(io.load_scraped_items(path)), self.items[10:20])
+
+    def test_tar(self):
+        for mode in ['w', 'w:gz']:
+            path = self.write_tar(mode)
+            self.assertEqual(list(io.load_scraped_items(path)), self.items)
+            self.assertEqual(list(io.load_scraped_shards(path, processes=2, ordered=True)),
+                             self.items)
+            shutil.rmtree(os.path.join(self.directory, 'shards'))
+
+    def test_shards(self):
+        self.write_shards(self.directory)
+        self.assertEqual(list(io.load_scraped_shards(self.directory, processes=2, ordered=True)),
+                         self.items)
+
+        loaded = list(io.load_scraped_shards(self.directory, processes=2))
+        self.assertEqual(sorted(loaded, key=lambda item: item['name']),
+                         sorted(self.items, key=lambda item: item['name']))
+
+    def write_corpus(self):
+        path = os.path.join(self.directory, 'corpus.jsonl')
+        with open(path, 'w') as f:
+            for i, item in enumerate(self.items):
+                f.write(json.dumps(item) + '\n')
+                if i % 7 == 0:
+                    f.write('\n')
+        return path
+
+    def test_index(self):
+        path = self.write_corpus()
+        index = io.JsonLinesIndex.open(path, keys=('url',))
+        self.assertEqual(len(index), len(self.items))
+        self.assertEqual([index[i] for i in xrange(len(index))], self.items)
+        self.assertEqual(index.keys('url'), tuple(item['url'] for item in self.items))
+        self.assertEqual(index.find('url', 'http://example.org/12'), [12])
+        self.assertEqual(index.find('url', 'missing'), [])
+        self.assertEqual(io.count_items(path), len(self.items))
+
+        loaded = io.JsonLinesIndex.open(path)
+        self.assertEqual(loaded.header, index.header)
+        self.assertEqual(loaded[5], self.items[5])
+
+    def test_index_out_of_date(self):
+        path = self.write_corpus()
+        io.JsonLinesIndex.open(path)
+        with open(path, 'a') as f:
+            f.write(json.dumps({'name': 'new'}) + '\n')
+        self.assertEqual(len(io.JsonLinesIndex.open(path)), len(self.items) + 1)
+
+        index = io.JsonLinesIndex.open(path, keys=('name',))
+        self.assertEqual(index.keys('name')[-1], 'new')
+
+    def test_index_partitions(self):
+        index = io.JsonLinesIndex.open(self.write_corpus())
+        for parts in [1, 3, 7, 100]:
+            partitions = index.partitions(parts)
+            self.assertLessEqual(len(partitions), parts)
+            self.assertEqual(partitions[0][0], 0)
+            self.assertEqual(partitions[-1][1], len(self.items))
+            self.assertEqual([item for start, end in partitions for item in index.read(start, end)],
+                             self.items)
+
+        self.assertEqual(list(index.read(10, 12)), self.items[10:12])
+        self.assertEqual(list(index.read(12, 12)), [])
+
+    def test_index_parallel(self):
+        index = io.JsonLinesIndex.open(self.write_corpus())
+        index.PARTITION_SIZE = 256
+        self.assertEqual(list(index.load_parallel(processes=2, ordered=True)), self.items)
+
+    def test_index_empty(self):
+        path = os.path.join(self.directory, 'empty.jsonl')
+        open(path, 'w').close()
+        index = io.JsonLinesIndex.open(path, keys=('url',))
+        self.assertEqual(len(io.JsonLinesIndex.open(path)), 0)
+        self.assertEqual(index.partitions(4), [])
+        self.assertEqual(index.keys('url'), ())
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.backend = codec.BACKEND
+        self.item = {'name': u'Fran\xe7ois', 'url': 'http://example.org/a/b', 'score': 0.123456789012,
+                     'fes': [{'fe': 'Place', 'chunk': 'Paris'}], 'id': 10 ** 12, 'gold': None}
+
+    def tearDown(self):
+        codec.set_backend(self.backend)
+
+    def test_round_trip(self):
+        for backend in codec.PREFERENCE:
+            try:
+                codec.set_backend(backend)
+            except ImportError:
+                continue
+
+            encoded = codec.dumps(self.item)
+            self.assertIsInstance(encoded, str)
+            self.assertNotIn('\n', encoded)
+            self.assertEqual(codec.loads(encoded), self.item)
+            self.assertEqual(json.loads(encoded), self.item)
+
+    def test_fallback(self):
+        self.assertIn(codec.set_backend(), codec.PREFERENCE)
+        self.assertEqual(codec.set_backend('json'), 'json')
+        self.assertIs(codec.loads, json.loads)
+
+
+def range_bounds(reader, start, end):
+    return start, end
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'columnar')
+        self.items = [
+            {'id': 0, 'bio': 'He was born', 'pos_tag': [['He', 'PP', 'he'], ['was', 'VBD', 'be'],
+                                                        ['born', 'VVN', 'bear']]},
+            {'id': 1, 'bio': ''},
+            {'id': 2, 'bio': 'She Bore', 'pos_tag': [['She', 'PP', 'she'], ['Bore', 'VVD', 'Bear']]},
+            {'id': 3, 'bio': 'It is', 'pos_tag': [['It', 'PP', 'it'], ['is', 'VBZ', 'be']]},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, items, buffer_size=1000):
+        with columnar.ColumnarWriter(self.path, 'pos_tag', buffer_size) as writer:
+            for item in items:
+                writer.write(dict(item))
+
+    def test_round_trip(self):
+        self.write(self.items, buffer_size=2)
+        self.assertTrue(columnar.is_columnar(self.path))
+        reader = columnar.ColumnarReader(self.path)
+        self.assertEqual(len(reader), len(self.items))
+        self.assertEqual(list(reader), self.items)
+        self.assertEqual(reader.tags(2), self.items[2]['pos_tag'])
+        self.assertEqual(list(io.load_scraped_items(self.path)), self.items)
+        self.assertEqual(len(reader.vocabularies['lemma']), 6)
+        self.assertEqual(len(reader.columns['lemma']), 7)
+
+    def test_pairs(self):
+        items = [{'tagged': [['He', 'PP'], ['was', 'VBD']]}]
+        columnar.convert([dict(each) for each in items], self.path, 'tagged')
+        reader = columnar.ColumnarReader(self.path)
+        self.assertEqual(reader.meta['columns'], ['token', 'pos'])
+        self.assertEqual(list(reader), items)
+
+    def test_not_modified(self):
+        with columnar.ColumnarWriter(self.path, 'pos_tag') as writer:
+            item = {'id': 0, 'pos_tag': [['He', 'PP', 'he']]}
+            writer.write(item)
+        self.assertEqual(item, {'id': 0, 'pos_tag': [['He', 'PP', 'he']]})
+        self.assertEqual(list(columnar.ColumnarReader(self.path)), [item])
+
+    def test_width_mismatch(self):
+        with columnar.ColumnarWriter(self.path, 'pos_tag') as writer:
+            writer.write({'id': 0, 'pos_tag': [['He', 'PP', 'he']]})
+            self.assertRaises(ValueError, writer.write, {'id': 1, 'pos_tag': [['He', 'PP']]})
+            self.assertRaises(ValueError, writer.write, {'id': 2, 'pos_tag': [['He', 'PP', 'he', 'x']]})
+            writer.write({'id': 3, 'pos_tag': [['It', 'PP', 'it']]})
+        self.assertEqual([item['id'] for item in columnar.ColumnarReader(self.path)], [0, 3])
+
+    def test_empty(self):
+        self.write([{'id': 0}])
+        self.assertEqual(list(columnar.ColumnarReader(self.path)), [{'id': 0}])
+
+    def write_sentences(self):
+        sentence = [['He', 'PP', 'he'], ['was', 'VBD', 'be'], ['born', 'VVN', 'bear'], ['.', 'SENT', '.']]
+        other = [['He', 'PP', 'he'], ['Died', 'VVD', 'die'], ['and', 'CC', 'and'],
+                 ['died', 'VVD', 'die'], ['.', 'SENT', '.']]
+        self.write([{'id': i, 'pos_tag': sentence * (i % 3) + other + sentence[:2]}
+                    for i in xrange(20)])
+
+    def test_sentences(self):
+        self.write_sentences()
+        reader = columnar.ColumnarReader(self.path)
+        self.assertEqual(reader.meta['sentences'], sum(i % 3 + 2 for i in xrange(20)))
+        self.assertEqual(reader.sentences[:4].tolist(), [0, 5, 7, 11])
+        self.assertEqual(reader.sentence_ids(4, 8).tolist(), [0, 1, 1, 2])
+
+    def test_map_sentences(self):
+        self.write_sentences()
+        reader = columnar.ColumnarReader(self.path)
+        ranges = sorted(columnar.map_sentences(self.path, range_bounds, processes=2, parts=7))
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], reader.meta['tags'])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertIn(start, reader.sentences)
+
+    def test_lus_per_sentence(self):
+        self.write_sentences()
+        histograms = columnar.map_sentences(self.path, compute_lu_distribution._lus_per_sentence,
+                                            ({'born', 'died'},), processes=2, parts=5)
+        counts = Counter()
+        for histogram in histograms:
+            counts.update({k: v for k, v in enumerate(histogram.tolist()) if v})
+        # one verb in each sentence with born or died (twice, in different case), none in the rest
+        self.assertEqual(counts, {1: sum(i % 3 + 1 for i in xrange(20)), 0: 20})
+
+    def test_lus_per_sentence_as_text(self):
+        class Splitter(object):
+            def split(self, text):
+                return text.split('. ')
+
+        class Tagger(object):
+            verbs = {'was': 'VBD', 'born': 'VVN', 'wrote': 'VVD', 'is': 'VBZ'}
+
+            def tag(self, sentence):
+                tokens = sentence.rstrip('.').split() + ['.']
+                return [(token, 'SENT' if token == '.' else self.verbs.get(token.lower(), 'NN'),
+                         token.lower()) for token in tokens]
+
+            def tag_sentences(self, sentences):
+                return [self.tag(sentence) for sentence in sentences]
+
+        bio = 'He was born in Rome. Ok. She wrote and Wrote books. It is.'
+        tags = [list(tag) for sentence in Splitter().split(bio) for tag in Tagger().tag(sentence)]
+        self.write([{'bio': bio, 'pos_tag': tags}])
+
+        saved = compute_lu_distribution.splitter, compute_lu_distribution.tagger, \
+            compute_lu_distribution.all_verbs
+        compute_lu_distribution.splitter, compute_lu_distribution.tagger = Splitter(), Tagger()
+        compute_lu_distribution.all_verbs = {'born', 'wrote'}
+        try:
+            expected = compute_lu_distribution.worker_with_sentences(bio)
+        finally:
+            compute_lu_distribution.splitter, compute_lu_distribution.tagger, \
+                compute_lu_distribution.all_verbs = saved
+
+        histogram, = columnar.map_sentences(self.path, compute_lu_distribution._lus_per_sentence,
+                                            ({'born', 'wrote'},), parts=1)
+        self.assertEqual({k: v for k, v in enumerate(histogram.tolist()) if v}, dict(expected))
+        self.assertEqual(dict(expected), {1: 2, 0: 1})
+
+    def test_rank_verbs(self):
+        jsonl = os.path.join(self.directory, 'tagged.jsonl')
+        with open(jsonl, 'w') as f:
+            for item in self.items:
+                f.write(json.dumps(item) + '\n')
+        self.write(self.items)
+
+        self.assertEqual(rank_verbs.produce_lemma_tokens(self.path, 'pos_tag', 'en'),
+                         rank_verbs.produce_lemma_tokens(jsonl, 'pos_tag', 'en'))
+        self.assertEqual(rank_verbs.produce_lemma_tokens(self.path, 'pos_tag', 'en'),
+                         {'be': {'was', 'is'}, 'bear': {'born', 'bore'}})
+
+        self.assertEqual(rank_verbs.PopularityRanking(self.path, 'pos_tag').find_ranking(processes=1),
+                         {'be': 1.0, 'bear': 1.0})
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Replies to /status/<code> with the given code, waiting a bit so
+        that concurrent requests overlap, and keeps track of the requests
+    """
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+
+    def do_GET(self):
+        server = self.server
+        with self.lock:
+            server.paths.append(self.path)
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            statuses = server.statuses.get(self.path)
+            status = statuses.pop(0) if statuses else 200
+
+        time.sleep(0.02)
+        body = 'page %s' % self.path
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (429, 503):
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+        with self.lock:
+            server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestWeb(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.paths, self.server.connections, self.server.statuses = [], set(), {}
+        self.server.active = self.server.max_active = 0
+        threading.Thread(target=self.server.serve_forever).start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.url = 'http://%s/' % self.host
+
+        self.settings = web.BACKOFF, web.CONCURRENCY, dict(web.HOST_CONCURRENCY)
+        web.BACKOFF = 0.01
+        web._local['pid'] = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        web.BACKOFF, web.CONCURRENCY, web.HOST_CONCURRENCY = self.settings
+        web._local['pid'] = None
+
+    def test_retry(self):
+        self.server.statuses['/busy'] = [503, 429]
+        response = web.get(self.url + 'busy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.paths, ['/busy'] * 3)
+
+    def test_give_up(self):
+        self.server.statuses['/busy'] = [503] * 5
+        response = web.get(self.url + 'busy', retries=2)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_not_retried(self):
+        self.server.statuses['/missing'] = [404]
+        self.assertEqual(web.get(self.url + 'missing').status_code, 404)
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_keep_alive(self):
+        for i in xrange(5):
+            web.get(self.url + str(i))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_fetch_many(self):
+        urls = [self.url + str(i) for i in xrange(20)]
+        for ordered in [True, False]:
+            results = list(web.fetch_many(urls, threads=8, ordered=ordered))
+            self.assertEqual(sorted(url for url, _, _ in results), sorted(urls))
+            if ordered:
+                self.assertEqual([url for url, _, _ in results], urls)
+            for url, response, error in results:
+                self.assertIsNone(error)
+                self.assertEqual(response.text, 'page /' + url.split('/')[-1])
+
+    def test_pool_reused(self):
+        list(web.fetch_many([self.url + 'a'], threads=4))
+        pool = web._local['pools'][4]
+        list(web.fetch_many([self.url + 'b'], threads=4))
+        self.assertIs(web._local['pools'][4], pool)
+
+    def test_host_concurrency(self):
+        web.HOST_CONCURRENCY[self.host] = 2
+        list(web.fetch_many([self.url + str(i) for i in xrange(12)], threads=8))
+        self.assertEqual(self.server.max_active, 2)
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        results = list(web.fetch_many([(self.url, {'retries': 0})]))
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[0][2], requests.ConnectionError)
+
+    def test_get_many_and_cache(self):
+        base_dir = cache.BASE_DIR
+        cache.BASE_DIR = tempfile.mkdtemp()
+        self.server.statuses['/missing'] = [404]
+        urls = [self.url + 'missing', self.url + 'a', self.url + 'b']
+        try:
+            for _ in xrange(2):
+                results = {url: (content, error) for url, content, error
+                           in io.get_many_and_cache(urls, namespace='test')}
+                self.assertEqual(results[self.url + 'a'], ('page /a', None))
+                self.assertEqual(results[self.url + 'missing'][1].response.status_code, 404)
+                # all cached, the second time no request is sent
+                web._local['pools'].clear()
+            self.assertEqual(web._local['pools'], {})
+        finally:
+            shutil.rmtree(cache.BASE_DIR)
+            cache.BASE_DIR = base_dir
+        self.assertEqual(sorted(self.server.paths), ['/a', '/b', '/missing'])
+
+
 class TestCache(unittest.TestCase):
     def random_hex_string(self, length):
         return ''.join(random.choice('0123456789abcdef') for _ in xrange(6))
@@ -154,8 +878,8 @@ class TestCache(unittest.TestCase):
         self.assertEqual(cache.get('key-2'), 'value-2')
 
     def test_folder_creation(self):
-        def same_prefix_path(hashed):
-            base = os.path.join(cache.BASE_DIR, 'some prefix')
+        def same_prefix_path(hashed, base_dir=None):
+            base = os.path.join(base_dir or cache.BASE_DIR, 'some prefix')
             return os.path.join(base, hashed), base, hashed
         cache._path_for = same_prefix_path
 
@@ -179,6 +903,152 @@ class TestCache(unittest.TestCase):
 
         self.assertNotEqual(function1('value'), function2('value'))
 
+    def test_decorator_ignored(self):
+        calls = []
+
+        @cache.cached(ignored=('verbose',))
+        def function(x, verbose=False):
+            calls.append(x)
+            return x
+
+        function('value', verbose=True)
+        function(x='value')
+        self.assertEqual(calls, ['value'])
+
+    def test_negative(self):
+        calls = []
+
+        @cache.cached
+        def function(x):
+            calls.append(x)
+
+        for _ in xrange(3):
+            self.assertIsNone(function('value'))
+        self.assertEqual(calls, ['value'])
+        self.assertGreater(cache.negative_hits['%s.function' % __name__], 0)
+
+    def test_negative_expiration(self):
+        calls = []
+
+        @cache.cached(negative_ttl=-1)
+        def function(x):
+            calls.append(x)
+
+        function('value')
+        function('value')
+        self.assertEqual(calls, ['value', 'value'])
+
+    def test_set_negative(self):
+        cache.set_negative('key')
+        self.assertEqual(cache.get('key', 'default'), 'default')
+        self.assertIs(cache.get('key', negative=cache.NEGATIVE), cache.NEGATIVE)
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_single_flight(self):
+        global calls_file
+        calls_file = os.path.join(cache.BASE_DIR, 'calls')
+        results = list(parallel.map(slow_lookup, [1, 1, 1, 2], processes=4))
+        self.assertEqual(sorted(results), [2, 2, 2, 4])
+        with open(calls_file) as f:
+            self.assertEqual(sorted(f.read().split()), ['1', '2'])
+
+    def test_single_flight_download(self):
+        global calls_file
+        calls_file = os.path.join(cache.BASE_DIR, 'calls')
+
+        def get(url, **kwargs):
+            record_call(url)
+            response = requests.Response()
+            response.status_code = 200
+            response._content = 'content'
+            return response
+
+        web_get, web.get = web.get, get
+        try:
+            results = list(parallel.map(io.get_and_cache, ['http://example.org'] * 3, processes=3))
+        finally:
+            web.get = web_get
+        self.assertEqual(results, ['content'] * 3)
+        with open(calls_file) as f:
+            self.assertEqual(f.read().split(), ['http://example.org'])
+
+    def test_single_flight_download_many(self):
+        global calls_file
+        calls_file = os.path.join(cache.BASE_DIR, 'calls')
+
+        def fetch_many(requests_, threads):
+            for request in requests_:
+                record_call(request[0])
+                response = requests.Response()
+                response.status_code = 200
+                response._content = 'content of ' + request[0]
+                yield request, response, None
+
+        urls = ['http://example.org/%d' % i for i in xrange(4)]
+        fetch, web.fetch_many = web.fetch_many, fetch_many
+        try:
+            results = list(parallel.map(get_many_pages, [urls, urls[1:], urls[:2]], processes=3))
+        finally:
+            web.fetch_many = fetch
+        self.assertEqual(sorted(results), sorted([(url, 'content of ' + url) for url in each]
+                                                 for each in [urls, urls[1:], urls[:2]]))
+        with open(calls_file) as f:
+            self.assertEqual(sorted(f.read().split()), urls)
+
+    def test_lock_many(self):
+        cache._hash_for = lambda key: '000' if key == 'key' else '111'
+        with cache.lock_many(['key', 'another key']):
+            with cache.lock('key'):
+                cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_lock_reentrant(self):
+        with cache.lock('key'):
+            with cache.lock('key'):
+                cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_lock_namespaces(self):
+        # same stripe, different namespaces
+        cache._hash_for = lambda key: '000'
+        timeout, cache.LOCK_TIMEOUT = cache.LOCK_TIMEOUT, 1
+        waited = []
+
+        def other():
+            start = time.time()
+            with cache.lock('another key', namespace='urls'):
+                waited.append(time.time() - start)
+
+        try:
+            with cache.lock('key', namespace='resolver'):
+                thread = threading.Thread(target=other)
+                thread.start()
+                thread.join()
+        finally:
+            cache.LOCK_TIMEOUT = timeout
+        self.assertLess(waited[0], 0.5)
+
+    def test_not_found(self):
+        calls = []
+
+        def get(url, **kwargs):
+            calls.append(url)
+            response = requests.Response()
+            response.url = url
+            response.status_code = 404
+            return response
+
+        web_get, web.get = web.get, get
+        try:
+            for _ in xrange(3):
+                with self.assertRaises(requests.HTTPError) as context:
+                    io.get_and_cache('http://example.org/missing')
+                self.assertEqual(context.exception.response.status_code, 404)
+        finally:
+            web.get = web_get
+        self.assertEqual(calls, ['http://example.org/missing'])
+
     def test_enabled(self):
         cache.ENABLED = False
         cache.set('key', 'value')
@@ -190,6 +1060,195 @@ class TestCache(unittest.TestCase):
         cache.set('obj', obj)
         self.assertEqual(obj, cache.get('obj'))
 
+    def test_namespaces(self):
+        cache.set('key', 'value')
+        cache.set('key', 'namespaced value', namespace='ns')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.get('key', namespace='ns'), 'namespaced value')
+        self.assertIsNone(cache.get('key', namespace='another ns'))
+
+    def test_expiration(self):
+        cache.set('key', 'value', ttl=-1)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 'another value', overwrite=False, ttl=3600)
+        self.assertEqual(cache.get('key'), 'another value')
+
+    def test_expiration_in_memory(self):
+        cache.set('key', 'value', ttl=0.2)
+        cache.memory.clear()
+        self.assertEqual(cache.get('key'), 'value')
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('key'))
+
+    def test_namespace_ttl(self):
+        cache.TTL['expiring'] = -1
+        try:
+            cache.set('key', 'value', namespace='expiring')
+            self.assertIsNone(cache.get('key', namespace='expiring'))
+        finally:
+            del cache.TTL['expiring']
+
+    def test_purge(self):
+        cache.set('key', 'value')
+        cache.set('key', 'value', namespace='ns')
+        cache.set('key', 'value', namespace='another ns')
+        cache.purge('ns')
+        self.assertIsNone(cache.get('key', namespace='ns'))
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.get('key', namespace='another ns'), 'value')
+        cache.purge('')
+        self.assertIsNone(cache.get('key'))
+
+    def test_purge_expired(self):
+        cache.set('expired', 'value', ttl=-1)
+        cache.set('expired', 'value', namespace='ns', ttl=-1)
+        cache.set('valid', 'value', ttl=3600)
+        self.assertEqual(cache.purge_expired(), 2)
+        self.assertEqual(cache.get('valid'), 'value')
+
+    def test_backend_base_dir(self):
+        base_dir = os.path.join(cache.BASE_DIR, 'elsewhere')
+        backend = cache.FileSystemBackend(base_dir)
+        backend.set('key', '"value"')
+        backend.set('key', '"namespaced value"', namespace='ns')
+        self.assertEqual(backend.get('key'), ('"value"', None))
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(sorted((ns, key, value) for ns, key, value, _ in backend.items()),
+                         [('', 'key', '"value"'), ('ns', 'key', '"namespaced value"')])
+        backend.purge('')
+        self.assertIsNone(backend.get('key'))
+        self.assertEqual(backend.get('key', namespace='ns'), ('"namespaced value"', None))
+
+    def test_sizes(self):
+        for i in xrange(3):
+            cache.set('key-%d' % i, i)
+        cache.set('key', 'value', namespace='ns')
+        sizes = cache.sizes()
+        self.assertEqual(sorted(sizes.keys()), ['', 'ns'])
+        self.assertEqual(sizes[''][0], 3)
+        self.assertEqual(sizes['ns'][0], 1)
+
+
+class TestCacheKeys(unittest.TestCase):
+    @staticmethod
+    def function(x, y=None, **kwargs):
+        pass
+
+    def test_positional_and_keyword(self):
+        self.assertEqual(cache.make_key(self.function, (1, 2), {}),
+                         cache.make_key(self.function, (), {'y': 2, 'x': 1}))
+
+    def test_ordering(self):
+        first = {'a': 1, 'b': [1, 2], 'c': {'d': 3, 'e': 4}}
+        second = dict(reversed(first.items()))
+        self.assertEqual(cache.make_key(self.function, (first, {1, 2, 3}), first),
+                         cache.make_key(self.function, (second, {3, 2, 1}), second))
+
+    def test_unicode(self):
+        self.assertEqual(cache.make_key(self.function, ('caf\xc3\xa9',), {}),
+                         cache.make_key(self.function, (u'cafe\u0301',), {}))
+
+    def test_ignored(self):
+        self.assertEqual(cache.make_key(self.function, (1,), {'z': 1}, ignored=('kwargs',)),
+                         cache.make_key(self.function, (1,), {'z': 2}, ignored=('kwargs',)))
+
+    def test_hashed(self):
+        key = cache.make_key(self.function, ('x' * 1000,), {}, hashed=('x',))
+        self.assertLess(len(key), 100)
+        self.assertNotEqual(key, cache.make_key(self.function, ('y' * 1000,), {}, hashed=('x',)))
+
+    def test_call_arguments(self):
+        def varargs(x, y=2, *args, **kwargs):
+            pass
+
+        def nested(x, (y, z)=(1, 2)):
+            pass
+
+        calls = [(self.function, (1,), {}), (self.function, (1, 2), {'z': 3}),
+                 (self.function, (), {'y': 2, 'x': 1}), (varargs, (1, 2, 3, 4), {'k': 5}),
+                 (varargs, (1,), {}), (nested, (1, (3, 4)), {}), (nested, (1,), {})]
+        for function, args, kwargs in calls:
+            self.assertEqual(cache._call_arguments(function, args, kwargs),
+                             inspect.getcallargs(function, *args, **kwargs))
+
+        for args, kwargs in [((1, 2, 3), {}), ((1,), {'x': 1}), ((), {'y': 1})]:
+            self.assertRaises(TypeError, cache._call_arguments, lambda x, y=None: None, args, kwargs)
+
+    def test_encoding(self):
+        values = [1, 2L, 1.5, float('nan'), True, None, 'caf\xc3\xa9', 'caf\xe9', u'cafe\u0301',
+                  {'b': 1, u'a': [1, (2, 3)]}, {1: 'x', (1, 2): 'y', None: 3}, {3, 1, 2}, object]
+        for value in values:
+            self.assertEqual(cache._encode(value), cache._dumps(cache._canonical(value)))
+
+
+class TestMemoryCache(unittest.TestCase):
+    def setUp(self):
+        self.memory = cache.MemoryCache(max_entries=3, max_bytes=100)
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.memory.get('key'))
+        self.memory.set('key', 'value', '"value"')
+        self.assertEqual(self.memory.get('key'), 'value')
+        stats = self.memory.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_evict_by_count(self):
+        for i in xrange(4):
+            self.memory.set('key-%d' % i, i, str(i))
+        self.memory.get('key-1')
+        self.memory.set('key-4', 4, '4')
+
+        self.assertIsNone(self.memory.get('key-0'))
+        self.assertIsNone(self.memory.get('key-2'))
+        self.assertEqual(self.memory.get('key-1'), 1)
+        self.assertEqual(self.memory.stats()['entries'], 3)
+
+    def test_evict_by_size(self):
+        self.memory.set('small', 'x', '"x"')
+        self.memory.set('big', 'x' * 90, '"%s"' % ('x' * 90))
+        self.assertIsNone(self.memory.get('small'))
+        self.memory.set('huge', 'x' * 200, '"%s"' % ('x' * 200))
+        self.assertIsNone(self.memory.get('huge'))
+        self.assertLessEqual(self.memory.stats()['bytes'], 100)
+
+    def test_mutable_values(self):
+        self.memory.set('key', ['value'], '["value"]')
+        self.memory.get('key').append('another value')
+        self.assertEqual(self.memory.get('key'), ['value'])
+
+
+class TestSQLiteCache(TestCache):
+    def setUp(self):
+        super(TestSQLiteCache, self).setUp()
+        self.cache_backend = cache.BACKEND
+        cache.BACKEND = 'sqlite'
+
+    def tearDown(self):
+        cache.BACKEND = self.cache_backend
+        super(TestSQLiteCache, self).tearDown()
+
+    def test_single_file(self):
+        for i in xrange(10):
+            cache.set('key-%d' % i, i)
+        self.assertTrue(all(f.startswith(cache.SQLiteBackend.file_name)
+                            for f in os.listdir(cache.BASE_DIR)))
+
+    def test_migrate(self):
+        source = os.path.join(cache.BASE_DIR, 'files')
+        cache.BASE_DIR, base_dir = source, cache.BASE_DIR
+        cache.BACKEND = 'files'
+        cache.set('key-1', 'value-1')
+        cache.set(u'\u84c4\u3048\u3066', {'complex': ['object']})
+        cache.set('key-2', 'value-2', namespace='ns', ttl=3600)
+
+        cache.BASE_DIR = base_dir
+        cache.BACKEND = 'sqlite'
+        cache.migrate.callback(source, overwrite=False)
+
+        self.assertEqual(cache.get('key-1'), 'value-1')
+        self.assertEqual(cache.get(u'\u84c4\u3048\u3066'), {'complex': ['object']})
+        self.assertEqual(cache.get('key-2', namespace='ns'), 'value-2')
+
 
 class TestWikidata(unittest.TestCase):
 
@@ -199,6 +1258,113 @@ class TestWikidata(unittest.TestCase):
     def tearDown(self):
         cache.ENABLED = True
 
+    def fake_api(self, action, params, use_cache=True, threads=8):
+        """ Each term is found as entity Q<length of the term> and in the pages
+            "common" and "page <term>", which are entities Q0 and Q1<length of the term>
+        """
+        self.calls.append((action, len(params)))
+        responses = []
+        for each in params:
+            if action == 'query':
+                responses.append({'query': {'search': [
+                    {'title': 'common'}, {'title': 'page ' + each['srsearch']}
+                ]}})
+            elif action == 'wbsearchentities':
+                term = each['search']
+                eid = 'Q0' if term == 'common' else 'Q1%d' % (len(term) - 5) \
+                    if term.startswith('page ') else 'Q%d' % len(term)
+                responses.append({'search': [{'id': eid}]})
+            elif action == 'wbgetentities':
+                responses.append({'entities': {eid: {
+                    'id': eid, 'labels': {'en': {'value': 'x' * len(eid)}},
+                    'claims': {'P31': [{'mainsnak': {'datavalue': {'value': {'numeric-id': 5}}}}]},
+                } for eid in each['ids'].split('|')}})
+        return responses
+
+    def test_search_many(self):
+        self.calls = []
+        call_api_many, wikidata.call_api_many = wikidata.call_api_many, self.fake_api
+        batch, wikidata.ENTITIES_BATCH = wikidata.ENTITIES_BATCH, 2
+        try:
+            results = wikidata.search_many(['Ab', 'cde ', 'ab'], 'en', label_exact=False)
+            self.assertEqual(self.calls, [('wbsearchentities', 2), ('query', 2),
+                                          ('wbsearchentities', 3), ('wbgetentities', 3)])
+            self.assertEqual({term: [e['id'] for e in entities] for term, entities in results.iteritems()},
+                             {'ab': ['Q2', 'Q0', 'Q12'], 'cde': ['Q3', 'Q0', 'Q13']})
+
+            self.assertEqual([e['id'] for e in wikidata.search('AB', 'en', type_=5, label_exact=False)], ['Q2', 'Q0', 'Q12'])
+            self.assertEqual(wikidata.search('AB', 'en', type_={6, 7}, label_exact=False), [])
+            self.assertEqual([e['id'] for e in wikidata.search('xx', 'en')], ['Q2', 'Q0'])
+        finally:
+            wikidata.call_api_many = call_api_many
+            wikidata.ENTITIES_BATCH = batch
+
+    def test_local_index(self):
+        def entity(eid, label, aliases, types, sitelinks):
+            return json.dumps({
+                'id': eid, 'type': 'item',
+                'labels': {'en': {'language': 'en', 'value': label},
+                           'it': {'language': 'it', 'value': label + ' it'}},
+                'aliases': {'en': [{'language': 'en', 'value': alias} for alias in aliases]},
+                'claims': {'P31': [{'mainsnak': {'snaktype': 'value', 'datavalue': {
+                    'type': 'wikibase-entityid', 'value': {'numeric-id': t}}}} for t in types],
+                    'P18': [{'mainsnak': {'datavalue': {'value': 'picture.jpg'}}}]},
+                'sitelinks': {'wiki%d' % i: {} for i in xrange(sitelinks)},
+            })
+
+        workdir = tempfile.mkdtemp()
+        dump = os.path.join(workdir, 'dump.json.gz')
+        with gzip.open(dump, 'w') as f:
+            f.write('[\n' + ',\n'.join([
+                entity('Q1', 'Vaughan', [], [515], 3),
+                entity('Q2', 'Vaughan', ['Vaughan family'], [5], 10),
+                entity('Q3', 'Toronto', [u'Tdot', 'Vaughan'], [515], 1),
+            ]) + '\n]\n')
+
+        def call_api_many(*args, **kwargs):
+            raise AssertionError('the APIs should not be used')
+
+        index = wikidata_index.WikidataIndex.build(dump, os.path.join(workdir, 'index'), ['en'], processes=1)
+        api, wikidata.call_api_many = wikidata.call_api_many, call_api_many
+        wikidata.INDEX = index.path
+        try:
+            self.assertEqual(len(index), 3)
+            self.assertNotIn('P18', index.lookup(['toronto'], 'en')['toronto'][0]['claims'])
+            self.assertEqual(index.lookup(['toronto it'], 'it'), {'toronto it': []})
+
+            self.assertEqual([e['id'] for e in wikidata.search(' VAUGHAN', 'en', label_exact=False)],
+                             ['Q2', 'Q1', 'Q3'])
+            self.assertEqual([e['id'] for e in wikidata.search('vaughan', 'en', type_={515, 6256})],
+                             ['Q1'])
+            self.assertEqual([e['id'] for e in wikidata.search('tdot', 'en', label_exact=False)], ['Q3'])
+            self.assertEqual(wikidata.search('tdot', 'en'), [])
+            self.assertEqual(wikidata.place_resolver('P19', 'Vaughan', 'en'), 'Q1')
+        finally:
+            wikidata.call_api_many = api
+            wikidata.INDEX = None
+            shutil.rmtree(workdir)
+
+    def test_hints(self):
+        def claims(**properties):
+            return {property: [{'mainsnak': {'datavalue': {'value': value}}} for value in values]
+                    for property, values in properties.iteritems()}
+
+        hints = wikidata.Hints({'P569': ['+00000001900-05-17T00:00:00Z/11'], 'P21': ['Q6581097'],
+                                'P27': ['Q30', 'Q145', None], 'Born': '17 may 1900'})
+        entities = [
+            {'id': 'Q1'},
+            {'id': 'Q2', 'claims': claims(P21=[{'numeric-id': 6581097}])},
+            {'id': 'Q3', 'claims': claims(P569=[{'time': '+00000001900-01-01T00:00:00Z', 'precision': 9}],
+                                          P27=[{'numeric-id': 30}, {'numeric-id': 145}])},
+            {'id': 'Q4', 'claims': claims(P569=[{'time': '+00000001901-05-17T00:00:00Z', 'precision': 11}],
+                                          P27=[{'broken': True}])},
+        ]
+
+        self.assertEqual(map(hints.score, entities[1:]), [0.5, 3, 0])
+        self.assertEqual(hints.best_match(entities), 'Q3')
+        self.assertEqual(hints.best_match(entities[:2]), '')
+        self.assertEqual(hints.best_match(entities[:1]), '')
+
     def test_date_width(self):
         self.assertEqual(wikidata.format_date(1967, 1, 17),
                          '+00000001967-01-17T00:00:00Z/11')
@@ -384,6 +1550,195 @@ class TestPosTag(unittest.TestCase):
             self.assertEqual(self.tagger.tag_one(each['text']),
                              each['correct'])
 
+    def test_tag_sentences(self):
+        sentences = [each['text'] for each in self.items] * 3
+        self.assertEqual(self.tagger.tag_sentences(sentences, batch_size=4),
+                         [each['correct'] for each in self.items] * 3)
+
+    def test_shared_tagger(self):
+        self.assertIs(pos_tag.TTPosTagger('en').tagger, self.tagger.tagger)
+
+
+class FakeTreeTagger(object):
+    """ Tags every token as a noun whose lemma is the token in lower case, counting the calls """
+    dummysequence = u'This\nis\na\ndummy\nsentence\n.'
+
+    def __init__(self):
+        self.calls = 0
+
+    def tag_text(self, text, **kwargs):
+        self.calls += 1
+        tokens = []
+        for chunk in [text] if isinstance(text, unicode) else text:
+            tokens.extend(chunk if isinstance(chunk, list) else chunk.split())
+        return [token if token.startswith('<') else u'%s\tNN\t%s' % (token, token.lower())
+                for token in tokens]
+
+
+class FakeTaggerPool(object):
+    """ Tags with :class:`FakeTreeTagger`, keeping track of the jobs in flight.
+        Jobs of texts starting with 'Fast' are finished straight away
+    """
+    def __init__(self, **kwargs):
+        self.tagger = FakeTreeTagger()
+        self.in_flight = self.most_in_flight = 0
+        self.stopped = False
+
+    def tag_text_async(self, text, **kwargs):
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        return FakeJob(self, text)
+
+    def stop_poll(self):
+        self.stopped = True
+
+
+class FakeJob(object):
+    def __init__(self, pool, text):
+        self.pool = pool
+        self.result = pool.tagger.tag_text(text)
+        self.finished = text.startswith(u'Fast')
+
+    def wait_finished(self):
+        self.finished = True
+        self.pool.in_flight -= 1
+
+
+class TestPosTagCache(unittest.TestCase):
+    def setUp(self):
+        self.base_dir, cache.BASE_DIR = cache.BASE_DIR, tempfile.mkdtemp()
+        self.fake = FakeTreeTagger()
+        self.get_tree_tagger, pos_tag.get_tree_tagger = pos_tag.get_tree_tagger, lambda *args, **kwargs: self.fake
+        self.tagger = pos_tag.TTPosTagger('en')
+        self.enabled, pos_tag.CACHE = pos_tag.CACHE, True
+        pos_tag.cache_stats.clear()
+
+    def tearDown(self):
+        shutil.rmtree(cache.BASE_DIR)
+        cache.BASE_DIR = self.base_dir
+        pos_tag.get_tree_tagger = self.get_tree_tagger
+        pos_tag.CACHE = self.enabled
+
+    def test_tag_one(self):
+        tagged = self.tagger.tag_one(u'He was born')
+        self.assertEqual(tagged, [Tag(u'He', u'NN', u'he'), Tag(u'was', u'NN', u'was'),
+                                  Tag(u'born', u'NN', u'born')])
+        self.assertEqual(self.tagger.tag_one(u'He was born'), tagged)
+        self.assertEqual(self.fake.calls, 1)
+        self.assertEqual(pos_tag.cache_stats, Counter(hits=1, misses=1))
+
+    def test_key(self):
+        self.tagger.tag_one(u'He was born')
+        self.tagger.tag_one(u'He was born', notagurl=True)
+        pos_tag.TTPosTagger('it').tag_one(u'He was born')
+        self.tagger.tag_one(u'He was born.')
+        self.assertEqual(self.fake.calls, 4)
+
+    def test_key_non_ascii(self):
+        self.assertEqual(self.tagger._cache_key('Jos\xc3\xa9 was born', {}),
+                         self.tagger._cache_key(u'Jos\xe9 was born', {}))
+
+    def test_tag_sentences(self):
+        sentences = [u'She died', u'He was born', u'It is']
+        self.tagger.tag_one(sentences[1])
+
+        tagged = self.tagger.tag_sentences(sentences)
+        self.assertEqual(self.fake.calls, 2)
+        self.assertEqual([[tag.word for tag in tags] for tags in tagged],
+                         [[u'She', u'died'], [u'He', u'was', u'born'], [u'It', u'is']])
+        self.assertEqual([self.tagger.tag_one(sentence) for sentence in sentences], tagged)
+        self.assertEqual(self.fake.calls, 2)
+
+    def test_disabled(self):
+        pos_tag.CACHE = False
+        self.tagger.tag_one(u'He was born')
+        self.tagger.tag_one(u'He was born')
+        self.assertEqual(self.fake.calls, 2)
+
+
+class TestPosTagMany(unittest.TestCase):
+    def setUp(self):
+        self.pools = []
+        self.pool_class, pos_tag.TaggerProcessPoll = pos_tag.TaggerProcessPoll, self.make_pool
+        self.get_tree_tagger, pos_tag.get_tree_tagger = pos_tag.get_tree_tagger, lambda *args, **kwargs: None
+        self.cache, pos_tag.CACHE = pos_tag.CACHE, False
+        self.tagger = pos_tag.TTPosTagger('en')
+
+    def tearDown(self):
+        pos_tag.TaggerProcessPoll = self.pool_class
+        pos_tag.get_tree_tagger = self.get_tree_tagger
+        pos_tag.CACHE = self.cache
+
+    def make_pool(self, **kwargs):
+        self.pools.append(FakeTaggerPool(**kwargs))
+        return self.pools[-1]
+
+    def items(self):
+        for i in xrange(20):
+            yield {'id': i, 'text': u'Fast item %d' % i if i % 3 == 0 else u'Slow item %d' % i if i % 5 else u''}
+
+    def test_ordered(self):
+        tagged = list(self.tagger.tag_many(self.items(), 'text', 'tagged', window=4))
+        self.assertEqual([item['id'] for item in tagged], [i for i in xrange(20) if i % 5 or i % 3 == 0])
+        for item in tagged:
+            self.assertEqual([tag.word for tag in item['tagged']], item['text'].split())
+        self.assertEqual(self.pools[0].most_in_flight, 4)
+        self.assertEqual(self.pools[0].in_flight, 0)
+        self.assertTrue(self.pools[0].stopped)
+
+    def test_unordered(self):
+        tagged = list(self.tagger.tag_many(self.items(), 'text', 'tagged', window=4, ordered=False))
+        ids = [item['id'] for item in tagged]
+        self.assertEqual(sorted(ids), [i for i in xrange(20) if i % 5 or i % 3 == 0])
+        self.assertLess(ids.index(3), ids.index(1))
+        self.assertEqual(self.pools[0].most_in_flight, 4)
+
+    def test_max_bytes(self):
+        tagged = list(self.tagger.tag_many(self.items(), 'text', 'tagged', window=4, max_bytes=1))
+        self.assertEqual(len(tagged), 18)
+        self.assertEqual(self.pools[0].most_in_flight, 1)
+
+
+class TestPerceptronPosTagger(unittest.TestCase):
+    documents = [
+        [[u'He', u'PP', u'he'], [u'was', u'VBD', u'be'], [u'born', u'VVN', u'bear'],
+         [u'in', u'IN', u'in'], [u'Rome', u'NP', u'Rome'], [u'.', u'SENT', u'.'],
+         [u'She', u'PP', u'she'], [u'wrote', u'VVD', u'write'], [u'books', u'NNS', u'book'],
+         [u'.', u'SENT', u'.']],
+        [[u'It', u'PP', u'it'], [u'was', u'VBD', u'be'], [u'Zyxw', u'NP', u'<unknown>'],
+         [u'.', u'SENT', u'.']],
+    ]
+
+    def setUp(self):
+        self.model = tempfile.mktemp()
+        self.tagger = pos_tag.PerceptronPosTagger.train(self.documents * 20, 'en', self.model)
+
+    def tearDown(self):
+        os.remove(self.model)
+
+    def test_tag_one(self):
+        self.assertEqual(self.tagger.tag_one(u'He was born in Rome.'),
+                         [Tag(*tag) for tag in self.documents[0][:5]])
+        self.assertEqual(self.tagger.tag_one(u'It was Zyxw.', skip_unknown=False),
+                         [Tag(*tag) for tag in self.documents[1][:3]])
+        self.assertNotIn(u'Zyxw', [tag.word for tag in self.tagger.tag_one(u'It was Zyxw.')])
+
+    def test_tag_many(self):
+        tagger = pos_tag.PerceptronPosTagger('en', self.model, processes=2)
+        items = [{'id': i, 'text': u'She wrote books.' if i % 2 else u''} for i in xrange(10)]
+        tagged = list(tagger.tag_many(items, 'text', 'tagged', batch_size=3))
+        self.assertEqual([item['id'] for item in tagged], [1, 3, 5, 7, 9])
+        for item in tagged:
+            self.assertEqual(item['tagged'], [Tag(*tag) for tag in self.documents[0][6:9]])
+
+    def test_tag_many_interface(self):
+        self.assertEqual(inspect.getargspec(pos_tag.PerceptronPosTagger.tag_many),
+                         inspect.getargspec(pos_tag.TTPosTagger.tag_many))
+        items = [{'id': i, 'text': u'She wrote books.'} for i in xrange(4)]
+        tagged = list(self.tagger.tag_many(items, 'text', 'tagged', window=2, ordered=True,
+                                           max_bytes=1, batch_size=1))
+        self.assertEqual([item['id'] for item in tagged], range(4))
+
 
 class TestDateNormalizer(unittest.TestCase):
     def setUp(self):
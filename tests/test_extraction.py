@@ -1,9 +1,12 @@
 # -*- encoding: utf-8 -*-
+import json
+import os
+import tempfile
 import unittest
 from treetaggerwrapper import Tag
-from strephit.extraction import process_semistructured, extract_sentences
+from strephit.extraction import process_semistructured, extract_sentences, balanced_extract
 from strephit.extraction.extract_sentences import *
-from strephit.commons import cache
+from strephit.commons import cache, io
 
 class TestSemistructured(unittest.TestCase):
     def setUp(self):
@@ -133,3 +136,44 @@ class TestExtractSentences(unittest.TestCase):
         self.assertIn('lu', sentence)
         self.assertEqual(sentence['text'], self.text_real)
         self.assertIn(sentence['lu'], self.lemma_to_token_real.keys())
+
+    def test_tag_document(self):
+        corpus = [{self.text_key: u'Forbes William was born on 3 January. He died in 1900. '
+                                  u'His son was born in Edinburgh and died young.',
+                   'url': self.url, 'name': self.name}]
+
+        by_document, by_sentence = [list(ManyToManyExtractor(
+            corpus, self.text_key, self.sent_key, 'en',
+            self.lemma_to_token_real, self.match_base_form, tag_document
+        ).extract(1)) for tag_document in [True, False]]
+
+        self.assertEqual(len(by_document), 4)
+        self.assertEqual(by_document, by_sentence)
+
+
+class TestBalancedExtract(unittest.TestCase):
+    sentences = [
+        {'url': 'http://a.org/1', 'lu': 'be'},
+        {'url': 'not a url', 'lu': 'be'},
+        {'url': 'http://a.org/2', 'lu': 'be'},
+        {'url': 'http://b.org/1', 'lu': 'write'},
+        {'lu': 'be'},
+    ]
+
+    def test_lu_count_bad_url(self):
+        frequencies = balanced_extract.lu_count(self.sentences)
+        self.assertEqual({source: dict(counts) for source, counts in frequencies.items()},
+                         {'a.org': {'be': 2}, 'b.org': {'write': 1}})
+
+    def test_lu_count_indexed(self):
+        path = tempfile.mktemp()
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(sentence) + '\n' for sentence in self.sentences)
+        try:
+            index = io.JsonLinesIndex.open(path, keys=('url', 'lu'))
+            self.assertEqual(balanced_extract.lu_count_indexed(index),
+                             balanced_extract.lu_count(self.sentences))
+        finally:
+            for each in [path, io.JsonLinesIndex.index_path(path), io.JsonLinesIndex.index_path(path) + '.keys']:
+                if os.path.exists(each):
+                    os.remove(each)